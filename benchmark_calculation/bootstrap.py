@@ -0,0 +1,219 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from common import *
+from buy_and_hold import get_buy_and_hold_share_allocation
+from portfolio_engine import holdings_daily_returns, summarize_daily_returns, weights_daily_returns
+from snp_500 import get_date_to_snp_500_prices
+
+NUM_RESAMPLES = 10000
+# Resamples drawn by one task of the process pool
+RESAMPLE_BATCH_SIZE = 1000
+# Pairs whose resampled differences are held at once by sharpe_difference_tests
+PAIR_BATCH_SIZE = 256
+CONFIDENCE = 0.95
+
+# Set once per worker process by _init_worker
+_worker_data = {}
+
+
+def default_block_length(num_days):
+    """
+    Block length of the circular block bootstrap, growing like T^(1/3)
+    """
+    return max(1, int(round(num_days ** (1 / 3))))
+
+
+def circular_block_sums(values, block_length):
+    """
+    values: (K, T) daily values
+
+    Returns the (K, T) sums of the block_length values starting on each day,
+    wrapping around to the first days at the end.
+    """
+    num_days = values.shape[1]
+    wrapped = np.concatenate([values] * (block_length // num_days + 2), axis=1)[:, :num_days + block_length]
+    cumulative = np.concatenate([np.zeros((values.shape[0], 1)), np.cumsum(wrapped, axis=1)], axis=1)
+    return cumulative[:, block_length:block_length + num_days] - cumulative[:, :num_days]
+
+
+def _init_worker(full_block_sums, last_block_sums, num_days, block_length):
+    _worker_data.update(
+        full_block_sums=full_block_sums, last_block_sums=last_block_sums,
+        num_days=num_days, block_length=block_length,
+    )
+
+
+def _resample_sharpe_ratios(seed_sequence, num_resamples):
+    """
+    Returns the (K, num_resamples) sharpe ratios of the series on
+    num_resamples circular block bootstrap resamples of the days.
+
+    Every resample is the same blocks of days for all series. Its sums are
+    the block sums of its block starts, so a batch of resamples is one
+    (3K, T) x (T, num_resamples) product with the counts of each start
+    instead of a pass over the resampled days.
+    """
+    full_block_sums, last_block_sums = _worker_data["full_block_sums"], _worker_data["last_block_sums"]
+    num_days, block_length = _worker_data["num_days"], _worker_data["block_length"]
+    num_full_blocks = num_days // block_length
+    rng = np.random.default_rng(seed_sequence)
+
+    starts = rng.integers(0, num_days, size=(num_resamples, num_full_blocks))
+    start_counts = np.bincount(
+        (starts + num_days * np.arange(num_resamples)[:, None]).ravel(), minlength=num_resamples * num_days
+    ).reshape(num_resamples, num_days)
+    sums = full_block_sums @ start_counts.T.astype(np.float64)
+    if last_block_sums is not None:
+        # the last block is cut to the days left
+        sums += last_block_sums[:, rng.integers(0, num_days, size=num_resamples)]
+
+    excess_sums, return_sums, square_sums = np.split(sums, 3)
+    mean = return_sums / num_days
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (
+            np.sqrt(TRADING_DAYS_PER_YEAR) * (excess_sums / num_days) /
+            np.sqrt(np.maximum(square_sums / num_days - mean ** 2, 0.0))
+        )
+
+
+def bootstrap_sharpe_ratios(
+    daily_returns,
+    daily_rf_rates,
+    num_resamples=NUM_RESAMPLES,
+    block_length=None,
+    seed=0,
+    num_workers=1,
+):
+    """
+    daily_returns: (K, T - 1) daily return rates of K strategies over the same days
+    daily_rf_rates: the T daily risk free rates of those days, as for
+    summarize_daily_returns (the first one is dropped)
+
+    Returns the (K,) sharpe ratios and their (K, num_resamples) circular block
+    bootstrap resamples, drawing the same blocks of days for every strategy so
+    differences between strategies keep their correlation.
+
+    Resamples are drawn in batches of RESAMPLE_BATCH_SIZE, each from its own
+    seed spawned from seed, so the result does not depend on num_workers.
+    A batch is cheap (about 15ms for 300 strategies over 440 days), so worker
+    processes only pay off for thousands of strategies or resamples.
+    """
+    daily_returns = np.atleast_2d(np.asarray(daily_returns, dtype=np.float64))
+    excess_returns = daily_returns - np.asarray(daily_rf_rates, dtype=np.float64)[1:]
+    num_days = daily_returns.shape[1]
+    block_length = block_length or default_block_length(num_days)
+    _, sharpe_ratios = summarize_daily_returns(daily_returns, daily_rf_rates)
+
+    quantities = np.concatenate([excess_returns, daily_returns, daily_returns ** 2])
+    full_block_sums = circular_block_sums(quantities, block_length)
+    last_block_length = num_days % block_length
+    last_block_sums = circular_block_sums(quantities, last_block_length) if last_block_length else None
+    worker_args = (full_block_sums, last_block_sums, num_days, block_length)
+
+    batch_sizes = [
+        min(RESAMPLE_BATCH_SIZE, num_resamples - start) for start in range(0, num_resamples, RESAMPLE_BATCH_SIZE)
+    ]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+    if num_workers == 1:
+        _init_worker(*worker_args)
+        batches = list(map(_resample_sharpe_ratios, seed_sequences, batch_sizes))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=worker_args,
+        ) as executor:
+            batches = list(executor.map(_resample_sharpe_ratios, seed_sequences, batch_sizes))
+    return sharpe_ratios, np.concatenate(batches, axis=1)
+
+
+def sharpe_difference_tests(
+    daily_returns,
+    daily_rf_rates,
+    names=None,
+    benchmark=None,
+    confidence=CONFIDENCE,
+    num_resamples=NUM_RESAMPLES,
+    block_length=None,
+    seed=0,
+    num_workers=1,
+):
+    """
+    Bootstrap tests of the sharpe ratio differences of K strategies
+    (see bootstrap_sharpe_ratios for the arguments), either of every strategy
+    against the benchmark (a name or row of daily_returns) or of every pair.
+
+    Returns a DataFrame with one row per pair: both sharpe ratios, their
+    difference, its confidence interval (bootstrap percentiles) and the
+    two-sided p-value of no difference, from the resampled differences
+    centered on the observed one.
+
+    The resampled differences are computed PAIR_BATCH_SIZE pairs at a time,
+    so memory stays O(PAIR_BATCH_SIZE x num_resamples) however many pairs
+    there are (all pairs of 300 strategies would otherwise take 3.6 GB).
+    """
+    names = list(names) if names is not None else list(range(len(daily_returns)))
+    sharpe_ratios, resampled = bootstrap_sharpe_ratios(
+        daily_returns, daily_rf_rates, num_resamples, block_length, seed, num_workers
+    )
+    if benchmark is not None:
+        b = names.index(benchmark) if benchmark in names else benchmark
+        pairs = [(a, b) for a in range(len(names)) if a != b]
+    else:
+        pairs = [(a, b) for a in range(len(names)) for b in range(a + 1, len(names))]
+    first, second = np.array([a for a, _ in pairs], dtype=np.int64), np.array([b for _, b in pairs], dtype=np.int64)
+
+    difference = sharpe_ratios[first] - sharpe_ratios[second]
+    alpha = 1 - confidence
+    ci_low, ci_high, p_value = np.empty(len(pairs)), np.empty(len(pairs)), np.empty(len(pairs))
+    for start in range(0, len(pairs), PAIR_BATCH_SIZE):
+        batch = slice(start, start + PAIR_BATCH_SIZE)
+        resampled_difference = resampled[first[batch]] - resampled[second[batch]]
+        ci_low[batch], ci_high[batch] = np.nanquantile(resampled_difference, [alpha / 2, 1 - alpha / 2], axis=1)
+        resampled_difference -= difference[batch, None]
+        extreme = np.abs(resampled_difference, out=resampled_difference) >= np.abs(difference[batch])[:, None]
+        p_value[batch] = (1 + extreme.sum(axis=1)) / (1 + resampled_difference.shape[1])
+
+    return pd.DataFrame({
+        "strategy": [names[a] for a in first],
+        "versus": [names[b] for b in second],
+        "sharpe": sharpe_ratios[first],
+        "versus_sharpe": sharpe_ratios[second],
+        "difference": difference,
+        "ci_low": ci_low,
+        "ci_high": ci_high,
+        "p_value": p_value,
+    })
+
+
+def main():
+    dates, ticker_to_closing_prices = get_ticker_to_closing_prices(
+        TEST_START_DATE, TEST_END_DATE
+    )
+    # S&P 500 closes on the same trading days as the stocks
+    date_to_snp_500_prices = get_date_to_snp_500_prices()
+    days = [i for i, date in enumerate(dates) if date in date_to_snp_500_prices]
+    dates = [dates[i] for i in days]
+    tickers = list(ticker_to_closing_prices)
+    prices = np.array([ticker_to_closing_prices[ticker] for ticker in tickers]).T[days]
+    snp_500_prices = np.array([date_to_snp_500_prices[date] for date in dates])
+    daily_risk_free_rates = get_daily_risk_free_rates(dates)
+
+    bnh_allocations = get_buy_and_hold_share_allocation(ticker_to_closing_prices)
+    daily_returns = np.vstack([
+        holdings_daily_returns(prices, np.array([[bnh_allocations[ticker] for ticker in tickers]])),
+        weights_daily_returns(prices, np.full((1, len(tickers)), 1 / len(tickers))),
+        snp_500_prices[1:] / snp_500_prices[:-1] - 1,
+    ])
+    tests = sharpe_difference_tests(
+        daily_returns, daily_risk_free_rates,
+        names=["Buy and hold", "Equal weight", "S&P 500"], benchmark="S&P 500",
+    )
+    print(tests.round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
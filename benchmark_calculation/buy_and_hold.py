@@ -26,15 +26,10 @@ def get_buy_and_hold_share_allocation(ticker_to_closing_prices):
 
 
 def main():
-    date_to_daily_risk_free_rate = get_date_to_daily_risk_free_rates(
-        TEST_START_DATE, TEST_END_DATE
-    )
     dates, ticker_to_closing_prices = get_ticker_to_closing_prices(
         TEST_START_DATE, TEST_END_DATE
     )
-    daily_risk_free_rates = fill_missing_daily_rf_rates(
-        date_to_daily_risk_free_rate, dates
-    )
+    daily_risk_free_rates = get_daily_risk_free_rates(dates)
 
     bnh_allocations = get_buy_and_hold_share_allocation(ticker_to_closing_prices)
     # Compute metrics
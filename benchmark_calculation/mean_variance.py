@@ -0,0 +1,222 @@
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+
+# Risk free rate of the max sharpe portfolio (EfficientFrontier.max_sharpe's
+# default when get_mean_variance_share_allocation was written, newer versions
+# default to 0, so the benchmark passes it explicitly)
+RISK_FREE_RATE = 0.02
+TOLERANCE = 1e-10
+
+
+def _equality_qp(factor, c, E, e):
+    """
+    Minimizer of 1/2 x^T Q x - c^T x subject to E^T x = e, and the
+    multipliers of the equalities, given the Cholesky factor of Q
+    """
+    Qc, QE = cho_solve(factor, c), cho_solve(factor, E)
+    multipliers = np.linalg.lstsq(E.T @ QE, e - E.T @ Qc, rcond=None)[0]
+    return Qc + QE @ multipliers, multipliers
+
+
+def active_set_qp(Q, c, E, e, x0, max_iterations=None, factor_cache=None):
+    """
+    Solves min 1/2 x^T Q x - c^T x subject to E^T x = e and x >= 0
+    (Q positive definite, E of shape (N, m) with few equalities)
+    with the primal active set method, starting from x0, which must satisfy
+    the constraints. Each iteration solves the problem on the variables
+    not held at 0 and either moves towards its solution until a variable
+    reaches 0 or frees the variable whose bound multiplier is the most negative.
+    Starting from the solution of a nearby problem (e.g. the previous
+    rebalance's) only takes the few iterations needed to change its support.
+
+    factor_cache: dictionary of the Cholesky factors of Q on the sets of free
+    variables already seen, shared by the solves of problems with the same Q
+    (e.g. the points of an efficient frontier)
+    """
+    num_variables = len(c)
+    E = E.reshape(num_variables, -1)
+    e = np.atleast_1d(e)
+    max_iterations = max_iterations or 10 * num_variables + 10
+    x = np.where(x0 > TOLERANCE, x0, 0.0)
+    free = x > 0
+    for _ in range(max_iterations):
+        indices = np.flatnonzero(free)
+        key = indices.tobytes()
+        factor = factor_cache.get(key) if factor_cache is not None else None
+        if factor is None:
+            factor = cho_factor(Q[np.ix_(indices, indices)])
+            if factor_cache is not None:
+                factor_cache[key] = factor
+        x_free, multipliers = _equality_qp(factor, c[indices], E[indices], e)
+        step = x_free - x[indices]
+        if np.abs(step).max() > TOLERANCE * (1 + np.abs(x[indices]).max()):
+            decreasing = step < 0
+            ratios = np.full(len(indices), np.inf)
+            ratios[decreasing] = -x[indices][decreasing] / step[decreasing]
+            blocking = np.argmin(ratios)
+            if ratios[blocking] < 1:
+                x[indices] += ratios[blocking] * step
+                x[indices[blocking]] = 0.0
+                free[indices[blocking]] = False
+            else:
+                x[indices] = x_free
+            continue
+
+        gradient = Q @ x - c
+        bound_multipliers = gradient - E @ multipliers
+        bound_multipliers[free] = np.inf
+        entering = np.argmin(bound_multipliers)
+        if bound_multipliers[entering] >= -TOLERANCE * (1 + np.abs(gradient).max()):
+            return x
+        free[entering] = True
+    raise RuntimeError(f"The active set method did not converge in {max_iterations} iterations")
+
+
+def min_variance_weights(covariance, initial_weights=None, factor_cache=None):
+    """
+    Long-only weights summing to 1 of the min variance portfolio
+    """
+    num_assets = len(covariance)
+    if initial_weights is None:
+        initial_weights = np.full(num_assets, 1 / num_assets)
+    return active_set_qp(
+        covariance, np.zeros(num_assets), np.ones(num_assets), 1.0, initial_weights, factor_cache=factor_cache
+    )
+
+
+def max_sharpe_weights(expected_returns, covariance, initial_weights=None, risk_free_rate=RISK_FREE_RATE):
+    """
+    Long-only weights summing to 1 of the max sharpe portfolio, as
+    EfficientFrontier(expected_returns, covariance).max_sharpe(): the weights
+    y / sum(y) of the y >= 0 of min y^T S y subject to (mu - rf)^T y = 1,
+    solved from initial_weights (e.g. the previous rebalance's weights).
+
+    When no asset returns more than the risk free rate there is no such y
+    (max_sharpe raises), the min variance weights are returned instead.
+    """
+    num_assets = len(expected_returns)
+    excess_returns = expected_returns - risk_free_rate
+    if excess_returns.max() <= 0:
+        return min_variance_weights(covariance, initial_weights)
+
+    if initial_weights is not None and initial_weights @ excess_returns > 0:
+        y0 = initial_weights / (initial_weights @ excess_returns)
+    else:
+        best = np.argmax(excess_returns)
+        y0 = np.zeros(num_assets)
+        y0[best] = 1 / excess_returns[best]
+    y = active_set_qp(covariance, np.zeros(num_assets), excess_returns, 1.0, y0)
+    return y / y.sum()
+
+
+def portfolio_performance(weights, expected_returns, covariance, risk_free_rate=RISK_FREE_RATE):
+    """
+    weights: (K, N) weights of K portfolios
+
+    Returns their (K,) expected returns, volatilities and sharpe ratios,
+    as EfficientFrontier.portfolio_performance
+    """
+    weights = np.atleast_2d(weights)
+    returns = weights @ expected_returns
+    volatilities = np.sqrt(np.einsum("kn,nm,km->k", weights, covariance, weights))
+    return returns, volatilities, (returns - risk_free_rate) / volatilities
+
+
+def efficient_frontier(expected_returns, covariance, target_returns=None, risk_aversions=None):
+    """
+    Long-only weights of the efficient portfolios of a grid, either of
+    target_returns, as EfficientFrontier.efficient_return (the min variance
+    portfolio returning at least the target), or of risk_aversions, as
+    EfficientFrontier.max_quadratic_utility (max mu^T w - d/2 w^T S w).
+
+    Returns the (G, N) weights, one row per grid point (NaN for target
+    returns above the highest expected return). Every point starts from the
+    weights of the one before and all points share the Cholesky factors
+    of the covariance on the supports they go through.
+    """
+    if (target_returns is None) == (risk_aversions is None):
+        raise ValueError("Pass either target_returns or risk_aversions")
+    num_assets = len(expected_returns)
+    ones = np.ones(num_assets)
+    factor_cache = dict()
+
+    if risk_aversions is not None:
+        weights = np.empty((len(risk_aversions), num_assets))
+        previous = np.full(num_assets, 1 / num_assets)
+        for i, risk_aversion in enumerate(risk_aversions):
+            previous = active_set_qp(
+                covariance, expected_returns / risk_aversion, ones, 1.0, previous, factor_cache=factor_cache
+            )
+            weights[i] = previous
+        return weights
+
+    target_returns = np.asarray(target_returns, dtype=np.float64)
+    weights = np.full((len(target_returns), num_assets), np.nan)
+    min_variance = min_variance_weights(covariance, factor_cache=factor_cache)
+    previous, previous_return = min_variance, min_variance @ expected_returns
+    best = np.argmax(expected_returns)
+    constraints = np.column_stack([ones, expected_returns])
+    # increasing targets, each one starting from the previous one's weights
+    # moved towards the asset with the highest expected return until the
+    # target is met
+    for i in np.argsort(target_returns, kind="stable"):
+        target = target_returns[i]
+        if target <= previous_return:
+            weights[i] = previous if target == previous_return else min_variance
+            continue
+        if target > expected_returns[best]:
+            continue
+        blend = (target - previous_return) / (expected_returns[best] - previous_return)
+        x0 = (1 - blend) * previous
+        x0[best] += blend
+        previous = active_set_qp(
+            covariance, np.zeros(num_assets), constraints, np.array([1.0, target]), x0, factor_cache=factor_cache
+        )
+        previous_return = target
+        weights[i] = previous
+    return weights
+
+
+def greedy_share_allocations(weights, prices, capital_levels, max_retries=10):
+    """
+    weights: (N,) long-only weights
+    prices: (N,) share prices
+    capital_levels: (C,) portfolio values
+
+    Returns the (C, N) whole shares of the weights bought with each capital
+    level and the (C,) cash left, as DiscreteAllocation(...).greedy_portfolio()
+    for every level at once: first the whole shares below each weight, then
+    one share at a time of the asset furthest below its weight, among the
+    max_retries furthest that the cash left can buy, in every level together.
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    prices = np.asarray(prices, dtype=np.float64)
+    capital_levels = np.asarray(capital_levels, dtype=np.float64)
+    # assets by decreasing weight, as greedy_portfolio goes through them
+    order = np.argsort(-weights, kind="stable")
+    weights, prices = weights[order], prices[order]
+
+    shares = np.floor(np.outer(capital_levels, weights) / prices)
+    funds = capital_levels.copy()
+    for n in range(len(prices)):
+        funds -= shares[:, n] * prices[n]
+
+    levels = np.flatnonzero(funds > 0)
+    while len(levels):
+        values = shares[levels] * prices
+        totals = values.sum(axis=1, keepdims=True)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            current_weights = np.where(totals > 0, values / totals, 0.0)
+        deficits = weights - current_weights
+        candidates = np.argsort(-deficits, axis=1, kind="stable")[:, :max_retries]
+        affordable = prices[candidates] <= funds[levels, None]
+        chosen = candidates[np.arange(len(levels)), affordable.argmax(axis=1)]
+        buying = affordable.any(axis=1) & (deficits[np.arange(len(levels)), chosen] > 0)
+        levels, chosen = levels[buying], chosen[buying]
+        shares[levels, chosen] += 1
+        funds[levels] -= prices[chosen]
+        levels = levels[funds[levels] > 0]
+
+    unsorted = np.empty_like(shares)
+    unsorted[:, order] = shares
+    return unsorted, funds
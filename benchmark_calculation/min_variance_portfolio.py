@@ -1,5 +1,6 @@
 from datetime import datetime
 from datetime import timedelta
+import numpy as np
 import pandas as pd
 from pypfopt.discrete_allocation import DiscreteAllocation, get_latest_prices
 from pypfopt.efficient_frontier import EfficientFrontier
@@ -7,6 +8,7 @@ from pypfopt.expected_returns import mean_historical_return
 from pypfopt.risk_models import CovarianceShrinkage
 from buy_and_hold import get_ticker_to_closing_prices
 from common import *
+from mean_variance import RISK_FREE_RATE, efficient_frontier, greedy_share_allocations, max_sharpe_weights, portfolio_performance
 
 START_DATE = datetime(2006, 1, 5)
 INITIAL_PORTFOLIO_VAL = 100000
@@ -32,7 +34,7 @@ def construct_price_df():
     S = CovarianceShrinkage(df).ledoit_wolf()
 
     ef = EfficientFrontier(mu, S)
-    weights = ef.max_sharpe()
+    weights = ef.max_sharpe(risk_free_rate=RISK_FREE_RATE)
     cleaned_weights = ef.clean_weights()
     ef.portfolio_performance(verbose=True)
     # Expected annual return: 31.9%, Sharpe Ratio: 3.15
@@ -55,7 +57,7 @@ def get_mean_variance_share_allocation():
     S = CovarianceShrinkage(df).ledoit_wolf()
 
     ef = EfficientFrontier(mu, S)
-    weights = ef.max_sharpe()
+    weights = ef.max_sharpe(risk_free_rate=RISK_FREE_RATE)
 
     _, ticker_to_closing_prices_at_test_start = get_ticker_to_closing_prices(
         TEST_START_DATE, TEST_END_DATE
@@ -75,16 +77,65 @@ def get_mean_variance_share_allocation():
     return allocation
 
 
-def main():
-    date_to_daily_risk_free_rate = get_date_to_daily_risk_free_rates(
+def get_mean_variance_inputs():
+    """
+    Returns the tickers, the expected returns and the Ledoit-Wolf covariance
+    of the training period (as get_mean_variance_share_allocation) and the
+    closing prices of the first test day, as arrays
+    """
+    dates, ticker_to_closing_prices = get_ticker_to_closing_prices(
+        START_DATE, TEST_START_DATE - timedelta(days=1)
+    )
+    tickers = list(ticker_to_closing_prices)
+    df = pd.DataFrame(
+        {ticker: ticker_to_closing_prices[ticker] for ticker in tickers},
+        index=dates,
+    )
+    mu = mean_historical_return(df).to_numpy()
+    S = CovarianceShrinkage(df).ledoit_wolf().to_numpy()
+
+    _, ticker_to_closing_prices_at_test_start = get_ticker_to_closing_prices(
         TEST_START_DATE, TEST_END_DATE
     )
+    prices_at_test_start = np.array(
+        [float(ticker_to_closing_prices_at_test_start[ticker][0]) for ticker in tickers]
+    )
+    return tickers, mu, S, prices_at_test_start
+
+
+def get_mean_variance_frontier(target_returns=None, risk_aversions=None):
+    """
+    Efficient portfolios of the training period over a grid of target returns
+    or risk aversions (see mean_variance.efficient_frontier).
+
+    Returns the tickers, the (G, N) weights and the (G,) expected returns,
+    volatilities and sharpe ratios of the grid points.
+    """
+    tickers, mu, S, _ = get_mean_variance_inputs()
+    weights = efficient_frontier(mu, S, target_returns, risk_aversions)
+    return (tickers, weights) + portfolio_performance(weights, mu, S)
+
+
+def get_mean_variance_share_allocations(capital_levels):
+    """
+    Share allocations of the max sharpe portfolio for every capital level,
+    bought at the first test day's prices with the greedy method of
+    DiscreteAllocation (get_mean_variance_share_allocation uses its linear
+    program for one level).
+
+    Returns the tickers, the (C, N) shares and the (C,) cash left.
+    """
+    tickers, mu, S, prices_at_test_start = get_mean_variance_inputs()
+    weights = max_sharpe_weights(mu, S)
+    shares, leftover = greedy_share_allocations(weights, prices_at_test_start, capital_levels)
+    return tickers, shares, leftover
+
+
+def main():
     dates, ticker_to_closing_prices = get_ticker_to_closing_prices(
         TEST_START_DATE, TEST_END_DATE
     )
-    daily_risk_free_rates = fill_missing_daily_rf_rates(
-        date_to_daily_risk_free_rate, dates
-    )
+    daily_risk_free_rates = get_daily_risk_free_rates(dates)
 
     mv_allocations = get_mean_variance_share_allocation()
     # Compute metrics
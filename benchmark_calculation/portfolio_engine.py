@@ -0,0 +1,102 @@
+import numpy as np
+
+TRADING_DAYS_PER_YEAR = 252
+# Upper bound on the number of float64 elements materialized at once when
+# evaluating time-varying holdings (~256MB)
+MAX_CHUNK_ELEMENTS = 2 ** 25
+
+
+def _chunk_size(num_allocations, elements_per_allocation):
+    return max(1, min(num_allocations, MAX_CHUNK_ELEMENTS // max(1, elements_per_allocation)))
+
+
+def holdings_daily_returns(prices, holdings):
+    """
+    Daily return rates of K portfolios given as share counts.
+
+    prices: (T, N) closing prices of N tickers over T trading days
+    holdings: (K, N) share counts held for the whole period, or
+              (K, T, N) share counts held at the close of each day
+
+    The return on day t is the profit of the shares held at the close of
+    day t - 1 divided by their value on day t - 1, so the result is (K, T - 1).
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    holdings = np.asarray(holdings, dtype=np.float64)
+    price_changes = np.diff(prices, axis=0)
+
+    if holdings.ndim == 2:
+        daily_profit = holdings @ price_changes.T
+        balance_yesterday = holdings @ prices[:-1].T
+        return daily_profit / balance_yesterday
+
+    num_allocations = holdings.shape[0]
+    daily_returns = np.empty((num_allocations, prices.shape[0] - 1))
+    step = _chunk_size(num_allocations, prices.size)
+    for k in range(0, num_allocations, step):
+        held = holdings[k:k + step, :-1]
+        daily_profit = np.einsum("tn,ktn->kt", price_changes, held)
+        balance_yesterday = np.einsum("tn,ktn->kt", prices[:-1], held)
+        daily_returns[k:k + step] = daily_profit / balance_yesterday
+    return daily_returns
+
+
+def weights_daily_returns(prices, weights):
+    """
+    Daily return rates of K portfolios given as capital weights.
+
+    prices: (T, N) closing prices of N tickers over T trading days
+    weights: (K, N) weights rebalanced to at every close, or
+             (K, T - 1, N) weights held from the close of day t - 1 to day t
+
+    Returns a (K, T - 1) array.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    ticker_returns = prices[1:] / prices[:-1] - 1
+
+    if weights.ndim == 2:
+        return weights @ ticker_returns.T
+
+    num_allocations = weights.shape[0]
+    daily_returns = np.empty((num_allocations, ticker_returns.shape[0]))
+    step = _chunk_size(num_allocations, ticker_returns.size)
+    for k in range(0, num_allocations, step):
+        daily_returns[k:k + step] = np.einsum("tn,ktn->kt", ticker_returns, weights[k:k + step])
+    return daily_returns
+
+
+def summarize_daily_returns(daily_returns, daily_rf_rates, trading_days_per_year=TRADING_DAYS_PER_YEAR):
+    """
+    Annualized expected return and risk free adjusted sharpe ratio of each row
+    of a (K, T - 1) array of daily return rates.
+
+    daily_rf_rates holds one rate per trading day (length T), the first day
+    is dropped to line up with the daily returns.
+    """
+    daily_returns = np.atleast_2d(daily_returns)
+    daily_rf_rates = np.asarray(daily_rf_rates, dtype=np.float64)[1:]
+
+    annualized_expected_return = (1 + daily_returns.mean(axis=1)) ** trading_days_per_year - 1
+    # See https://quant.stackexchange.com/questions/28385/what-value-should-the-risk-free-monthly-return-rate-be-sharpe-ratio-calculation
+    # for scaling sharpe ratio
+    sharpe_ratio = (
+        np.sqrt(trading_days_per_year) *
+        (daily_returns - daily_rf_rates).mean(axis=1) / daily_returns.std(axis=1)
+    )
+    return annualized_expected_return, sharpe_ratio
+
+
+def evaluate_allocations(prices, holdings, daily_rf_rates, trading_days_per_year=TRADING_DAYS_PER_YEAR):
+    """
+    Score a batch of K share allocations (static or time-varying, see
+    holdings_daily_returns) in one pass.
+
+    Returns the (K, T - 1) daily return rates and the (K,) annualized
+    expected returns and sharpe ratios.
+    """
+    daily_returns = holdings_daily_returns(prices, holdings)
+    annualized_expected_return, sharpe_ratio = summarize_daily_returns(
+        daily_returns, daily_rf_rates, trading_days_per_year
+    )
+    return daily_returns, annualized_expected_return, sharpe_ratio
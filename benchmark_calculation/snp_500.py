@@ -3,8 +3,8 @@ from datetime import datetime
 from datetime import timedelta
 import numpy as np
 import pandas as pd
-import yfinance as yf
 from common import *
+from market_data_cache import cached_price_source
 
 
 SNP_500_TICKER = "^GSPC"
@@ -12,7 +12,7 @@ SNP_500_TICKER = "^GSPC"
 
 def get_date_to_snp_500_prices():
     date_to_price = {}
-    data = yf.download(
+    data = cached_price_source(MARKET_DATA_CACHE_REL_PATH).fetch(
         SNP_500_TICKER,
         start=TEST_START_DATE,
         end=TEST_END_DATE + timedelta(days=1),
@@ -36,14 +36,9 @@ def get_snp_500_metrics(snp_500_closing_prices, daily_rf_rates):
 
 
 def main():
-    date_to_daily_risk_free_rate = get_date_to_daily_risk_free_rates(
-        TEST_START_DATE, TEST_END_DATE
-    )
     date_to_snp_500_prices = get_date_to_snp_500_prices()
     dates = list(date_to_snp_500_prices.keys())
-    daily_risk_free_rates = fill_missing_daily_rf_rates(
-        date_to_daily_risk_free_rate, dates
-    )
+    daily_risk_free_rates = get_daily_risk_free_rates(dates)
 
     snp_500_prices = list(date_to_snp_500_prices.values())
     snp_annualized_return, snp_sharpe = get_snp_500_metrics(snp_500_prices, daily_risk_free_rates)
@@ -0,0 +1,35 @@
+import tracemalloc
+
+import numpy as np
+
+from bootstrap import bootstrap_sharpe_ratios, sharpe_difference_tests
+
+NUM_RESAMPLES = 1000
+
+
+def test_pairwise_tests_of_hundreds_of_strategies_fit_in_memory():
+    rng = np.random.default_rng(0)
+    daily_returns = rng.normal(0.0005, 0.01, size=(300, 440))
+    daily_rf_rates = np.full(441, 1e-4)
+
+    tracemalloc.start()
+    tests = sharpe_difference_tests(daily_returns, daily_rf_rates, num_resamples=NUM_RESAMPLES)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    num_pairs = 300 * 299 // 2
+    assert len(tests) == num_pairs
+    # the resampled differences of all pairs would take 359 MB
+    assert peak < 100 * 2**20
+
+    # the rows match the differences of the bootstrap resamples, pair by pair
+    sharpe_ratios, resampled = bootstrap_sharpe_ratios(daily_returns, daily_rf_rates, NUM_RESAMPLES)
+    for row in [0, 298, 12345, num_pairs - 1]:
+        a, b = tests.strategy[row], tests.versus[row]
+        resampled_difference = resampled[a] - resampled[b]
+        difference = sharpe_ratios[a] - sharpe_ratios[b]
+        np.testing.assert_allclose(
+            [tests.ci_low[row], tests.ci_high[row]], np.nanquantile(resampled_difference, [0.025, 0.975])
+        )
+        extreme = np.abs(resampled_difference - difference) >= abs(difference)
+        assert tests.p_value[row] == (1 + extreme.sum()) / (1 + NUM_RESAMPLES)
@@ -0,0 +1,200 @@
+import time
+import numpy as np
+import pandas as pd
+from pypfopt.discrete_allocation import DiscreteAllocation
+from common import *
+from mean_variance import RISK_FREE_RATE, max_sharpe_weights
+from min_variance_portfolio import INITIAL_PORTFOLIO_VAL, START_DATE
+from portfolio_engine import holdings_daily_returns, summarize_daily_returns
+
+# Trading days between rebalances (weekly)
+REBALANCE_DAYS = 5
+
+
+class RollingMoments:
+    """
+    Sums of the daily returns of N tickers over a window of days, from which
+    the Ledoit-Wolf covariance and the mean historical returns of the window
+    are computed without going back to the returns:
+
+        s1: sum of the returns (N,)
+        s2: sum of the cross-products of the returns (N, N)
+        log_growth: sum of log(1 + returns) (N,)
+        square_norms: sum of ||r||^2 ||r||^2 over the days
+        weighted_sums: sum of ||r||^2 r over the days (N,)
+
+    Days enter and leave the window with add and remove. Missing returns count
+    as 0, like CovarianceShrinkage.
+    """
+
+    def __init__(self, num_tickers):
+        self.num_days = 0
+        self.s1 = np.zeros(num_tickers)
+        self.s2 = np.zeros((num_tickers, num_tickers))
+        self.log_growth = np.zeros(num_tickers)
+        self.square_norms = 0.0
+        self.weighted_sums = np.zeros(num_tickers)
+
+    @classmethod
+    def from_returns(cls, returns):
+        moments = cls(returns.shape[1])
+        moments.add(returns)
+        return moments
+
+    def _update(self, returns, sign):
+        returns = np.nan_to_num(np.atleast_2d(returns))
+        norms = np.einsum("tn,tn->t", returns, returns)
+        self.num_days += sign * len(returns)
+        self.s1 += sign * returns.sum(axis=0)
+        self.s2 += sign * (returns.T @ returns)
+        self.log_growth += sign * np.log1p(returns).sum(axis=0)
+        self.square_norms += sign * norms @ norms
+        self.weighted_sums += sign * (norms @ returns)
+
+    def add(self, returns):
+        """
+        returns: (days, N) returns of the days entering the window
+        """
+        self._update(returns, 1)
+
+    def remove(self, returns):
+        """
+        returns: (days, N) returns of the days leaving the window
+        """
+        self._update(returns, -1)
+
+    def expected_returns(self, trading_days_per_year=TRADING_DAYS_PER_YEAR):
+        """
+        Annualized compounded mean returns, as mean_historical_return
+        """
+        return np.exp(self.log_growth * trading_days_per_year / self.num_days) - 1
+
+    def ledoit_wolf(self, trading_days_per_year=TRADING_DAYS_PER_YEAR):
+        """
+        Returns the annualized covariance shrunk towards a constant variance
+        and the shrinkage, as CovarianceShrinkage(...).ledoit_wolf()
+        (sklearn.covariance.ledoit_wolf of the returns).
+
+        sklearn sums over the demeaned returns x = r - m. Its two sums are
+        expanded in the raw sums: sum(x x^T) = s2 - n m m^T, and
+        sum(||x||^4) = square_norms - 4 m.weighted_sums + 4 m^T s2 m
+                       + 2 ||m||^2 trace(s2) - 3 n ||m||^4
+        """
+        n, num_tickers = self.num_days, len(self.s1)
+        mean = self.s1 / n
+        mean_norm = mean @ mean
+        cross = self.s2 - n * np.outer(mean, mean)
+        trace = np.trace(cross)
+        fourth_powers = (
+            self.square_norms - 4 * mean @ self.weighted_sums + 4 * mean @ self.s2 @ mean
+            + 2 * mean_norm * np.trace(self.s2) - 3 * n * mean_norm ** 2
+        )
+
+        mu = trace / n / num_tickers
+        delta_ = np.sum(cross ** 2) / n ** 2
+        beta = (fourth_powers / n - delta_) / (num_tickers * n)
+        delta = (delta_ - 2 * mu * trace / n + num_tickers * mu ** 2) / num_tickers
+        beta = min(beta, delta)
+        shrinkage = 0 if beta == 0 else beta / delta
+
+        covariance = (1 - shrinkage) * cross / n
+        covariance[np.diag_indices(num_tickers)] += shrinkage * mu
+        return covariance * trading_days_per_year, shrinkage
+
+
+def share_allocation(weights, prices, portfolio_value):
+    """
+    Returns the whole number of shares of each ticker bought for weights with
+    portfolio_value by the linear program of DiscreteAllocation (as
+    get_mean_variance_share_allocation), and the cash left
+    """
+    da = DiscreteAllocation(
+        dict(enumerate(weights)), pd.Series(prices), total_portfolio_value=portfolio_value
+    )
+    allocation, leftover = da.lp_portfolio()
+    shares = np.zeros(len(weights))
+    shares[list(allocation)] = list(allocation.values())
+    return shares, leftover
+
+
+def walk_forward_holdings(
+    prices,
+    first_day,
+    rebalance_days=REBALANCE_DAYS,
+    lookback_days=None,
+    initial_value=INITIAL_PORTFOLIO_VAL,
+    risk_free_rate=RISK_FREE_RATE,
+):
+    """
+    prices: (T, N) closing prices, the days before first_day are history only
+
+    Rebalances to the max sharpe portfolio of the returns of the last
+    lookback_days days (default: every day since the first one) at the close
+    of first_day and every rebalance_days days after it (default: only once),
+    buying whole shares with the value of the portfolio (shares and cash left).
+    The optimizer starts from the previous rebalance's weights.
+    The window's moments are updated with the days that entered and left
+    it since the last rebalance, and recomputed once every day of the window
+    has been replaced so rounding errors don't build up.
+
+    Returns the (T - first_day, N) shares held at each close from first_day
+    and the (rebalances, N) weights.
+    """
+    prices = np.asarray(prices, dtype=np.float64)
+    returns = prices[1:] / prices[:-1] - 1
+    num_days, num_tickers = prices.shape
+    rebalance_days = rebalance_days or num_days
+
+    moments = RollingMoments(num_tickers)
+    start, end = 0, 0
+    removed = 0
+    holdings = np.empty((num_days - first_day, num_tickers))
+    shares, cash = np.zeros(num_tickers), initial_value
+    all_weights = []
+    weights = None
+    for day in range(first_day, num_days):
+        if (day - first_day) % rebalance_days == 0:
+            # returns up to the close before the rebalance day, returns[j] is day j + 1's
+            new_end = day - 1
+            new_start = 0 if lookback_days is None else max(0, new_end - lookback_days)
+            moments.add(returns[end:new_end])
+            if removed + new_start - start >= max(1, new_end - new_start):
+                moments = RollingMoments.from_returns(returns[new_start:new_end])
+                removed = 0
+            else:
+                moments.remove(returns[start:new_start])
+                removed += new_start - start
+            start, end = new_start, new_end
+
+            covariance, _ = moments.ledoit_wolf()
+            weights = max_sharpe_weights(moments.expected_returns(), covariance, weights, risk_free_rate)
+            all_weights.append(weights)
+            shares, cash = share_allocation(weights, prices[day], shares @ prices[day] + cash)
+        holdings[day - first_day] = shares
+    return holdings, np.array(all_weights)
+
+
+def main():
+    store = load_price_store(CSVS_REL_PATH, PRICE_STORE_REL_PATH)
+    dates, prices = store.get(START_DATE, TEST_END_DATE, "Close")
+    first_day = next(i for i, date in enumerate(dates) if date >= TEST_START_DATE)
+    test_prices = prices[first_day:]
+    daily_risk_free_rates = get_daily_risk_free_rates(dates[first_day:])
+
+    for name, rebalance_days, lookback_days in [
+        ("Mean variance, held", None, None),
+        ("Mean variance, weekly", REBALANCE_DAYS, None),
+        ("Mean variance, weekly on the last year", REBALANCE_DAYS, TRADING_DAYS_PER_YEAR),
+    ]:
+        ctime = time.time()
+        holdings, weights = walk_forward_holdings(prices, first_day, rebalance_days, lookback_days)
+        daily_returns = holdings_daily_returns(test_prices, holdings[None])
+        annualized_return, sharpe = summarize_daily_returns(daily_returns, daily_risk_free_rates)
+        print(
+            f"{name} - Annualized Expected return: {annualized_return[0]:.2f}, Sharpe Ratio: {sharpe[0]:.2f} "
+            f"({len(weights)} rebalances in {time.time() - ctime:.2f}s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
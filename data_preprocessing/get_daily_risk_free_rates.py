@@ -1,15 +1,22 @@
 import csv
-import math
-from datetime import datetime
+import numpy as np
+import pandas as pd
+from rate_curve import RATE_TABLE, RISK_FREE_RATES_CSV, CSV_DATE_FMT, write_rate_table
 
 READ_DATE_FMT = "%m/%d/%Y"
-WRITE_DATE_FMT = "%Y-%m-%d %H:%M:%S"
+WRITE_DATE_FMT = CSV_DATE_FMT
+YIELD_RATES_CSV = "csvs/US_treasury_daily_yield_rates.csv"
+# We will use the one month cmt rate as a benchmark for short term risk free rate
+# This is commonly done in adjustable-rate morgages.
+# (https://www.investopedia.com/terms/c/cmtindex.asp)
+RISK_FREE_TENOR = "1 Mo"
 
 
 def cmt_rate_to_apy(cmt_rate):
     """
     Convert the CMT (semiannual bond equivalent) yield published on
     the US Treasury website to annual percentage yield.
+    Works on scalars and arrays alike.
 
     See "ARE THE CMT YIELDS ANNUAL YIELDS?" section in
     https://home.treasury.gov/policy-issues/financing-the-government/interest-rate-statistics/interest-rates-frequently-asked-questions
@@ -17,39 +24,73 @@ def cmt_rate_to_apy(cmt_rate):
     return (1 + cmt_rate / 2) ** 2 - 1.0
 
 
-def main():
-    # US Treasury daily yield curve rates obtained from
-    # https://www.treasury.gov/resource-center/data-chart-center/interest-rates/pages/textview.aspx?data=yield
+def read_yield_rates(yield_rates_csv=YIELD_RATES_CSV):
+    """
+    Returns the publication dates, the tenors and the (dates, tenors) CMT
+    rates in percent, NaN where a rate was not published
+    """
+    df = pd.read_csv(yield_rates_csv, na_values="N/A", encoding="utf-8-sig")
+    dates = pd.to_datetime(df.pop(df.columns[0]), format=READ_DATE_FMT).values.astype("datetime64[D]")
+    return dates, list(df.columns), df.to_numpy(dtype=np.float64)
 
-    # We will use the one month cmt rate as a benchmark for short term risk free rate
-    # This is commonly done in adjustable-rate morgages.
-    # (https://www.investopedia.com/terms/c/cmtindex.asp)
-    with open("csvs/US_treasury_daily_yield_rates.csv", "r") as rf, \
-            open("csvs/US_treasury_daily_risk_free_rates.csv", "w") as wf:
-        reader = csv.reader(rf)
-        writer = csv.writer(wf)
 
-        # Deal with headers
-        next(reader)
-        writer.writerow(["Date", "Daily_RF_Rate"])
+def fill_unpublished_rates(cmt_rates):
+    """
+    Returns the (dates, tenors) rates with every rate that was not published
+    for the day replaced by the tenor's rate of the previous day.
+    Tenors not published yet stay NaN.
+    """
+    published = ~np.isnan(cmt_rates)
+    last_published = np.maximum.accumulate(
+        np.where(published, np.arange(len(cmt_rates))[:, None], 0), axis=0
+    )
+    return cmt_rates[last_published, np.arange(cmt_rates.shape[1])]
 
-        for row in reader:
-            date_str = row[0]
-            if row[1] != "N/A":
-                # if 1 month cmt rate not published for the day,
-                # just assume the same rate as previous day
-                one_mo_cmt_rate = float(row[1])
-                one_mo_cmt_rate /= 100
 
-            # reformat date
-            date_str = datetime.strptime(date_str, READ_DATE_FMT).strftime(WRITE_DATE_FMT)
+def cmt_rate_to_daily_rate(cmt_rate):
+    """
+    Convert one CMT rate in percent to a daily rate with Python floats,
+    the arithmetic the risk free rates CSV has always been written with
+    """
+    apy = cmt_rate_to_apy(cmt_rate / 100)
+    daily_rate = (1 + apy) ** (1 / 365)  # assume 365 days in year
+    return daily_rate - 1
 
-            # convert 1 month cmt rate to daily rate
-            apy = cmt_rate_to_apy(one_mo_cmt_rate)
-            daily_rate = (1 + apy) ** (1 / 365)  # assume 365 days in year
-            daily_rate -= 1
 
-            writer.writerow([date_str, daily_rate])
+def cmt_rates_to_daily_rates(cmt_rates):
+    """
+    Convert (dates, tenors) CMT rates in percent to daily rates,
+    all tenors in one pass.
+
+    If a tenor's rate was not published for the day,
+    just assume the same rate as previous day.
+    Tenors not published yet stay NaN.
+    """
+    cmt_rates = fill_unpublished_rates(cmt_rates) / 100
+    apy = cmt_rate_to_apy(cmt_rates)
+    daily_rates = (1 + apy) ** (1 / 365)  # assume 365 days in year
+    return daily_rates - 1
+
+
+def main():
+    # US Treasury daily yield curve rates obtained from
+    # https://www.treasury.gov/resource-center/data-chart-center/interest-rates/pages/textview.aspx?data=yield
+    dates, tenors, cmt_rates = read_yield_rates(YIELD_RATES_CSV)
+    cmt_rates = fill_unpublished_rates(cmt_rates)
+    daily_rates = cmt_rates_to_daily_rates(cmt_rates)
+
+    # every tenor, for experiments with other risk free rates (see rate_curve.RateTable)
+    write_rate_table(RATE_TABLE, dates, tenors, daily_rates)
+
+    # numpy's vectorized pow rounds the last bit of a few rates differently,
+    # so the CSV keeps the scalar conversion and doesn't change when regenerated
+    with open(RISK_FREE_RATES_CSV, "w") as wf:
+        writer = csv.writer(wf)
+        writer.writerow(["Date", "Daily_RF_Rate"])
+        writer.writerows(zip(
+            pd.DatetimeIndex(dates).strftime(WRITE_DATE_FMT),
+            map(cmt_rate_to_daily_rate, cmt_rates[:, tenors.index(RISK_FREE_TENOR)].tolist()),
+        ))
 
 
 if __name__ == "__main__":
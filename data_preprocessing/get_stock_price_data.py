@@ -1,8 +1,15 @@
+import argparse
 import csv
+import json
+import os
+from collections import deque
 from datetime import datetime
 from datetime import timedelta
+import numpy as np
 import pandas as pd
-import yfinance as yf
+from indicators import moving_mean, shift
+from market_data_cache import cached_price_source
+from price_sources import PRICE_COLUMNS, LocalCsvPriceSource
 
 SELECTED_STOCK_TICKERS = [
     "BEN",  # Franklin Resources
@@ -19,7 +26,13 @@ SELECTED_STOCK_TICKERS = [
 START_TIME = datetime(2006, 1, 1)
 END_TIME = datetime(2017, 12, 31)
 DATE_FMT = "%Y-%m-%d"  # Date format for yfinance
+CSV_DATE_FMT = "%Y-%m-%d %H:%M:%S"
+CSV_DIR = "csvs"
 CSV_HEADER = ["Date", "Open", "Close", "High", "Low", "Volume", "MA7", "MA30"]
+# NOTE: rows are written in PRICE_COLUMNS order (Open, High, Low, Close, Volume),
+#       which CSV_HEADER does not follow, so the closing price is read by position
+CSV_CLOSE_INDEX = 1 + PRICE_COLUMNS.index("Close")
+MA_WINDOWS = (7, 30)
 
 
 def trading_days_to_regular_days(days):
@@ -27,43 +40,200 @@ def trading_days_to_regular_days(days):
     return days / 5 * 7
 
 
+class RollingMovingAverages:
+    """
+    MA7 and MA30 of the closing prices of the 30 trading days before each bar,
+    kept as running sums so each new bar costs O(1).
+    """
+
+    def __init__(self, closes=(), sums=None):
+        self.closes = deque(closes, maxlen=max(MA_WINDOWS))
+        if sums is None:
+            sums = [sum(list(self.closes)[-window:]) for window in MA_WINDOWS]
+        self.sums = list(sums)
+
+    def next(self, closing_price):
+        """
+        Returns the moving averages for the bar with the given closing price
+        (which only cover the previous bars), then adds the bar to the window.
+        """
+        moving_averages = [s / window for s, window in zip(self.sums, MA_WINDOWS)]
+        for i, window in enumerate(MA_WINDOWS):
+            if len(self.closes) >= window:
+                self.sums[i] -= self.closes[-window]
+            self.sums[i] += closing_price
+        self.closes.append(closing_price)
+        return moving_averages
+
+    def to_dict(self):
+        return {"closes": list(self.closes), "sums": self.sums}
+
+
+def csv_path(ticker, csv_dir=CSV_DIR):
+    return os.path.join(csv_dir, f"{ticker}_technical_data.csv")
+
+
+def state_path(ticker, csv_dir=CSV_DIR):
+    return os.path.join(csv_dir, f"{ticker}_ma_state.json")
+
+
+def save_state(ticker, last_date, moving_averages, csv_dir=CSV_DIR):
+    """
+    Writes the state through a temporary file, so a run that dies while
+    saving never leaves a truncated state behind
+    """
+    path = state_path(ticker, csv_dir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"last_date": last_date.strftime(CSV_DATE_FMT), **moving_averages.to_dict()}, f)
+    os.replace(tmp_path, path)
+
+
+def csv_last_date(ticker, csv_dir=CSV_DIR):
+    """
+    Returns the date of the last row of a ticker's CSV, reading only its end
+    """
+    with open(csv_path(ticker, csv_dir), "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 4096))
+        last_row = f.read().decode().splitlines()[-1]
+    return datetime.strptime(last_row.split(",")[0], CSV_DATE_FMT)
+
+
+def load_state(ticker, csv_dir=CSV_DIR):
+    """
+    Returns the last stored date and the moving average state of a ticker,
+    or (None, None) if the ticker has no CSV yet.
+
+    CSVs written before the state file existed are bootstrapped from their
+    last 30 rows, and so are CSVs whose last row is not the state's last date
+    (e.g. a run that died between appending bars and saving the state).
+    """
+    if not os.path.exists(csv_path(ticker, csv_dir)):
+        return None, None
+    if os.path.exists(state_path(ticker, csv_dir)):
+        with open(state_path(ticker, csv_dir), "r") as f:
+            state = json.load(f)
+        last_date = datetime.strptime(state["last_date"], CSV_DATE_FMT)
+        if last_date == csv_last_date(ticker, csv_dir):
+            return last_date, RollingMovingAverages(state["closes"], state["sums"])
+
+    tail = pd.read_csv(csv_path(ticker, csv_dir), float_precision="round_trip").tail(max(MA_WINDOWS))
+    last_date = datetime.strptime(tail.iloc[-1, 0], CSV_DATE_FMT)
+    return last_date, RollingMovingAverages(tail.iloc[:, CSV_CLOSE_INDEX].tolist())
+
+
+def write_bars(writer, data, moving_averages):
+    for ts, row in data.iterrows():
+        date = datetime(year=ts.year, month=ts.month, day=ts.day)
+        ma7, ma30 = moving_averages.next(row["Close"])
+        writer.writerow([date] + list(row[PRICE_COLUMNS]) + [ma7, ma30])
+
+
+def previous_bars_moving_averages(closes):
+    """
+    Returns the (bars, len(MA_WINDOWS)) moving averages of the closing prices
+    of the bars before each bar, for the whole history at once.
+
+    The sums are rounded like sum() over the previous closes,
+    as the CSVs were originally written.
+    """
+    previous_closes = shift(np.asarray(closes, dtype=np.float64).reshape(-1, 1))
+    return np.hstack([moving_mean(previous_closes, window, exact=True) for window in MA_WINDOWS])
+
+
+def download_ticker(ticker, source, end_time=END_TIME, csv_dir=CSV_DIR):
+    """
+    Download the full history of a ticker from START_TIME and rewrite its CSV.
+
+    Returns the number of bars written.
+    """
+    # Go back 30 more (trading) days to calculate moving average
+    data = source.fetch(
+        ticker,
+        start=(
+            START_TIME - timedelta(days=trading_days_to_regular_days(max(MA_WINDOWS)))
+        ).strftime(DATE_FMT),
+        end=end_time.strftime(DATE_FMT),
+        interval="1d",
+        auto_adjust=True,
+    )
+
+    # First 30 days are only used to fill the moving average window
+    moving_averages = previous_bars_moving_averages(data["Close"])[max(MA_WINDOWS):]
+    closes = data["Close"].tolist()
+    data = data.iloc[max(MA_WINDOWS):]
+    with open(csv_path(ticker, csv_dir), "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADER)
+        bars = data[PRICE_COLUMNS].to_numpy(dtype=np.float64).tolist()
+        for ts, bar, bar_moving_averages in zip(data.index, bars, moving_averages.tolist()):
+            writer.writerow([datetime(year=ts.year, month=ts.month, day=ts.day)] + bar + bar_moving_averages)
+
+    # incremental updates continue from the last 30 closes
+    moving_averages = RollingMovingAverages(closes[-max(MA_WINDOWS):])
+    last_ts = data.index[-1]
+    save_state(ticker, datetime(last_ts.year, last_ts.month, last_ts.day), moving_averages, csv_dir)
+    return len(data)
+
+
+def update_ticker(ticker, source, end_time, csv_dir=CSV_DIR):
+    """
+    Append the bars after the last stored date of a ticker up to end_time
+    (exclusive), downloading the full history if the ticker has no CSV yet.
+
+    Returns the number of bars appended (written, for a full download).
+    """
+    last_date, moving_averages = load_state(ticker, csv_dir)
+    if last_date is None:
+        return download_ticker(ticker, source, end_time, csv_dir)
+
+    data = source.fetch(
+        ticker,
+        start=(last_date + timedelta(days=1)).strftime(DATE_FMT),
+        end=end_time.strftime(DATE_FMT),
+        interval="1d",
+        auto_adjust=True,
+    )
+    data = data[data.index > pd.Timestamp(last_date)]
+    if data.empty:
+        return 0
+
+    with open(csv_path(ticker, csv_dir), "a", newline='') as f:
+        write_bars(csv.writer(f), data, moving_averages)
+
+    last_ts = data.index[-1]
+    save_state(ticker, datetime(last_ts.year, last_ts.month, last_ts.day), moving_averages, csv_dir)
+    return len(data)
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="append bars after the last stored date up to today instead of re-downloading the history"
+    )
+    parser.add_argument(
+        "--source-dir",
+        help="serve bars from <source-dir>/<ticker>.csv instead of Yahoo Finance"
+    )
+    parser.add_argument(
+        "--offline", action="store_true",
+        help="only serve Yahoo Finance bars from the local market data cache"
+    )
+    args = parser.parse_args()
+
+    if args.source_dir:
+        source = LocalCsvPriceSource(args.source_dir)
+    else:
+        source = cached_price_source(offline=args.offline or None)
     for ticker in SELECTED_STOCK_TICKERS:
-        # Create the CSV file
-        with open(f"csvs/{ticker}_technical_data.csv", "w", newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(CSV_HEADER)
-
-            # Go back 30 more (trading) days to calculate moving average
-            data = yf.download(
-                ticker,
-                start=(
-                    START_TIME - timedelta(days=trading_days_to_regular_days(30))
-                ).strftime(DATE_FMT),
-                end=END_TIME.strftime(DATE_FMT),
-                interval="1d",
-                auto_adjust=True,
-            )
-
-            # Maintain list of closing prices for MA calculation
-            last_30_days_closing_prices = [
-                closing_price for closing_price in data["Close"].head(30)
-            ]
-
-            # Remove first 30 days data
-            data = data.iloc[30:]
-            for ts, row in data.iterrows():
-                date = datetime(year=ts.year, month=ts.month, day=ts.day)
-
-                # Calculate moving averages and update closing price list
-                ma7 = sum(last_30_days_closing_prices[-7:]) / 7
-                ma30 = sum(last_30_days_closing_prices) / 30
-                last_30_days_closing_prices.pop(0)
-                last_30_days_closing_prices.append(row["Close"])
-
-                # Write data to CSV
-                csv_row = [date] + list(row) + [ma7, ma30]
-                writer.writerow(csv_row)
+        if args.incremental:
+            full_history = not os.path.exists(csv_path(ticker))
+            num_bars = update_ticker(ticker, source, datetime.today())
+            print(f"{ticker}: {f'downloaded full history of {num_bars} bars' if full_history else f'{num_bars} new bars'}")
+        else:
+            download_ticker(ticker, source)
 
 
 if __name__ == "__main__":
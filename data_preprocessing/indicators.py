@@ -0,0 +1,291 @@
+"""
+Technical indicators of every ticker at once.
+
+Prices are (dates, tickers) arrays, one column per ticker, with NaN where a
+ticker has no bar (e.g. before it was listed). Every indicator is computed for all tickers together with
+a few whole-array operations per window: moving sums and variances come from
+cumulative sums and exponential moving averages are a recursive filter along
+the dates (scipy.signal.lfilter).
+
+Indicator names follow stockstats, which FinRL's FeatureEngineer uses, so
+either can produce the tech_indicator_list columns:
+
+    macd, macds, macdh                      MACD (12, 26) line, 9 day signal, histogram
+    boll, boll_ub, boll_lb                  20 day Bollinger bands, 2 standard deviations
+    rsi_<n>                                 relative strength index
+    cci_<n>                                 commodity channel index
+    dx_<n>                                  directional movement index
+    <column>_<n>_sma                        simple moving average of a price column
+    <column>_<n>_ema                        exponential moving average (span n)
+    <column>_<n>_mstd                       moving standard deviation
+    volatility_<n>                          moving standard deviation of the daily close returns
+"""
+import re
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+PRICE_COLUMNS = ["open", "high", "low", "close", "volume"]
+BOLL_PERIOD = 20
+BOLL_STD_TIMES = 2
+MACD_EMA_SHORT = 12
+MACD_EMA_LONG = 26
+MACD_EMA_SIGNAL = 9
+CCI_CONSTANT = 0.015
+WINDOW_INDICATOR = re.compile(r"^(rsi|cci|dx|volatility)_(\d+)$")
+COLUMN_INDICATOR = re.compile(r"^(\w+)_(\d+)_(sma|ema|mstd)$")
+
+
+def shift(values, periods=1):
+    """
+    values shifted down by periods dates, NaN for the first ones
+    """
+    shifted = np.full(values.shape, np.nan)
+    if periods < len(values):
+        shifted[periods:] = values[:len(values) - periods]
+    return shifted
+
+
+def _window_sums(values, window):
+    """
+    Sums of the last window rows from the cumulative sums of values
+    """
+    cumulative = np.vstack([np.zeros((1,) + values.shape[1:], dtype=values.dtype), np.cumsum(values, axis=0)])
+    return cumulative[1:] - cumulative[np.maximum(np.arange(1, len(values) + 1) - window, 0)]
+
+
+def _centered(values, valid):
+    """
+    values minus the first valid value of each ticker, 0 where not valid,
+    which keeps differences of cumulative sums accurate at price levels
+    """
+    first = values[valid.argmax(axis=0), np.arange(values.shape[1])]
+    first = np.where(valid.any(axis=0), first, 0.0)
+    return np.where(valid, values - first, 0.0), first
+
+
+def moving_sum(values, window, min_periods=None, exact=False):
+    """
+    Sum of the last window values of every ticker (NaN values are skipped),
+    NaN until min_periods (default: window) values are available.
+    Returns (sums, counts).
+
+    The sums are differences of cumulative sums. With exact=True the window's
+    shifted arrays are added oldest first instead, so every sum is rounded
+    exactly like the built-in sum() over the same values (window additions
+    instead of one cumulative sum).
+    """
+    min_periods = window if min_periods is None else min_periods
+    valid = ~np.isnan(values)
+    counts = _window_sums(valid.astype(np.int64), window)
+    if exact:
+        padded = np.vstack([np.zeros((window - 1,) + values.shape[1:]), np.where(valid, values, 0.0)])
+        sums = padded[:len(values)].copy()
+        for lag in range(1, window):
+            sums += padded[lag:lag + len(values)]
+    else:
+        centered, first = _centered(values, valid)
+        sums = _window_sums(centered, window) + counts * first
+    sums[counts < min_periods] = np.nan
+    return sums, counts
+
+
+def moving_mean(values, window, min_periods=None, exact=False):
+    sums, counts = moving_sum(values, window, min_periods, exact)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def moving_var(values, window, min_periods=None, ddof=1):
+    """
+    Variance of the last window values of every ticker (NaN values are skipped)
+    from cumulative sums of the values and their squares.
+    """
+    min_periods = window if min_periods is None else min_periods
+    valid = ~np.isnan(values)
+    centered, _ = _centered(values, valid)
+    sums, squares = _window_sums(centered, window), _window_sums(centered ** 2, window)
+    counts = _window_sums(valid.astype(np.int64), window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = (squares - sums ** 2 / counts) / (counts - ddof)
+    var = np.maximum(var, 0.0)
+    var[counts < max(min_periods, ddof + 1)] = np.nan
+    return var
+
+
+def moving_std(values, window, min_periods=None, ddof=1):
+    return np.sqrt(moving_var(values, window, min_periods, ddof))
+
+
+def ewm_mean(values, alpha):
+    """
+    Exponentially weighted mean of every ticker with smoothing factor alpha,
+    as pandas' ewm(alpha=alpha, adjust=True, ignore_na=False).mean():
+    the weighted sum of the observed values divided by the sum of their weights,
+    both one recursive filter along the dates.
+    """
+    valid = ~np.isnan(values)
+    b, a = [1.0], [1.0, alpha - 1.0]
+    weighted_sums = lfilter(b, a, np.where(valid, values, 0.0), axis=0)
+    weights = lfilter(b, a, valid.astype(np.float64), axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = weighted_sums / weights
+    means[weights == 0] = np.nan
+    return means
+
+
+def ema(values, span):
+    return ewm_mean(values, 2.0 / (span + 1))
+
+
+def smma(values, window):
+    return ewm_mean(values, 1.0 / window)
+
+
+def macd(close):
+    """
+    Returns the MACD line, its signal line and their difference
+    """
+    line = ema(close, MACD_EMA_SHORT) - ema(close, MACD_EMA_LONG)
+    signal = ema(line, MACD_EMA_SIGNAL)
+    return line, signal, line - signal
+
+
+def bollinger_bands(close):
+    """
+    Returns the middle, upper and lower Bollinger bands
+    """
+    middle = moving_mean(close, BOLL_PERIOD, min_periods=1)
+    std = moving_std(close, BOLL_PERIOD, min_periods=1)
+    return middle, middle + BOLL_STD_TIMES * std, middle - BOLL_STD_TIMES * std
+
+
+def rsi(close, window):
+    change = close - shift(close)
+    gains = smma(np.where(change > 0, change, np.where(np.isnan(change), np.nan, 0.0)), window)
+    losses = smma(np.where(change < 0, -change, np.where(np.isnan(change), np.nan, 0.0)), window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return 100 - 100 / (1.0 + gains / losses)
+
+
+def cci(high, low, close, window):
+    """
+    Commodity channel index: the deviation of the typical price from its moving
+    average over CCI_CONSTANT times the mean absolute deviation in the window
+    """
+    typical = (close + high + low) / 3.0
+    typical_mean = moving_mean(typical, window, min_periods=1)
+    # the mean deviation is taken from the mean of the same window,
+    # so each lag's distance to it is added separately
+    num_days = len(typical)
+    deviations = np.zeros(typical.shape)
+    counts = np.zeros(typical.shape)
+    for lag in range(window):
+        deviation = np.abs(typical[:num_days - lag] - typical_mean[lag:])
+        valid = ~np.isnan(deviation)
+        deviations[lag:] += np.where(valid, deviation, 0.0)
+        counts[lag:] += valid
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (typical - typical_mean) / (CCI_CONSTANT * deviations / counts)
+
+
+def dx(high, low, close, window):
+    """
+    Directional movement index from the smoothed +DM, -DM and true range
+    """
+    up_move = np.maximum(high - shift(high), 0.0)
+    down_move = np.maximum(shift(low) - low, 0.0)
+    plus_dm = np.where(up_move > down_move, up_move, 0.0)
+    minus_dm = np.where(down_move > up_move, down_move, 0.0)
+    previous_close = shift(close)
+    true_range = np.max([high - low, np.abs(high - previous_close), np.abs(low - previous_close)], axis=0)
+    average_true_range = smma(true_range, window)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        plus_di = ema(plus_dm, window) / average_true_range * 100
+        minus_di = ema(minus_dm, window) / average_true_range * 100
+        return np.abs(plus_di - minus_di) / (plus_di + minus_di) * 100
+
+
+def volatility(close, window):
+    returns = close / shift(close) - 1
+    return moving_std(returns, window)
+
+
+def _compute_indicator(name, prices):
+    """
+    Returns the (dates, tickers) array of a windowed indicator
+    (see compute_indicators for the MACD and Bollinger lines)
+    """
+    match = WINDOW_INDICATOR.match(name)
+    if match:
+        kind, window = match.group(1), int(match.group(2))
+        if kind == "rsi":
+            return rsi(prices["close"], window)
+        if kind == "cci":
+            return cci(prices["high"], prices["low"], prices["close"], window)
+        if kind == "dx":
+            return dx(prices["high"], prices["low"], prices["close"], window)
+        return volatility(prices["close"], window)
+
+    match = COLUMN_INDICATOR.match(name)
+    if match and match.group(1) in prices:
+        column, window, kind = match.group(1), int(match.group(2)), match.group(3)
+        if kind == "sma":
+            return moving_mean(prices[column], window, min_periods=1)
+        if kind == "ema":
+            return ema(prices[column], window)
+        return moving_std(prices[column], window, min_periods=1)
+
+    raise ValueError(f"Unknown technical indicator {name!r}")
+
+
+def compute_indicators(prices, indicators):
+    """
+    prices: dictionary of price column (open, high, low, close, volume)
+    to its (dates, tickers) array
+
+    Returns a dictionary of indicator name to its (dates, tickers) array.
+    The three MACD lines and the three Bollinger bands are computed together.
+    """
+    computed = dict()
+    for name in indicators:
+        if name in computed:
+            continue
+        if name in ("macd", "macds", "macdh"):
+            computed.update(zip(("macd", "macds", "macdh"), macd(prices["close"])))
+        elif name in ("boll", "boll_ub", "boll_lb"):
+            computed.update(zip(("boll", "boll_ub", "boll_lb"), bollinger_bands(prices["close"])))
+        else:
+            computed[name] = _compute_indicator(name, prices)
+    return {name: computed[name] for name in indicators}
+
+
+def add_technical_indicators(df, indicators):
+    """
+    df: long dataset with date, tic and price columns (e.g. YahooDownloader's)
+
+    Same columns as FeatureEngineer(tech_indicator_list=indicators).preprocess_data(df),
+    computed for all tickers at once. Like stockstats, every ticker's
+    indicators only see its own bars: row i of a ticker's column is its i-th
+    bar, so dates another ticker traded on don't count towards its windows.
+    Values missing at the start or end of a ticker's history are filled with
+    its next or last available value.
+    """
+    df = df.copy()
+    order = np.lexsort((df["date"].to_numpy(), df["tic"].to_numpy()))
+    tickers, tic_codes = np.unique(df["tic"].to_numpy(), return_inverse=True)
+    positions = np.empty(len(df), dtype=np.int64)
+    positions[order] = np.arange(len(df)) - np.searchsorted(tic_codes[order], tic_codes[order])
+    num_rows = positions.max() + 1 if len(df) else 0
+
+    prices = dict()
+    for column in PRICE_COLUMNS:
+        if column in df.columns:
+            panel = np.full((num_rows, len(tickers)), np.nan)
+            panel[positions, tic_codes] = df[column].to_numpy(dtype=np.float64)
+            prices[column] = panel
+
+    for name, values in compute_indicators(prices, indicators).items():
+        values = pd.DataFrame(values).bfill().ffill().to_numpy()
+        df[name] = values[positions, tic_codes]
+    return df
@@ -0,0 +1,243 @@
+import fcntl
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from pandas.tseries.holiday import USFederalHolidayCalendar
+from price_sources import LocalCsvPriceSource, YahooPriceSource
+
+MARKET_DATA_CACHE_DIR = "market_data_cache"
+INDEX_FILE = "index.json"
+INDEX_LOCK_FILE = "index.lock"
+OBJECTS_DIR = "objects"
+CACHE_DATE_FMT = "%Y-%m-%d"
+# Bars of the last few days can still be missing or revised upstream,
+# so they are always fetched live and never cached
+SETTLE_DAYS = 3
+
+
+def uncovered_ranges(segments, start, end):
+    """
+    Returns the [start, end) ranges between start and end
+    that none of the (sorted) segments cover.
+    """
+    gaps = []
+    cursor = start
+    for segment in segments:
+        segment_start, segment_end = pd.Timestamp(segment["start"]), pd.Timestamp(segment["end"])
+        if segment_start >= end:
+            break
+        if segment_end <= cursor:
+            continue
+        if segment_start > cursor:
+            gaps.append((cursor, segment_start))
+        cursor = max(cursor, segment_end)
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+def has_trading_days(start, end):
+    """
+    Rough check of whether the market was open between start and end (exclusive)
+    """
+    holidays = USFederalHolidayCalendar().holidays(start, end).values.astype("datetime64[D]")
+    return np.busday_count(start.date(), end.date(), holidays=holidays) > 0
+
+
+class CachedPriceSource:
+    """
+    Read-through cache in front of a price source (YahooPriceSource or
+    LocalCsvPriceSource) with the same fetch interface.
+
+    Bars are cached per (ticker, interval, auto_adjust) as segments covering
+    [start, end) date ranges. A request is served from the segments it
+    overlaps and only the uncovered ranges are fetched from upstream, after
+    which segments that touch are merged into one. Segment files are named by
+    the hash of their contents and listed in the index:
+
+        cache_dir/index.json
+        cache_dir/objects/<sha256>.csv
+
+    With offline=True nothing is fetched and a request that is not fully
+    cached raises LookupError.
+    """
+
+    def __init__(self, cache_dir=MARKET_DATA_CACHE_DIR, upstream=None, offline=False):
+        self.cache_dir = cache_dir
+        self.upstream = upstream
+        self.offline = offline
+        os.makedirs(os.path.join(cache_dir, OBJECTS_DIR), exist_ok=True)
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, INDEX_FILE)
+
+    def _object_path(self, name):
+        return os.path.join(self.cache_dir, OBJECTS_DIR, name)
+
+    def _load_index(self):
+        if not os.path.exists(self._index_path()):
+            return {}
+        with open(self._index_path(), "r") as f:
+            return json.load(f)
+
+    @contextmanager
+    def _index_lock(self):
+        """
+        Serializes index updates of processes sharing the cache,
+        e.g. the workers of the sharded dataset pipeline
+        """
+        with open(os.path.join(self.cache_dir, INDEX_LOCK_FILE), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _save_index(self, index):
+        # written through a temporary file so readers never see a partial index
+        tmp_path = self._index_path() + f".{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._index_path())
+
+    def _write_object(self, data):
+        """
+        Stores the bars under the hash of their CSV and returns the object name,
+        or None if there are no bars.
+        """
+        if data.empty:
+            return None
+        content = data.to_csv(index_label="Date").encode()
+        name = hashlib.sha256(content).hexdigest() + ".csv"
+        path = self._object_path(name)
+        if not os.path.exists(path):
+            tmp_path = path + f".{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return name
+
+    def _read_object(self, name):
+        return pd.read_csv(self._object_path(name), index_col=0, parse_dates=True, float_precision="round_trip")
+
+    def _read_segments(self, segments, start, end):
+        frames = [
+            self._read_object(segment["object"]) for segment in segments
+            if segment["object"] is not None
+            and pd.Timestamp(segment["start"]) < end and pd.Timestamp(segment["end"]) > start
+        ]
+        if not frames:
+            return pd.DataFrame(index=pd.DatetimeIndex([], name="Date"))
+        data = pd.concat(frames)
+        data = data[~data.index.duplicated(keep="last")].sort_index()
+        return data[(data.index >= start) & (data.index < end)]
+
+    def _fetch_upstream(self, ticker, start, end, interval, auto_adjust):
+        data = self.upstream.fetch(
+            ticker,
+            start=start.strftime(CACHE_DATE_FMT),
+            end=end.strftime(CACHE_DATE_FMT),
+            interval=interval,
+            auto_adjust=auto_adjust,
+        )
+        if isinstance(data.columns, pd.MultiIndex):
+            # newer yfinance versions add the ticker as a second column level
+            data = data.copy()
+            data.columns = data.columns.get_level_values(0)
+        data.index.name = "Date"
+        return data[(data.index >= start) & (data.index < end)]
+
+    def _merge(self, segments):
+        """
+        Returns the segments sorted by start date with every run
+        of overlapping or adjacent segments merged into one.
+        """
+        segments = sorted(segments, key=lambda segment: segment["start"])
+        groups = []
+        for segment in segments:
+            if groups and segment["start"] <= groups[-1][-1]["end"]:
+                groups[-1].append(segment)
+            else:
+                groups.append([segment])
+
+        merged = []
+        for group in groups:
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            start = min(segment["start"] for segment in group)
+            end = max(segment["end"] for segment in group)
+            data = self._read_segments(group, pd.Timestamp(start), pd.Timestamp(end))
+            merged.append({"start": start, "end": end, "object": self._write_object(data)})
+        return merged
+
+    def _remove_unreferenced(self, index, names):
+        referenced = {segment["object"] for segments in index.values() for segment in segments}
+        for name in names - referenced:
+            if name is not None and os.path.exists(self._object_path(name)):
+                os.remove(self._object_path(name))
+
+    def fetch(self, ticker, start, end, interval="1d", auto_adjust=True):
+        """
+        Returns a DataFrame of bars from start (inclusive) to end (exclusive)
+        indexed by date, fetching only the ranges that are not cached yet.
+        """
+        start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+        settled = max(start, min(end, pd.Timestamp.today().normalize() - pd.Timedelta(days=SETTLE_DAYS)))
+        key = f"{ticker}|{interval}|{'adjusted' if auto_adjust else 'raw'}"
+
+        index = self._load_index()
+        segments = index.get(key, [])
+        gaps = uncovered_ranges(segments, start, settled)
+        if gaps:
+            if self.offline or self.upstream is None:
+                gap_start, gap_end = gaps[0]
+                raise LookupError(
+                    f"{key} is not cached from {gap_start.strftime(CACHE_DATE_FMT)} "
+                    f"to {gap_end.strftime(CACHE_DATE_FMT)} and the cache is offline"
+                )
+            new_segments = []
+            for gap_start, gap_end in gaps:
+                data = self._fetch_upstream(ticker, gap_start, gap_end, interval, auto_adjust)
+                if data.empty and has_trading_days(gap_start, gap_end):
+                    # yfinance returns an empty frame when a download fails,
+                    # so only ranges without trading days are cached as empty
+                    continue
+                new_segments.append({
+                    "start": gap_start.strftime(CACHE_DATE_FMT),
+                    "end": gap_end.strftime(CACHE_DATE_FMT),
+                    "object": self._write_object(data),
+                })
+            with self._index_lock():
+                # other processes may have updated the index while fetching
+                index = self._load_index()
+                segments = index.get(key, []) + new_segments
+                names = {segment["object"] for segment in segments}
+                index[key] = self._merge(segments)
+                self._save_index(index)
+                self._remove_unreferenced(index, names)
+
+        data = self._read_segments(index.get(key, []), start, settled)
+        if end > settled and not self.offline and self.upstream is not None:
+            recent = self._fetch_upstream(ticker, settled, end, interval, auto_adjust)
+            data = recent if data.empty else pd.concat([data, recent])
+        return data
+
+
+def cached_price_source(cache_dir=MARKET_DATA_CACHE_DIR, source_dir=None, offline=None):
+    """
+    Returns a CachedPriceSource in front of Yahoo Finance, or in front of the
+    <ticker>.csv files of source_dir when given.
+
+    source_dir and offline default to the MARKET_DATA_SOURCE_DIR and
+    MARKET_DATA_OFFLINE environment variables, so a build environment
+    can run the whole pipeline without network access.
+    """
+    source_dir = source_dir or os.environ.get("MARKET_DATA_SOURCE_DIR")
+    if offline is None:
+        offline = os.environ.get("MARKET_DATA_OFFLINE", "") not in ("", "0")
+    upstream = LocalCsvPriceSource(source_dir) if source_dir else YahooPriceSource()
+    return CachedPriceSource(cache_dir, upstream, offline)
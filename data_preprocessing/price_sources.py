@@ -0,0 +1,54 @@
+import os
+import pandas as pd
+import yfinance as yf
+
+# Columns of a daily bar, in the order yfinance returns them with auto_adjust=True
+PRICE_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+
+
+class YahooPriceSource:
+    """
+    Daily bars downloaded from Yahoo Finance.
+    """
+
+    def fetch(self, ticker, start, end, interval="1d", auto_adjust=True):
+        """
+        Returns a DataFrame of bars from start (inclusive) to end (exclusive)
+        indexed by date, with the columns yf.download returns.
+        """
+        return yf.download(
+            ticker,
+            start=start,
+            end=end,
+            interval=interval,
+            auto_adjust=auto_adjust,
+        )
+
+
+class LocalCsvPriceSource:
+    """
+    File-backed stand-in for YahooPriceSource that serves bars from local
+    CSVs with a Date column followed by the bar columns, e.g. a saved
+    yf.download(...).to_csv().
+
+    paths is either a directory holding one <ticker>.csv per ticker or a
+    dictionary of ticker to CSV path. Bars are served as stored, so the
+    auto_adjust flag is not applied.
+    """
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def _csv_path(self, ticker):
+        if isinstance(self.paths, dict):
+            return self.paths[ticker]
+        return os.path.join(self.paths, f"{ticker}.csv")
+
+    def fetch(self, ticker, start, end, interval="1d", auto_adjust=True):
+        if interval != "1d":
+            raise ValueError(f"LocalCsvPriceSource only serves daily bars, got interval={interval}")
+        df = pd.read_csv(self._csv_path(ticker), float_precision="round_trip")
+        df.columns = [column.strip() for column in df.columns]
+        df.index = pd.DatetimeIndex(pd.to_datetime(df.pop(df.columns[0])), name="Date")
+        df = df.sort_index()
+        return df[(df.index >= pd.Timestamp(start)) & (df.index < pd.Timestamp(end))]
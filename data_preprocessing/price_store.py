@@ -0,0 +1,139 @@
+import json
+import os
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+CSVS_DIR = "csvs"
+STORE_DIR = "price_store"
+CSV_SUFFIX = "_technical_data.csv"
+CSV_DATE_FMT = "%Y-%m-%d %H:%M:%S"
+PRICES_FILE = "prices.npy"
+DATES_FILE = "dates.npy"
+META_FILE = "meta.json"
+
+
+def _list_technical_csvs(csvs_dir):
+    """
+    Returns a dictionary of ticker to technical data CSV path,
+    sorted by ticker so the store layout is deterministic.
+    """
+    return {
+        f[:-len(CSV_SUFFIX)]: os.path.join(csvs_dir, f)
+        for f in sorted(os.listdir(csvs_dir)) if f.endswith(CSV_SUFFIX)
+    }
+
+
+def _source_mtimes(ticker_to_csv):
+    return {ticker: os.path.getmtime(path) for ticker, path in ticker_to_csv.items()}
+
+
+def build_price_store(csvs_dir=CSVS_DIR, store_dir=STORE_DIR):
+    """
+    One-time conversion of every *_technical_data.csv in csvs_dir into a
+    columnar binary store:
+        prices.npy - float64 array of shape (dates, tickers, fields)
+        dates.npy  - datetime64[D] date index (sorted)
+        meta.json  - ticker and field names plus source file mtimes
+
+    The price array is written through a memory map one ticker at a time,
+    so building the store never holds more than one CSV in memory.
+    """
+    ticker_to_csv = _list_technical_csvs(csvs_dir)
+    tickers = list(ticker_to_csv)
+    if not tickers:
+        raise ValueError(f"No *{CSV_SUFFIX} files found in {csvs_dir}")
+    os.makedirs(store_dir, exist_ok=True)
+
+    prices = None
+    for i, ticker in enumerate(tickers):
+        df = pd.read_csv(ticker_to_csv[ticker], float_precision="round_trip")
+        dates = pd.to_datetime(df.iloc[:, 0], format=CSV_DATE_FMT).values.astype("datetime64[D]")
+        if prices is None:
+            fields = list(df.columns[1:])
+            date_index = dates
+            prices = np.lib.format.open_memmap(
+                os.path.join(store_dir, PRICES_FILE),
+                mode="w+",
+                dtype=np.float64,
+                shape=(len(date_index), len(tickers), len(fields)),
+            )
+        elif not np.array_equal(dates, date_index):
+            raise ValueError(f"{ticker_to_csv[ticker]} does not share the trading dates of {tickers[0]}")
+        prices[:, i, :] = df.iloc[:, 1:].to_numpy(dtype=np.float64)
+
+    prices.flush()
+    del prices
+    np.save(os.path.join(store_dir, DATES_FILE), date_index)
+    with open(os.path.join(store_dir, META_FILE), "w") as f:
+        json.dump(
+            {"tickers": tickers, "fields": fields, "source_mtimes": _source_mtimes(ticker_to_csv)},
+            f,
+        )
+
+
+class PriceStore:
+    """
+    Read-only view over a store written by build_price_store.
+    The price array is memory-mapped, so slicing a date range only touches
+    the pages of that range.
+    """
+
+    def __init__(self, store_dir=STORE_DIR):
+        with open(os.path.join(store_dir, META_FILE), "r") as f:
+            meta = json.load(f)
+        self.tickers = meta["tickers"]
+        self.fields = meta["fields"]
+        self.source_mtimes = meta["source_mtimes"]
+        self.dates = np.load(os.path.join(store_dir, DATES_FILE))
+        self.prices = np.load(os.path.join(store_dir, PRICES_FILE), mmap_mode="r")
+
+    def date_slice(self, start_date, end_date):
+        """
+        Returns the slice of the date index covering start_date to end_date
+        (both inclusive), found by binary search.
+        """
+        start = np.searchsorted(self.dates, np.datetime64(start_date, "D"), side="left")
+        end = np.searchsorted(self.dates, np.datetime64(end_date, "D"), side="right")
+        return slice(start, end)
+
+    def get(self, start_date, end_date, field):
+        """
+        Returns the list of dates from the start date to the end date and
+        a (dates, tickers) view of the given field over the same range.
+        """
+        rows = self.date_slice(start_date, end_date)
+        dates = self.dates[rows].astype("datetime64[us]").tolist()
+        return dates, self.prices[rows, :, self.fields.index(field)]
+
+    def is_stale(self, csvs_dir):
+        return _source_mtimes(_list_technical_csvs(csvs_dir)) != self.source_mtimes
+
+
+@lru_cache(maxsize=None)
+def load_price_store(csvs_dir=CSVS_DIR, store_dir=STORE_DIR):
+    """
+    Returns the PriceStore for csvs_dir, (re)building it first if it does not
+    exist yet or any source CSV changed since it was built.
+    The store is opened once per process and shared by every caller.
+    """
+    if os.path.exists(os.path.join(store_dir, META_FILE)):
+        store = PriceStore(store_dir)
+        if not store.is_stale(csvs_dir):
+            return store
+        del store
+    build_price_store(csvs_dir, store_dir)
+    return PriceStore(store_dir)
+
+
+def main():
+    build_price_store()
+    store = PriceStore()
+    print(
+        f"Price store built: {len(store.dates)} dates x {len(store.tickers)} tickers x "
+        f"{len(store.fields)} fields ({store.dates[0]} to {store.dates[-1]})"
+    )
+
+
+if __name__ == "__main__":
+    main()
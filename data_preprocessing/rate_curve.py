@@ -0,0 +1,125 @@
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+
+RISK_FREE_RATES_CSV = "csvs/US_treasury_daily_risk_free_rates.csv"
+RATE_TABLE = "csvs/US_treasury_daily_rate_table.npz"
+CSV_DATE_FMT = "%Y-%m-%d %H:%M:%S"
+
+
+class RateCurve:
+    """
+    Daily risk free rates indexed by the (sorted) dates they were published.
+
+    Rates for trading days on which the US Treasury did not publish
+    yield curve rates are taken from the most recent day it did (as-of join).
+    """
+
+    def __init__(self, dates, rates):
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+        self.rates = np.asarray(rates, dtype=np.float64)
+
+    @classmethod
+    def from_csv(cls, risk_free_rates_csv=RISK_FREE_RATES_CSV):
+        df = pd.read_csv(risk_free_rates_csv, float_precision="round_trip")
+        dates = pd.to_datetime(df.iloc[:, 0], format=CSV_DATE_FMT).values
+        return cls(dates, df.iloc[:, 1].to_numpy())
+
+    @classmethod
+    def from_rate_table(cls, tenor, rate_table=RATE_TABLE):
+        """
+        Returns the curve of one tenor of the rate table, e.g. "3 Mo"
+        """
+        return load_rate_table(rate_table).curve(tenor)
+
+    def slice(self, start_date, end_date):
+        """
+        Returns views of the publication dates and rates
+        from the start date to the end date (both inclusive)
+        """
+        start = np.searchsorted(self.dates, np.datetime64(start_date, "D"), side="left")
+        end = np.searchsorted(self.dates, np.datetime64(end_date, "D"), side="right")
+        return self.dates[start:end], self.rates[start:end]
+
+    def align(self, trading_dates):
+        """
+        Returns an array with the daily risk free rate of every trading date,
+        forward-filling dates without a published rate.
+        """
+        trading_dates = np.asarray(trading_dates, dtype="datetime64[D]")
+        indices = np.searchsorted(self.dates, trading_dates, side="right") - 1
+        if len(indices) and indices.min() < 0:
+            raise ValueError(f"No risk free rate published on or before {trading_dates[indices.argmin()]}")
+        return self.rates[indices]
+
+
+class RateTable:
+    """
+    Daily rates of every tenor of the yield curve, a (dates, tenors) array
+    indexed by the (sorted) dates they were published, NaN before a tenor
+    was first published. Written by get_daily_risk_free_rates.py.
+    """
+
+    def __init__(self, dates, tenors, rates):
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+        self.tenors = list(tenors)
+        self.rates = np.asarray(rates, dtype=np.float64)
+
+    @classmethod
+    def from_npz(cls, rate_table=RATE_TABLE):
+        with np.load(rate_table) as table:
+            return cls(table["dates"], table["tenors"].tolist(), table["rates"])
+
+    def _tenor_index(self, tenor):
+        if tenor not in self.tenors:
+            raise ValueError(f"Unknown tenor {tenor!r}, the rate table has {self.tenors}")
+        return self.tenors.index(tenor)
+
+    def curve(self, tenor):
+        """
+        Returns the RateCurve of a tenor from the first day it was published
+        """
+        rates = self.rates[:, self._tenor_index(tenor)]
+        published = ~np.isnan(rates)
+        return RateCurve(self.dates[published], rates[published])
+
+    def get(self, start_date, end_date, tenor):
+        """
+        Returns views of the publication dates and the daily rates of a tenor
+        from the start date to the end date (both inclusive)
+        """
+        start = np.searchsorted(self.dates, np.datetime64(start_date, "D"), side="left")
+        end = np.searchsorted(self.dates, np.datetime64(end_date, "D"), side="right")
+        return self.dates[start:end], self.rates[start:end, self._tenor_index(tenor)]
+
+
+def write_rate_table(rate_table, dates, tenors, rates):
+    """
+    Write the (dates, tenors) daily rates as an uncompressed npz
+    """
+    np.savez(
+        rate_table,
+        dates=np.asarray(dates, dtype="datetime64[D]"),
+        tenors=np.asarray(tenors),
+        rates=np.asarray(rates, dtype=np.float64),
+    )
+
+
+@lru_cache(maxsize=None)
+def load_rate_table(rate_table=RATE_TABLE):
+    """
+    Returns the RateTable of the given npz, read once per process.
+    """
+    return RateTable.from_npz(rate_table)
+
+
+@lru_cache(maxsize=None)
+def load_rate_curve(risk_free_rates_csv=RISK_FREE_RATES_CSV, tenor=None, rate_table_npz=RATE_TABLE):
+    """
+    Returns the RateCurve of the given CSV, read once per process.
+    With a tenor, the curve is the one of that tenor in the rate table
+    rate_table_npz instead.
+    """
+    if tenor is not None:
+        return RateCurve.from_rate_table(tenor, rate_table_npz)
+    return RateCurve.from_csv(risk_free_rates_csv)
@@ -0,0 +1,386 @@
+"""
+Turbulence index of the tickers' daily returns, as FinRL's
+FeatureEngineer(use_turbulence=True): the Mahalanobis distance of each day's
+returns from the mean of the window days before it,
+
+    (r_t - m)^T pinv(cov) (r_t - m)
+
+with the mean m and covariance cov (ddof=1) of the returns of the window
+days, dropping the tickers with missing returns in the window.
+
+Recomputing the covariance and its pseudo-inverse every day costs
+O(window N^2 + N^3) per day for N tickers. turbulence_index slides the
+window instead, one day in and one day out, and keeps an inverse up to date
+in O(N^2) per day (O(window^2 + window N) when N >= window):
+
+    N < window:   the inverse of the window's scatter matrix, two rank one
+                  (Sherman-Morrison) updates per day
+    N >= window:  the covariance has rank window - 1 and its pseudo-inverse
+                  comes from the window x window Gram matrix of the days,
+                  whose inverse takes one rank two (Woodbury) update per day
+
+Every distance is refined once against the matrix itself, and the inverse
+is recomputed when the residual shows the updates have drifted from it (the
+worse the window is conditioned, the sooner), every refresh_days days and
+whenever the tickers of the window change. Days whose window has missing
+returns in every ticker or whose covariance is singular are computed like
+FinRL.
+"""
+import time
+import numpy as np
+import pandas as pd
+
+# One year of trading days, FinRL's window
+TURBULENCE_WINDOW = 252
+# Smallest ratio of the smallest to the largest eigenvalue (or of the
+# determinants before and after an update) an inverse is kept at
+TOLERANCE = 1e-10
+# Largest relative residual of a solve with an updated inverse before the
+# inverse is recomputed
+RESIDUAL_TOLERANCE = 1e-6
+
+
+def close_returns(closes):
+    """
+    closes: (dates, tickers) closing prices, NaN (or 0, as in the panel of
+    build_stock_panel) where a ticker has no bar
+
+    Daily returns as DataFrame.pct_change() (which pads missing prices
+    first), NaN before a ticker's first bar
+    """
+    closes = pd.DataFrame(closes)
+    closes = closes.where(closes > 0).ffill().to_numpy(dtype=np.float64)
+    returns = np.full(closes.shape, np.nan)
+    returns[1:] = closes[1:] / closes[:-1] - 1
+    return returns
+
+
+def _window_columns(returns, day, window):
+    """
+    Rows and tickers of the window of day FinRL computes the covariance of:
+    the rows after the most missing values any ticker is missing,
+    then the tickers without missing returns
+    """
+    history = returns[day - window:day]
+    missing = np.isnan(history)
+    first_row = missing.sum(axis=0).min()
+    return history[first_row:], ~missing[first_row:].any(axis=0)
+
+
+def _distance(history, current):
+    """
+    Turbulence of current against history with pinv, as calculate_turbulence
+    """
+    if history.shape[1] == 0:
+        return 0.0
+    deviation = current - history.mean(axis=0)
+    covariance = np.atleast_2d(np.cov(history, rowvar=False))
+    return float(deviation @ np.linalg.pinv(covariance) @ deviation)
+
+
+def _finrl_values(distances, window):
+    """
+    FinRL keeps 0 for the first window days and for the first two days
+    with a positive distance (outliers while the calculation begins)
+    """
+    positive = np.nan_to_num(distances, nan=-1.0) > 0
+    positive[:window] = False
+    return np.where(positive & (np.cumsum(positive) > 2), distances, 0.0)
+
+
+def naive_turbulence_index(returns, window=TURBULENCE_WINDOW):
+    """
+    returns: (dates, tickers) daily returns, NaN where missing
+
+    (dates,) turbulence index recomputing the covariance and its
+    pseudo-inverse every day, as calculate_turbulence
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    distances = np.zeros(len(returns))
+    for day in range(window, len(returns)):
+        history, columns = _window_columns(returns, day, window)
+        distances[day] = _distance(history[:, columns], returns[day, columns])
+    return _finrl_values(distances, window)
+
+
+class RollingInverse:
+    """
+    Inverse of a symmetric positive definite matrix that changes by low rank
+    updates from day to day. Solves go through one step of iterative
+    refinement against the matrix itself, and the inverse is recomputed when
+    its residual shows that the updates have drifted too far from the matrix
+    (which happens sooner the worse the matrix is conditioned).
+    """
+
+    def _invert(self, matrix):
+        eigenvalues, eigenvectors = np.linalg.eigh(matrix)
+        self.singular = eigenvalues[0] <= TOLERANCE * eigenvalues[-1]
+        self.inverse = (eigenvectors / eigenvalues) @ eigenvectors.T
+        self.inversions += 1
+
+    def _solve(self, matrix, vector):
+        """
+        matrix^-1 vector, matrix is the one the inverse was updated to
+        """
+        solution = self.inverse @ vector
+        residual = vector - matrix @ solution
+        if np.linalg.norm(residual) > RESIDUAL_TOLERANCE * np.linalg.norm(vector):
+            self._invert(matrix)
+            solution = self.inverse @ vector
+            residual = vector - matrix @ solution
+        return solution + self.inverse @ residual
+
+
+class RollingInverseCovariance(RollingInverse):
+    """
+    Scatter matrix S = sum (r - m)(r - m)^T of the n days of a window of
+    N < n tickers, its inverse P and their mean m. The distance of r is
+    (n - 1) (r - m)^T P (r - m).
+
+    A day entering the window of n days, then the oldest day y leaving the
+    n + 1 days are rank one updates of S:
+
+        S1 = S + n / (n + 1) (r - m)(r - m)^T      m1 = m + (r - m) / (n + 1)
+        S2 = S1 - (n + 1) / n (y - m1)(y - m1)^T   m2 = m1 + (m1 - y) / n
+
+    and of P with the Sherman-Morrison formula, O(N^2) each.
+    """
+
+    def __init__(self, history):
+        self.history = history.copy()
+        self.oldest = 0
+        self.num_days = len(history)
+        self.mean = history.mean(axis=0)
+        deviations = history - self.mean
+        self.scatter = deviations.T @ deviations
+        self.inversions = 0
+        self._invert(self.scatter)
+
+    def distance(self, current):
+        deviation = current - self.mean
+        return (self.num_days - 1) * deviation @ self._solve(self.scatter, deviation)
+
+    def _rank_one_update(self, vector, scale):
+        """
+        S + scale v v^T and its inverse, False if it is (close to) singular
+        """
+        projected = self.inverse @ vector
+        ratio = 1 + scale * vector @ projected
+        if ratio <= TOLERANCE:
+            return False
+        self.inverse -= (scale / ratio) * np.outer(projected, projected)
+        self.scatter += scale * np.outer(vector, vector)
+        return True
+
+    def slide(self, current):
+        """
+        current enters the window and its oldest day leaves it.
+        Returns False if the new scatter matrix is (close to) singular.
+        """
+        n = self.num_days
+        leaving = self.history[self.oldest]
+        deviation = current - self.mean
+        self._rank_one_update(deviation, n / (n + 1))
+        mean = self.mean + deviation / (n + 1)
+        if not self._rank_one_update(leaving - mean, -(n + 1) / n):
+            return False
+        self.mean = mean + (mean - leaving) / n
+        self.history[self.oldest] = current
+        self.oldest = (self.oldest + 1) % n
+        return True
+
+
+class RollingInverseGram(RollingInverse):
+    """
+    Pseudo-inverse of the covariance of the n days of a window of N >= n - 1
+    tickers through the n x n Gram matrix K = X X^T of the days' returns X.
+
+    With the centered returns Xc = H X (H = I - 11^T / n), the scatter matrix
+    Xc^T Xc has the pseudo-inverse Xc^T G+^2 Xc with G = Xc Xc^T = H K H, so
+    the distance of r is (n - 1) ||G+ v||^2 with v = Xc (r - m), i.e.
+
+        v = g - mean(g) - K 1 / n + 1^T K 1 / n^2,    g = X r
+
+    G has rank n - 1 (its null space is 1) and v is orthogonal to 1, so
+    G+ v = A^-1 v with A = G + s 11^T / n, for any s > 0.
+
+    Days are stored in a ring, a day replacing the oldest one in slot j
+    changes row and column j of K: K + e_j a^T + a e_j^T, a rank two update of
+    A by H e_j and H a, whose inverse takes the Woodbury formula, O(n^2),
+    after the O(n N) Gram row g of the new day.
+    """
+
+    def __init__(self, history):
+        self.history = history.copy()
+        self.oldest = 0
+        self.num_days = len(history)
+        self.gram = history @ history.T
+        centered = self._centered_gram()
+        # s, the eigenvalue of 1, on the scale of the others
+        self.scale = np.trace(centered) / (self.num_days - 1)
+        self.inversions = 0
+        self._invert(centered + self.scale / self.num_days)
+        self._current_gram = None
+
+    def _centered_gram(self):
+        row_means = self.gram.mean(axis=1)
+        return self.gram - row_means[:, None] - row_means[None, :] + row_means.mean()
+
+    def distance(self, current):
+        gram = self.history @ current
+        row_means = self.gram.mean(axis=1)
+        deviations = gram - gram.mean() - row_means + row_means.mean()
+        projected = self._solve(self._centered_gram() + self.scale / self.num_days, deviations)
+        self._current_gram = (current, gram)
+        return (self.num_days - 1) * projected @ projected
+
+    def slide(self, current):
+        """
+        current enters the window and its oldest day leaves it.
+        Returns False if the new covariance has rank below n - 1.
+        """
+        n, slot = self.num_days, self.oldest
+        if self._current_gram is not None and self._current_gram[0] is current:
+            gram = self._current_gram[1].copy()
+        else:
+            gram = self.history @ current
+        gram[slot] = current @ current
+        change = gram - self.gram[slot]
+        change[slot] /= 2
+
+        vectors = np.zeros((n, 2))
+        vectors[slot, 0] = 1
+        vectors[:, 1] = change
+        vectors -= vectors.mean(axis=0)
+        projected = self.inverse @ vectors
+        # A + U C U^T with C = [[0, 1], [1, 0]] = C^-1
+        capacitance = np.array([[0.0, 1.0], [1.0, 0.0]]) + vectors.T @ projected
+        # determinant of the new A over the one of A
+        if -np.linalg.det(capacitance) <= TOLERANCE:
+            return False
+        self.inverse -= projected @ np.linalg.solve(capacitance, projected.T)
+
+        self.gram[slot] = gram
+        self.gram[:, slot] = gram
+        self.history[slot] = current
+        self.oldest = (slot + 1) % n
+        self._current_gram = None
+        return True
+
+
+def rolling_inverse(history):
+    """
+    RollingInverseCovariance or RollingInverseGram of the window's returns,
+    whichever inverse is smaller
+    """
+    if history.shape[1] < len(history) - 1:
+        return RollingInverseCovariance(history)
+    return RollingInverseGram(history)
+
+
+def turbulence_index(returns, window=TURBULENCE_WINDOW, refresh_days=None):
+    """
+    returns: (dates, tickers) daily returns, NaN where missing
+
+    (dates,) turbulence index of naive_turbulence_index (up to rounding),
+    sliding the window's inverse (see rolling_inverse) from day to day
+    instead of recomputing it. It is recomputed from the window when it has
+    drifted (see RollingInverse), every refresh_days days (default: window)
+    and when tickers enter or leave the window. Days whose window has missing returns in every ticker or
+    whose covariance is singular are computed like naive_turbulence_index.
+    """
+    returns = np.asarray(returns, dtype=np.float64)
+    refresh_days = refresh_days or window
+    num_dates = len(returns)
+    # missing returns of every ticker in the window of every day
+    missing = np.vstack([np.zeros((1, returns.shape[1]), dtype=np.int64), np.cumsum(np.isnan(returns), axis=0)])
+
+    distances = np.zeros(num_dates)
+    inverse, inverse_columns, slides = None, None, 0
+    for day in range(window, num_dates):
+        window_missing = missing[day] - missing[day - window]
+        columns = window_missing == 0
+        if not columns.any():
+            history, columns = _window_columns(returns, day, window)
+            distances[day] = _distance(history[:, columns], returns[day, columns])
+            inverse = None
+            continue
+
+        if inverse is None or slides >= refresh_days or not np.array_equal(columns, inverse_columns):
+            inverse = rolling_inverse(returns[day - window:day, columns])
+            inverse_columns, slides = columns, 0
+        current = returns[day, columns]
+        if not inverse.singular:
+            distances[day] = inverse.distance(current)
+        if inverse.singular:
+            # the window's covariance has no inverse, found when building or
+            # recomputing it
+            distances[day] = _distance(returns[day - window:day, columns], current)
+            inverse = None
+            continue
+        if np.isnan(current).any() or not inverse.slide(current):
+            # the ticker with a missing return leaves the window tomorrow
+            inverse = None
+        slides += 1
+    return _finrl_values(distances, window)
+
+
+def calculate_turbulence(df, window=TURBULENCE_WINDOW, naive=False):
+    """
+    df: long dataset with date, tic and close columns
+
+    Returns a frame with the turbulence index of every date,
+    as FeatureEngineer.calculate_turbulence
+    """
+    closes = df.pivot(index="date", columns="tic", values="close").sort_index()
+    returns = close_returns(closes)
+    index = naive_turbulence_index(returns, window) if naive else turbulence_index(returns, window)
+    return pd.DataFrame({"date": closes.index, "turbulence": index})
+
+
+def add_turbulence(df, window=TURBULENCE_WINDOW):
+    """
+    df with the turbulence column of its date, as FeatureEngineer.add_turbulence
+    """
+    df = df.merge(calculate_turbulence(df, window), on="date")
+    return df.sort_values(["date", "tic"]).reset_index(drop=True)
+
+
+def risk_off_threshold(df, quantile):
+    """
+    Turbulence above which an environment sells everything: the quantile
+    of the turbulence of df's dates (e.g. of the training window)
+    """
+    return float(df.groupby("date")["turbulence"].first().quantile(quantile))
+
+
+def benchmark_turbulence(num_dates=2 * TURBULENCE_WINDOW, num_tickers=500, window=TURBULENCE_WINDOW, seed=0):
+    """
+    Times turbulence_index against naive_turbulence_index on random returns
+    of num_tickers tickers, a tenth of which start trading after the others.
+    Returns the seconds of both and their largest relative difference.
+    """
+    rng = np.random.default_rng(seed)
+    factors = rng.normal(0, 0.01, (num_dates, 5))
+    returns = factors @ rng.normal(0, 1, (5, num_tickers)) + rng.normal(0, 0.01, (num_dates, num_tickers))
+    listings = rng.integers(0, num_dates // 2, num_tickers // 10)
+    for ticker, listing in enumerate(listings):
+        returns[:listing, ticker] = np.nan
+
+    ctime = time.time()
+    naive = naive_turbulence_index(returns, window)
+    naive_seconds = time.time() - ctime
+    ctime = time.time()
+    rolling = turbulence_index(returns, window)
+    rolling_seconds = time.time() - ctime
+    difference = np.abs(rolling - naive).max() / np.abs(naive).max()
+    return naive_seconds, rolling_seconds, difference
+
+
+if __name__ == "__main__":
+    for num_tickers in [30, 100, 500]:
+        naive_seconds, rolling_seconds, difference = benchmark_turbulence(num_tickers=num_tickers)
+        print(
+            f"{num_tickers} tickers, {2 * TURBULENCE_WINDOW} dates - naive: {naive_seconds:.2f}s, "
+            f"rolling: {rolling_seconds:.2f}s, largest relative difference: {difference:.1e}"
+        )
@@ -0,0 +1,123 @@
+import itertools
+import numpy as np
+import pandas as pd
+
+from fast_env import FastStockTradingEnv, OrderBuffers, execute_orders
+from perf_stats import perf_stats
+
+# env_kwargs a scenario can change
+SCENARIO_KEYS = ["buy_cost_pct", "sell_cost_pct", "hmax", "initial_amount"]
+
+
+def scenario_grid(**values):
+    """
+    Returns the scenarios of every combination of the given values,
+    e.g. scenario_grid(buy_cost_pct=[0.001, 0.002], hmax=[50, 100])
+    """
+    unknown = set(values) - set(SCENARIO_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown scenario keys {sorted(unknown)}, expected some of {SCENARIO_KEYS}")
+    keys = list(values)
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values.values())]
+
+
+def actions_array(df_actions_list, tickers):
+    """
+    Returns the (M, days - 1, tickers) share orders of the df_actions of M
+    backtests (as DRL_prediction returns them) in the given ticker order
+    """
+    return np.stack([df_actions[list(tickers)].to_numpy(dtype=np.int64) for df_actions in df_actions_list])
+
+
+def replay_actions(df, env_kwargs, actions, scenarios, record_holdings=False):
+    """
+    Re-execute the share orders of M backtests over df under S scenarios of
+    env_kwargs (see SCENARIO_KEYS, the keys a scenario leaves out keep their
+    env_kwargs value), without running the models again.
+
+    actions: (M, days - 1, tickers) orders the models placed with env_kwargs
+    (tickers sorted), as simulate and evaluate_models return them, or the
+    list of the df_actions DRL_prediction returned for them
+
+    A day's orders are scaled by the scenario's hmax over env_kwargs' and
+    truncated towards zero (within a share of the model's action times the
+    scenario's hmax), then executed with the rules of the environment, so
+    sells stay limited by the shares held and buys by the cash left. The
+    policy doesn't see the cash and holdings of a scenario: only its decisions
+    are replayed. With the settings of env_kwargs, the placed orders reproduce
+    the backtests (up to rounding). On the days above env_kwargs'
+    turbulence_threshold every account sells all of its holdings instead,
+    as in the environment. df_actions hold the executed orders instead, which
+    reproduce them except after a buy of -1 shares, which StockTradingEnv
+    makes when the cost of the previous buys leaves the cash below 0.
+
+    All M * S accounts are executed together, one batch per day.
+    Returns the dates, the (M, S, days) cash and account values at each close
+    and, with record_holdings, the (M, S, days, tickers) holdings at each close
+    (otherwise the (M, S, tickers) holdings at the last one).
+    """
+    env = FastStockTradingEnv(df=df, **env_kwargs)
+    if isinstance(actions, list) and isinstance(actions[0], pd.DataFrame):
+        actions = actions_array(actions, env.tickers)
+    actions = np.asarray(actions, dtype=np.int64)
+    num_models, num_orders, n = actions.shape
+    if num_orders != env.num_days - 1:
+        raise ValueError(f"Expected the orders of {env.num_days - 1} days, got {num_orders}")
+    settings = {
+        key: np.array([scenario.get(key, env_kwargs[key]) for scenario in scenarios], dtype=np.float64)
+        for key in SCENARIO_KEYS
+    }
+    num_scenarios = len(scenarios)
+    # account b is model b // S under scenario b % S
+    repeat = lambda values: np.tile(values, num_models)
+    buy_cost_pct, sell_cost_pct = repeat(settings["buy_cost_pct"]), repeat(settings["sell_cost_pct"])
+    hmax_scale = repeat(settings["hmax"] / env_kwargs["hmax"])
+
+    num_accounts = num_models * num_scenarios
+    cash = np.empty((num_accounts, env.num_days))
+    account_values = np.empty((num_accounts, env.num_days))
+    cash[:, 0] = account_values[:, 0] = repeat(settings["initial_amount"])
+    holdings = np.zeros((num_accounts, env.num_days, n)) if record_holdings else None
+    day_cash, day_holdings = cash[:, 0].copy(), np.zeros((num_accounts, n))
+    risk_off = env.risk_off_days()
+    buffers = OrderBuffers(num_accounts, n)
+    for day in range(env.num_days - 1):
+        if risk_off[day]:
+            orders = -np.maximum(day_holdings, 0).astype(np.int64)
+        else:
+            orders = np.repeat(actions[:, day], num_scenarios, axis=0)
+            orders = np.trunc(orders * hmax_scale[:, None]).astype(np.int64)
+        execute_orders(day_cash, day_holdings, env.close[day], orders, buy_cost_pct, sell_cost_pct, buffers)
+        cash[:, day + 1] = day_cash
+        account_values[:, day + 1] = day_cash + day_holdings @ env.close[day + 1]
+        if record_holdings:
+            holdings[:, day + 1] = day_holdings
+
+    shape = (num_models, num_scenarios)
+    if record_holdings:
+        holdings = holdings.reshape(shape + (env.num_days, n))
+    else:
+        holdings = day_holdings.reshape(shape + (n,))
+    return (
+        env.dates,
+        cash.reshape(shape + (env.num_days,)),
+        account_values.reshape(shape + (env.num_days,)),
+        holdings,
+    )
+
+
+def scenario_perf_stats(df, env_kwargs, actions, scenarios, model_names=None):
+    """
+    Returns the backtest_stats of every backtest under every scenario (see
+    replay_actions), one row per (model, scenario) with the scenario's settings
+    """
+    _, _, account_values, _ = replay_actions(df, env_kwargs, actions, scenarios)
+    num_models, num_scenarios, num_days = account_values.shape
+    stats = perf_stats(account_values.reshape(-1, num_days))
+    model_names = list(model_names) if model_names is not None else list(range(num_models))
+    settings = pd.DataFrame([
+        {key: scenario.get(key, env_kwargs[key]) for key in SCENARIO_KEYS} for scenario in scenarios
+    ])
+    index = pd.MultiIndex.from_product([model_names, range(num_scenarios)], names=["model", "scenario"])
+    settings = pd.concat([settings] * num_models, ignore_index=True)
+    return pd.concat([settings, stats], axis=1).set_index(index)
@@ -0,0 +1,135 @@
+import os
+import numpy as np
+import pandas as pd
+import torch
+from torch import nn
+from stable_baselines3 import DDPG
+
+from checkpoints import MODEL_FILE, latest_checkpoint
+from fast_env import FastStockTradingEnv, OrderBuffers, execute_orders
+from perf_stats import perf_stats
+
+
+class BatchedActor:
+    """
+    The deterministic policies of several trained DDPG models evaluated as one:
+    the weights of every Linear layer of the actor networks are stacked over the
+    models, so a forward pass of all of them is one batched matrix product per
+    layer instead of one predict call per model.
+
+    All models must have the same actor architecture, i.e. the same
+    features (state space) and net_arch.
+    """
+
+    def __init__(self, models):
+        self.action_space = models[0].action_space
+        actors = [model.actor.mu for model in models]
+        if any(len(actor) != len(actors[0]) for actor in actors):
+            raise ValueError("All models must have the same actor architecture")
+
+        self.layers = []
+        for modules in zip(*actors):
+            if any(type(module) is not type(modules[0]) for module in modules):
+                raise ValueError("All models must have the same actor architecture")
+            if isinstance(modules[0], nn.Linear):
+                # (M, in, out) weights and (M, 1, out) biases
+                weight = torch.stack([module.weight.detach().cpu() for module in modules]).transpose(1, 2)
+                bias = torch.stack([module.bias.detach().cpu() for module in modules]).unsqueeze(1)
+                self.layers.append((weight, bias))
+            else:
+                self.layers.append(modules[0])
+
+    def __len__(self):
+        return self.layers[0][0].shape[0]
+
+    @torch.no_grad()
+    def predict(self, observations):
+        """
+        observations: (M, state_space) float32, one per model
+
+        Returns the (M, action_space) actions model.predict(observation)
+        returns for each model, up to float32 rounding.
+        """
+        x = torch.as_tensor(observations, dtype=torch.float32).unsqueeze(1)
+        for layer in self.layers:
+            if isinstance(layer, tuple):
+                weight, bias = layer
+                x = torch.baddbmm(bias, x, weight)
+            else:
+                x = layer(x)
+        # same rescaling from the tanh output as the policy's predict
+        low, high = self.action_space.low, self.action_space.high
+        return low + (0.5 * (x.squeeze(1).numpy() + 1.0) * (high - low))
+
+
+def simulate(actor, df, env_kwargs):
+    """
+    Trade every model of actor over df in lockstep, with the same rules and
+    number of steps as DRLAgent.DRL_prediction on FastStockTradingEnv(df, **env_kwargs).
+
+    The market data is converted to arrays once and shared by all models. Each
+    day builds the (M, state_space) states, runs one batched forward pass and
+    executes the M accounts' orders together.
+
+    Returns the dates, the (M, days) account values, the (M, days - 1, tickers)
+    executed share orders and the (M, days - 1, tickers) orders the models
+    placed, before they were limited by the cash and shares held (or replaced
+    by selling everything on the days above env_kwargs' turbulence_threshold).
+    """
+    env = FastStockTradingEnv(df=df, **env_kwargs)
+    num_models, n = len(actor), env.stock_dim
+    cash = np.full(num_models, float(env.initial_amount))
+    holdings = np.zeros((num_models, n))
+    state = np.zeros((num_models, env.state_space), dtype=np.float32)
+    account_values = np.zeros((num_models, env.num_days))
+    account_values[:, 0] = env.initial_amount
+    actions = np.zeros((num_models, max(env.num_days - 1, 0), n), dtype=np.int64)
+    placed = np.zeros_like(actions)
+    risk_off = env.risk_off_days()
+    buffers = OrderBuffers(num_models, n)
+
+    for day in range(env.num_days - 1):
+        state[:, 0] = cash
+        state[:, 1:n + 1] = env.tensor[day, 0]
+        state[:, n + 1:2 * n + 1] = holdings
+        state[:, 2 * n + 1:] = env.tensor[day, 1:].ravel()
+        # same float32 scaling and truncation towards zero as the env
+        orders = (actor.predict(state) * env.hmax).astype(int)
+        placed[:, day] = orders
+        if risk_off[day]:
+            orders = -np.maximum(holdings, 0).astype(np.int64)
+        execute_orders(cash, holdings, env.close[day], orders, env.buy_cost_pct, env.sell_cost_pct, buffers)
+        actions[:, day] = orders
+        account_values[:, day + 1] = cash + holdings @ env.close[day + 1]
+    return env.dates, account_values, actions, placed
+
+
+def load_models(run_dirs):
+    """
+    Returns the models of the latest checkpoints of the given
+    train_configuration runs, on the CPU
+    """
+    models = []
+    for run_dir in run_dirs:
+        checkpoint = latest_checkpoint(run_dir)
+        if checkpoint is None:
+            raise ValueError(f"{run_dir} has no checkpoint")
+        models.append(DDPG.load(os.path.join(checkpoint, MODEL_FILE), device="cpu"))
+    return models
+
+
+def evaluate_models(models, df, env_kwargs):
+    """
+    Backtest many models trained on the same features over df at once.
+
+    Returns a list with the df_account_value of every model (as DRL_prediction
+    returns it), a DataFrame with the backtest_stats of every model, one
+    row per model, and the (M, days - 1, tickers) orders the models placed
+    (see action_replay.replay_actions).
+    """
+    dates, account_values, _, placed = simulate(BatchedActor(models), df, env_kwargs)
+    df_account_values = [
+        pd.DataFrame({"date": dates, "account_value": model_account_values})
+        for model_account_values in account_values
+    ]
+    return df_account_values, perf_stats(account_values), placed
@@ -0,0 +1,66 @@
+import time
+
+from stable_baselines3.common.callbacks import BaseCallback
+
+from checkpoints import save_checkpoint
+
+
+class EnvThroughputCallback(BaseCallback):
+    """
+    Measures data collection throughput in environment steps per second,
+    summed over every copy of a vectorized environment.
+    """
+
+    def __init__(self, verbose=0):
+        super().__init__(verbose)
+        self.env_steps_per_second = None
+
+    def _on_training_start(self):
+        self._start_time = time.time()
+        self._start_timesteps = self.model.num_timesteps
+
+    def _on_step(self):
+        return True
+
+    def _on_training_end(self):
+        elapsed = time.time() - self._start_time
+        env_steps = self.model.num_timesteps - self._start_timesteps
+        self.env_steps_per_second = env_steps / elapsed if elapsed > 0 else float("nan")
+        self.logger.record("time/env_steps_per_second", self.env_steps_per_second)
+        print(f"{env_steps} env steps over {self.training_env.num_envs} envs in {elapsed:.1f}s: "
+              f"{self.env_steps_per_second:.1f} env steps/s")
+
+
+class TrainingCheckpointCallback(BaseCallback):
+    """
+    Checkpoints the run every save_freq environment steps and when training ends.
+
+    Checkpoints are taken at the start of a rollout, after the gradient steps
+    of the previous one, where the model, replay buffer and environments are
+    consistent with each other, so resuming from one is exact.
+    """
+
+    def __init__(self, run_dir, save_freq, verbose=0):
+        super().__init__(verbose)
+        self.run_dir = run_dir
+        self.save_freq = save_freq
+
+    def _on_training_start(self):
+        self._last_save = self.model.num_timesteps
+
+    def _save(self):
+        save_checkpoint(self.model, self.run_dir)
+        self._last_save = self.model.num_timesteps
+        if self.verbose:
+            print(f"Checkpoint saved to {self.run_dir} after {self.model.num_timesteps} steps")
+
+    def _on_rollout_start(self):
+        if self.model.num_timesteps - self._last_save >= self.save_freq:
+            self._save()
+
+    def _on_step(self):
+        return True
+
+    def _on_training_end(self):
+        if self.model.num_timesteps > self._last_save:
+            self._save()
@@ -0,0 +1,98 @@
+import glob
+import hashlib
+import json
+import os
+import pickle
+import shutil
+
+from stable_baselines3 import DDPG
+from stable_baselines3.common.save_util import load_from_zip_file
+
+from utils import get_rng_state, set_rng_state
+
+MODEL_FILE = "model.zip"
+REPLAY_BUFFER_FILE = "replay_buffer.pkl"
+TRAINING_STATE_FILE = "training_state.pkl"
+LATEST_FILE = "latest.json"
+
+
+def run_id(**run_config):
+    """
+    Returns an id that only depends on the given configuration,
+    so rerunning the same configuration finds its own checkpoints.
+    """
+    encoded = json.dumps(run_config, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def latest_checkpoint(run_dir):
+    """
+    Returns the directory of the last complete checkpoint of a run, or None
+    """
+    latest_path = os.path.join(run_dir, LATEST_FILE)
+    if not os.path.exists(latest_path):
+        return None
+    with open(latest_path, "r") as f:
+        return os.path.join(run_dir, json.load(f)["checkpoint"])
+
+
+def save_checkpoint(model, run_dir):
+    """
+    Save the model (with its optimizers), the replay buffer, the random number
+    generator states and the episode state of every training environment.
+
+    The checkpoint is written to its own directory and only becomes the latest
+    once complete, so a run interrupted while saving keeps the previous one.
+    """
+    name = f"step_{model.num_timesteps}"
+    checkpoint_dir = os.path.join(run_dir, name)
+    tmp_dir = checkpoint_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    model.save(os.path.join(tmp_dir, MODEL_FILE))
+    model.save_replay_buffer(os.path.join(tmp_dir, REPLAY_BUFFER_FILE))
+    try:
+        env_states = model.get_env().env_method("get_episode_state")
+    except AttributeError:
+        # environments without get_episode_state (e.g. FinRL's StockTradingEnv)
+        # start a new episode when resumed
+        env_states = None
+    with open(os.path.join(tmp_dir, TRAINING_STATE_FILE), "wb") as f:
+        pickle.dump({"rng": get_rng_state(), "env": env_states}, f)
+
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    os.replace(tmp_dir, checkpoint_dir)
+    with open(os.path.join(run_dir, LATEST_FILE + ".tmp"), "w") as f:
+        json.dump({"checkpoint": name, "num_timesteps": model.num_timesteps}, f)
+    os.replace(os.path.join(run_dir, LATEST_FILE + ".tmp"), os.path.join(run_dir, LATEST_FILE))
+
+    for old_dir in glob.glob(os.path.join(run_dir, "step_*")):
+        if os.path.basename(old_dir) != name:
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def load_checkpoint(checkpoint_dir, env):
+    """
+    Returns the model of a checkpoint attached to env, with the replay buffer,
+    random number generator states and environment episodes restored, so that
+    model.learn(..., reset_num_timesteps=False) continues exactly where the
+    checkpointed run was.
+    """
+    model = DDPG.load(os.path.join(checkpoint_dir, MODEL_FILE), env=env)
+    model.load_replay_buffer(os.path.join(checkpoint_dir, REPLAY_BUFFER_FILE))
+    with open(os.path.join(checkpoint_dir, TRAINING_STATE_FILE), "rb") as f:
+        training_state = pickle.load(f)
+    for index, episode_state in enumerate(training_state["env"] or []):
+        env.env_method("set_episode_state", episode_state, indices=[index])
+    set_rng_state(training_state["rng"])
+    return model
+
+
+def warm_start(model, checkpoint_dir):
+    """
+    Initialize the policy networks of model with the ones of a checkpoint,
+    keeping the optimizers, replay buffer and hyperparameters of model.
+    """
+    _, params, _ = load_from_zip_file(os.path.join(checkpoint_dir, MODEL_FILE), device=model.device)
+    model.set_parameters({"policy": params["policy"]}, exact_match=False, device=model.device)
@@ -8,12 +8,11 @@ from datetime import timedelta
 import csv
 import math
 import itertools
+import tracemalloc
 import random
 import copy
 
-%matplotlib inline
 from finrl.config import config
-from finrl.marketdata.yahoodownloader import YahooDownloader
 from finrl.preprocessing.preprocessors import FeatureEngineer
 from finrl.preprocessing.data import data_split
 from finrl.env.env_stocktrading import StockTradingEnv
@@ -26,32 +25,59 @@ import sys
 import os
 from typing import List
 sys.path.append("../FinRL-Library")
+sys.path.append("../data_preprocessing")
+from rate_curve import load_rate_curve
+from market_data_cache import cached_price_source
+from indicators import add_technical_indicators
+from turbulence import TURBULENCE_WINDOW, calculate_turbulence
+from stock_panel import MARKET_DATA_CACHE_DIR, build_stock_panel, download_stock_data
 
-def get_stock_data(start_date:str, end_date:str, stocks_tradable:List[str], tech_indicator_list:List[str]):
+RISK_FREE_RATES_CSV = "../data_preprocessing/csvs/US_treasury_daily_risk_free_rates.csv"
+RATE_TABLE = "../data_preprocessing/csvs/US_treasury_daily_rate_table.npz"
+
+def get_stock_data(start_date:str, end_date:str, stocks_tradable:List[str], tech_indicator_list:List[str], price_source=None, use_stockstats:bool=False, use_turbulence:bool=False, turbulence_window:int=TURBULENCE_WINDOW):
     """
     start_date and end_date include the whole period from train, validation to test time periods
-    """
-    df = YahooDownloader(start_date=start_date,
-                         end_date=end_date,
-                         ticker_list=stocks_tradable).fetch_data()
 
-    fe = FeatureEngineer(use_technical_indicator=True,
-#                         tech_indicator_list = config.TECHNICAL_INDICATORS_LIST,
-                         tech_indicator_list=tech_indicator_list,
-                         use_turbulence=False,
-                         user_defined_feature=False)
+    Bars come from the local market data cache, which only downloads what it
+    doesn't have yet (see data_preprocessing/market_data_cache.py)
 
-    processed = fe.preprocess_data(df)
+    The technical indicators are computed for all tickers at once
+    (see data_preprocessing/indicators.py), or with FinRL's FeatureEngineer
+    one ticker at a time if use_stockstats
 
-    list_ticker = processed["tic"].unique().tolist()
-    list_date = list(pd.date_range(processed['date'].min(),processed['date'].max()).astype(str))
-    combination = list(itertools.product(list_date,list_ticker))
-
-    processed_full = pd.DataFrame(combination,columns=["date","tic"]).merge(processed,on=["date","tic"],how="left")
-    processed_full = processed_full[processed_full['date'].isin(processed['date'])]
-    processed_full = processed_full.sort_values(['date','tic'])
+    use_turbulence adds the turbulence index of the tickers' returns over the
+    turbulence_window days before every date as a turbulence column, the same
+    for every tic of a date (see data_preprocessing/turbulence.py)
+    """
+    if price_source is None:
+        price_source = cached_price_source(MARKET_DATA_CACHE_DIR)
+    df = download_stock_data(start_date, end_date, stocks_tradable, price_source)
+
+    if use_stockstats:
+        fe = FeatureEngineer(use_technical_indicator=True,
+#                             tech_indicator_list = config.TECHNICAL_INDICATORS_LIST,
+                             tech_indicator_list=tech_indicator_list,
+                             use_turbulence=False,
+                             user_defined_feature=False)
+
+        processed = fe.preprocess_data(df)
+    else:
+        processed = add_technical_indicators(df, tech_indicator_list)
+
+    tracemalloc.start()
+    processed_full = build_stock_panel(processed)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Shape of the (date, tic) panel: {processed_full.shape}, peak memory while building it: {peak / 2**20:.1f} MiB")
+
+    if use_turbulence:
+        # from the bars before the panel fills the missing ones with 0
+        turbulence = calculate_turbulence(processed, turbulence_window)
+        turbulence = pd.Series(turbulence["turbulence"].to_numpy(), index=pd.to_datetime(turbulence["date"]))
+        processed_full["turbulence"] = turbulence.reindex(processed_full["date"]).to_numpy(dtype=np.float32)
 
-    processed_full = processed_full.fillna(0)
+    list_date = list(pd.date_range(processed['date'].min(),processed['date'].max()).astype(str))
     return processed_full, list_date
 
 # train = data_split(processed_full, start_training, end_training)
@@ -63,17 +89,22 @@ def get_date_to_daily_risk_free_rates(start_date:datetime, end_date:datetime, ri
     Returns a dictionary of date to daily risk free rate
     from the start date to the end date (in order)
     """
-    date_to_daily_risk_free_rate = {}
-    with open(
-        risk_free_rates_csv, "r"
-    ) as f:
-        reader = csv.reader(f)
-        next(reader)  # skip header
-        for row in reader:
-            date = datetime.datetime.strptime(row[0], CSV_DATE_FMT)
-            if date >= start_date and date <= end_date:
-                date_to_daily_risk_free_rate[date] = float(row[1])
-    return date_to_daily_risk_free_rate
+    dates, rates = load_rate_curve(risk_free_rates_csv).slice(start_date, end_date)
+    return dict(zip(dates.astype("datetime64[us]").tolist(), rates.tolist()))
+
+
+def get_daily_risk_free_rates(required_dates:List[datetime], risk_free_rates_csv:str, tenor:str=None, rate_table_npz:str=RATE_TABLE):
+    """
+    Returns an array with the daily risk free rate of every date in required_dates.
+
+    Days when the stock market was open but the US Treasury did not publish
+    yield curve rates use the rate of the previous day when rates were published.
+    The rate curve is read once per process, so this is cheap to call per window.
+
+    With a tenor (e.g. "3 Mo"), the rates are the ones of that tenor
+    in the rate table rate_table_npz instead of the CSV's.
+    """
+    return load_rate_curve(risk_free_rates_csv, tenor, rate_table_npz).align(required_dates)
 
 
 def fill_missing_daily_rf_rates(date_to_daily_rf_rate, required_dates:List[datetime]):
@@ -85,14 +116,18 @@ def fill_missing_daily_rf_rates(date_to_daily_rf_rate, required_dates:List[datet
     This is required because there are some days when the stock market
     was open but the US Treasury did not publish yield curve rates.
     Approximate missing data using the previous day when rates were published.
+
+    The mapping is left unmodified.
     """
     daily_risk_free_rates = []
     for date in required_dates:
-        if date not in date_to_daily_rf_rate:
-            missing_date_index = required_dates.index(date)
+        if date in date_to_daily_rf_rate:
+            daily_risk_free_rates.append(date_to_daily_rf_rate[date])
+        elif daily_risk_free_rates:
             # Assume the daily rate exists for the day before
-            date_to_daily_rf_rate[date] = date_to_daily_rf_rate[required_dates[missing_date_index - 1]]
-        daily_risk_free_rates.append(date_to_daily_rf_rate[date])
+            daily_risk_free_rates.append(daily_risk_free_rates[-1])
+        else:
+            raise ValueError(f"No risk free rate for {date} or a previous required date")
     return daily_risk_free_rates
 
 def risk_free_adjusted_sharpe_ratio(daily_returns, daily_rf_rates):
@@ -115,33 +150,3 @@ def risk_free_adjusted_sharpe_ratio(daily_returns, daily_rf_rates):
 #     df_account_value["account_value"].pct_change().fillna(0).values,
 #     daily_risk_free_rates
 # )
-
-def add_sentiments(ndays:int, dataset:dict, df:pd.DataFrame):
-    """
-    dataset: sentiment dataset
-    df: main pandas dataset
-    """
-    ndays = timedelta(days=ndays)
-    sentiment_mean = []
-    sentiment_std = []
-    print("Begin")
-    for e, row in df.iterrows():
-        date_formatted = pd.to_datetime(row["date"], format="%Y-%m-%d")
-        tic = row["tic"]
-        dataset_dates = dataset[tic]["date"].apply(lambda x: x.date())
-        if date_formatted.date() in dataset_dates.values:
-            score = dataset[tic]["sentiment_score"][(dataset_dates >= (date_formatted.date()-ndays)) && (dataset_dates <=  date_formatted.date())]
-            sentiment_mean.append(score.values.mean())
-            sentiment_std.append(score.values.std())
-        
-#         print(f"{tic} mean sentiment {sentiment_mean[-1]}")
-#         print(f"{tic} std sentiment {sentiment_std[-1]}")
-        else:
-            sentiment_mean.append(0)
-            sentiment_std.append(0)
-    print("Done")
-    df["sentiment_mean"] = sentiment_mean
-    df["sentiment_std"] = sentiment_std
-    return df
-
-
@@ -0,0 +1,168 @@
+import glob
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+
+sys.path.append("../data_preprocessing")
+from indicators import add_technical_indicators
+from market_data_cache import cached_price_source
+
+from dataset_store import DATASET_DIR, partition_dir, write_partition_part
+from sentiment_store import SENTIMENT_STATS, SentimentStore
+from stock_panel import MARKET_DATA_CACHE_DIR, build_stock_panel, download_stock_data
+
+# Copies of a shard's rows alive at once while a stage runs: the downloaded
+# bars, the (dates, tickers) arrays of the indicator engine, the panel and
+# the Arrow tables it is written from
+SHARD_COPIES = 4
+BYTES_PER_VALUE = 8
+# date, tic, open, high, low, close, volume and day
+BAR_COLUMNS = 8
+STAGING_FILE = "{}.feather"
+
+# Set once per worker process by _init_worker
+_worker_config = {}
+
+
+def ticker_bytes(start_date, end_date, num_columns):
+    """
+    Estimated peak bytes a ticker adds to a shard from start_date to end_date
+    """
+    num_days = np.busday_count(np.datetime64(start_date, "D"), np.datetime64(end_date, "D"))
+    return int(num_days) * num_columns * BYTES_PER_VALUE * SHARD_COPIES
+
+
+def tickers_per_shard(start_date, end_date, num_columns, memory_budget_mb, num_workers):
+    """
+    Returns the number of tickers a shard can hold so that num_workers shards
+    processed at once stay within memory_budget_mb
+    """
+    budget = memory_budget_mb * 2**20 / num_workers
+    return max(1, int(budget // ticker_bytes(start_date, end_date, num_columns)))
+
+
+def make_shards(tickers, shard_size):
+    tickers = sorted(tickers)
+    return [tickers[i:i + shard_size] for i in range(0, len(tickers), shard_size)]
+
+
+def _init_worker(start_date, end_date, indicators, windows, staging_dir, dataset_dir, price_source):
+    if price_source is None:
+        price_source = cached_price_source(MARKET_DATA_CACHE_DIR)
+    _worker_config.update(
+        start_date=start_date, end_date=end_date, indicators=indicators,
+        windows=windows, staging_dir=staging_dir, dataset_dir=dataset_dir,
+        price_source=price_source,
+    )
+
+
+def _download_shard(shard_index, tickers):
+    """
+    Download stage: bars of the shard's tickers through the market data cache,
+    with their technical indicators. Returns the trading dates of the shard.
+    """
+    config = _worker_config
+    df = download_stock_data(config["start_date"], config["end_date"], tickers, config["price_source"])
+    df = add_technical_indicators(df, config["indicators"])
+    df["date"] = pd.to_datetime(df["date"])
+    df.to_feather(os.path.join(config["staging_dir"], STAGING_FILE.format(shard_index)))
+    return df["date"].unique()
+
+
+def _write_shard(shard_index, trading_dates):
+    """
+    Panel and sentiment stage: the shard's rows on the trading dates of all
+    tickers, with the sentiment aggregates, written as one part per year.
+    Returns the number of rows written.
+    """
+    config = _worker_config
+    staging_path = os.path.join(config["staging_dir"], STAGING_FILE.format(shard_index))
+    processed = pd.read_feather(staging_path)
+    panel = build_stock_panel(processed, trading_dates)
+    del processed
+    panel = SentimentStore(config["windows"]).add_columns(panel, list(panel["tic"].cat.categories))
+    for year, part in panel.groupby(panel["date"].dt.year):
+        write_partition_part(part, config["dataset_dir"], year, f"shard-{shard_index:05d}")
+    os.remove(staging_path)
+    return len(panel)
+
+
+def compact_partition(dataset_dir, year):
+    """
+    Merge the shard parts of a year into one part sorted by date and tic,
+    the layout write_dataset produces. Only one year is in memory at a time.
+    """
+    paths = sorted(glob.glob(os.path.join(partition_dir(dataset_dir, year), "shard-*.arrow")))
+    part = pd.concat(
+        [pa.ipc.open_file(pa.memory_map(path, "r")).read_all().to_pandas() for path in paths],
+        ignore_index=True,
+    )
+    part["tic"] = part["tic"].astype(str).astype(pd.CategoricalDtype(sorted(part["tic"].unique())))
+    write_partition_part(part, dataset_dir, year, "part-00000")
+    for path in paths:
+        os.remove(path)
+
+
+def build_dataset_sharded(
+    start_date,
+    end_date,
+    tickers,
+    indicators,
+    windows,
+    dataset_dir=DATASET_DIR,
+    memory_budget_mb=8192,
+    num_workers=None,
+    price_source=None,
+    ):
+    """
+    Same dataset as get_stock_data, SentimentStore.add_columns and write_dataset
+    on the full frame, built in shards of tickers on a process pool so the
+    whole universe is never in memory at once:
+
+    1. every shard downloads its bars and computes its indicators,
+    2. every shard builds its panel on the trading dates of all shards,
+       adds its sentiment aggregates and writes one part per year,
+    3. the parts of every year are merged into one.
+
+    The shard size keeps num_workers shards within memory_budget_mb. The new
+    dataset replaces the old one once complete.
+
+    price_source: where the bars come from, as in get_stock_data (default:
+    the local market data cache), it is pickled to every worker
+    """
+    num_workers = num_workers or os.cpu_count()
+    num_columns = BAR_COLUMNS + len(indicators) + len(SENTIMENT_STATS) * len(set(windows))
+    shard_size = tickers_per_shard(start_date, end_date, num_columns, memory_budget_mb, num_workers)
+    shards = make_shards(tickers, shard_size)
+    num_workers = min(num_workers, len(shards))
+    print(f"{len(tickers)} tickers in {len(shards)} shards of up to {shard_size} tickers on {num_workers} workers")
+
+    build_dir = dataset_dir.rstrip("/") + ".build"
+    staging_dir = os.path.join(build_dir, "staging")
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(start_date, end_date, indicators, windows, staging_dir, build_dir, price_source),
+    ) as executor:
+        shard_dates = list(executor.map(_download_shard, range(len(shards)), shards))
+        trading_dates = np.unique(np.concatenate(shard_dates))
+        num_rows = sum(executor.map(_write_shard, range(len(shards)), [trading_dates] * len(shards)))
+    shutil.rmtree(staging_dir)
+
+    for year in sorted({pd.Timestamp(date).year for date in trading_dates}):
+        compact_partition(build_dir, year)
+
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    os.replace(build_dir, dataset_dir)
+    print(f"{num_rows} rows of {len(trading_dates)} trading days saved to {dataset_dir}")
@@ -0,0 +1,130 @@
+import glob
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc
+
+DATASET_DIR = "./data/dataset"
+
+
+def dataset_splits(configs):
+    """
+    Returns a dictionary of split name to its (start date, end date) range,
+    end exclusive like data_split, from the train, validation and test
+    sections of the config. train_for_test spans train and validation.
+    """
+    splits = {
+        name: (configs[name]["start_date"], configs[name]["end_date"])
+        for name in ["train", "validation", "test"]
+    }
+    splits["train_for_test"] = (configs["train"]["start_date"], configs["validation"]["end_date"])
+    return splits
+
+
+def partition_dir(dataset_dir, year):
+    return os.path.join(dataset_dir, f"year={year}")
+
+
+def write_partition_part(df, dataset_dir, year, part_name):
+    """
+    Write the rows of one year as an Arrow IPC file of its partition,
+    sorted by date and tic so reads can slice it by date.
+    Returns the path of the file.
+    """
+    os.makedirs(partition_dir(dataset_dir, year), exist_ok=True)
+    path = os.path.join(partition_dir(dataset_dir, year), f"{part_name}.arrow")
+    table = pa.Table.from_pandas(
+        df.sort_values(["date", "tic"], kind="mergesort"), preserve_index=False
+    ).combine_chunks()
+    # uncompressed so the file can be memory mapped without decoding it
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    return path
+
+
+def write_dataset(df, dataset_dir=DATASET_DIR):
+    """
+    Write df (one row per (date, tic) with a datetime64 date column) once,
+    partitioned by year:
+        dataset_dir/year=YYYY/part-00000.arrow
+    replacing whatever the dataset held before.
+    """
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    for year, part in df.groupby(df["date"].dt.year):
+        write_partition_part(part, dataset_dir, year, "part-00000")
+
+
+class DatasetStore:
+    """
+    Read side of the dataset written by write_dataset.
+
+    Part files are memory mapped and sliced by date, so reading a split only
+    touches the partitions of its years and the requested columns, and the
+    returned tables are views of the mapped files rather than copies.
+    """
+
+    def __init__(self, dataset_dir=DATASET_DIR, splits=None):
+        self.dataset_dir = dataset_dir
+        self.splits = splits or {}
+        self._tables = {}
+
+    def years(self):
+        return sorted(
+            int(os.path.basename(path).split("=")[1])
+            for path in glob.glob(os.path.join(self.dataset_dir, "year=*"))
+        )
+
+    def _part_tables(self, year):
+        tables = []
+        for path in sorted(glob.glob(os.path.join(partition_dir(self.dataset_dir, year), "part-*.arrow"))):
+            if path not in self._tables:
+                self._tables[path] = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+            tables.append(self._tables[path])
+        return tables
+
+    def read_table(self, start_date, end_date, columns=None):
+        """
+        Returns an Arrow table of the rows from start_date (inclusive) to
+        end_date (exclusive) holding only the given columns (all by default).
+        """
+        start, end = np.datetime64(start_date, "D"), np.datetime64(end_date, "D")
+        years = [year for year in self.years() if start.astype(object).year <= year <= (end - 1).astype(object).year]
+        slices = []
+        for year in years:
+            for table in self._part_tables(year):
+                # part files are sorted by date
+                dates = table.column("date").to_numpy()
+                lo, hi = np.searchsorted(dates, start, side="left"), np.searchsorted(dates, end, side="left")
+                if hi > lo:
+                    part = table.slice(lo, hi - lo)
+                    slices.append(part.select(columns) if columns is not None else part)
+        if not slices:
+            raise ValueError(f"No rows from {start_date} to {end_date} in {self.dataset_dir}")
+        return pa.concat_tables(slices)
+
+    def read(self, start_date, end_date, columns=None):
+        """
+        Same as data_split(df, start_date, end_date) on the full frame:
+        rows sorted by date and tic, indexed by the day number.
+        """
+        if columns is not None:
+            columns = ["date", "tic"] + [column for column in columns if column not in ("date", "tic")]
+        data = self.read_table(start_date, end_date, columns).to_pandas()
+        # parts can come with different dictionaries, so restore the alphabetical tic order
+        data["tic"] = data["tic"].astype(str).astype(pd.CategoricalDtype(sorted(data["tic"].unique())))
+        data = data.sort_values(["date", "tic"], ignore_index=True)
+        data.index = data.date.factorize()[0]
+        return data
+
+    def split(self, name, columns=None):
+        """
+        Returns the rows of a named split, see read.
+        """
+        start_date, end_date = self.splits[name]
+        return self.read(start_date, end_date, columns)
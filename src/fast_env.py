@@ -0,0 +1,388 @@
+import copy
+import numpy as np
+import pandas as pd
+import gym
+from gym import spaces
+from gym.utils import seeding
+from stable_baselines3.common.vec_env import DummyVecEnv
+
+
+def _fill_buys_in_order(cash, holdings_shape, prices, orders, bought, cost, rows, buy_cost_pct):
+    """
+    Fill the buy orders of the given rows largest first, each limited by the
+    cash left after the previous ones, like StockTradingEnv._buy_stock.
+    Updates cash, bought and cost in place.
+    """
+    buy_cost_pct = np.broadcast_to(buy_cost_pct, cash.shape)
+    if len(rows) == 1:
+        # a single account is faster with plain floats than with per-rank array ops
+        row = rows[0]
+        row_prices = prices[row]
+        row_orders = orders[row]
+        remaining = float(cash[row])
+        cost_pct = float(buy_cost_pct[row])
+        buy_index = np.argsort(row_orders)[::-1][:np.count_nonzero(row_orders > 0)]
+        for index in buy_index.tolist():
+            price = float(row_prices[index])
+            if price > 0:
+                num_shares = min(remaining // price, int(row_orders[index]))
+                remaining -= price * num_shares * (1 + cost_pct)
+                cost[row] += price * num_shares * cost_pct
+                bought[row, index] = num_shares
+        cash[row] = remaining
+        return
+
+    cost_pct = buy_cost_pct[rows]
+    buy_order = np.argsort(orders[rows], axis=1)[:, ::-1]
+    for rank in range(holdings_shape[1]):
+        index = buy_order[:, rank]
+        wanted = orders[rows, index]
+        if not (wanted > 0).any():
+            break
+        price = prices[rows, index]
+        active = (wanted > 0) & (price > 0)
+        num_shares = np.where(active, np.minimum(cash[rows] // np.where(active, price, 1), wanted), 0)
+        cash[rows] -= price * num_shares * (1 + cost_pct)
+        cost[rows] += price * num_shares * cost_pct
+        bought[rows, index] = num_shares
+
+
+class OrderBuffers:
+    """
+    Work arrays of execute_orders for a batch of B accounts and N tickers,
+    allocated once so that executing each day's orders allocates nothing
+    """
+
+    def __init__(self, num_accounts, num_tickers):
+        shape = (num_accounts, num_tickers)
+        self.tradable = np.empty(shape, dtype=bool)
+        self.traded = np.empty(shape, dtype=bool)
+        self.sold = np.empty(shape)
+        self.bought = np.empty(shape)
+        self.sell_value = np.empty(num_accounts)
+        self.buy_value = np.empty(num_accounts)
+        self.amount = np.empty(num_accounts)
+        self.constrained = np.empty(num_accounts, dtype=bool)
+        self.cost = np.empty(num_accounts)
+        self.trades = np.empty(num_accounts, dtype=np.int64)
+        self.buy_trades = np.empty(num_accounts, dtype=np.int64)
+
+
+def execute_orders(cash, holdings, prices, orders, buy_cost_pct, sell_cost_pct, buffers=None):
+    """
+    Execute integer share orders for a batch of B accounts with the same
+    rules as FinRL's StockTradingEnv, updating cash and holdings in place.
+
+    cash: (B,) float64 cash balances
+    holdings: (B, N) float64 share counts
+    prices: (N,) or (B, N) prices the orders execute at
+    orders: (B, N) integer share orders, negative to sell. Overwritten with
+            the number of shares actually traded (negative for sells)
+    buy_cost_pct, sell_cost_pct: scalars or (B,) arrays
+    buffers: OrderBuffers of the batch to work in (new ones if None). With
+             the same buffers every day, executing the orders allocates
+             nothing, except for the accounts whose buys exceed their cash,
+             which are filled one order at a time
+
+    Sells are limited by the shares held and buys by the cash available, with
+    buys filled in descending order of size like StockTradingEnv. Stocks with
+    a price of 0 (missing data) are never traded.
+
+    Returns the (B,) transaction costs paid and the (B,) number of trades,
+    held in buffers until the next call.
+    """
+    if buffers is None:
+        buffers = OrderBuffers(*holdings.shape)
+    prices = np.broadcast_to(prices, holdings.shape)
+    buy_cost_pct = np.asarray(buy_cost_pct, dtype=np.float64)
+    sell_cost_pct = np.asarray(sell_cost_pct, dtype=np.float64)
+    tradable = np.greater(prices, 0, out=buffers.tradable)
+
+    # Sells are independent of each other, so they are done all at once.
+    # min(-order, held) is positive exactly for the sells of held shares
+    sold = np.negative(orders, out=buffers.sold)
+    np.minimum(sold, holdings, out=sold)
+    np.maximum(sold, 0, out=sold)
+    sold *= tradable
+    sell_value = np.einsum("bn,bn->b", prices, sold, out=buffers.sell_value)
+    cash += np.multiply(sell_value, 1 - sell_cost_pct, out=buffers.amount)
+    holdings -= sold
+    cost = np.multiply(sell_value, sell_cost_pct, out=buffers.cost)
+
+    # Buys only interact through the cash they share. Accounts that can afford
+    # all of their buys are filled at once, the others fill them largest first
+    bought = np.maximum(orders, 0, out=buffers.bought)
+    bought *= tradable
+    trades = np.sum(np.greater(sold, 0, out=buffers.traded), axis=1, out=buffers.trades)
+    trades += np.sum(np.greater(bought, 0, out=buffers.traded), axis=1, out=buffers.buy_trades)
+    buy_value = np.einsum("bn,bn->b", prices, bought, out=buffers.buy_value)
+    np.multiply(buy_value, 1 + buy_cost_pct, out=buffers.amount)
+    if np.greater(buffers.amount, cash, out=buffers.constrained).any():
+        constrained = np.flatnonzero(buffers.constrained)
+        bought[constrained] = 0
+        buy_value[constrained] = 0
+        _fill_buys_in_order(cash, holdings.shape, prices, orders, bought, cost, constrained, buy_cost_pct)
+
+    cash -= np.multiply(buy_value, 1 + buy_cost_pct, out=buffers.amount)
+    holdings += bought
+    cost += np.multiply(buy_value, buy_cost_pct, out=buffers.amount)
+
+    np.subtract(bought, sold, out=orders, casting="unsafe")
+    return cost, trades
+
+
+class FastStockTradingEnv(gym.Env):
+    """
+    Drop-in replacement for FinRL's StockTradingEnv with the same constructor,
+    state layout, action, reward and transaction cost semantics.
+
+    The market data is converted once into contiguous arrays:
+        close:  float64 (days, tickers) prices used for accounting
+        tensor: float32 (days, 1 + features, tickers) close prices and
+                tech_indicator_list values, laid out in state order
+    so stepping only copies array slices into a preallocated state buffer
+    and executes the orders in preallocated OrderBuffers, instead of slicing
+    the DataFrame every day.
+
+    With initial=False, every episode continues the cash and holdings of
+    previous_state (a state of this layout) instead of starting from
+    initial_amount in cash, like StockTradingEnv.
+
+    With a turbulence_threshold, df needs a turbulence column (see
+    data_preprocessing/turbulence.py). On the days whose turbulence is at or
+    above the threshold every holding is sold and nothing is bought, whatever
+    the action, like StockTradingEnv (which starts episodes at a turbulence of 0).
+    """
+    metadata = {'render.modes': ['human']}
+
+    def __init__(self,
+                 df,
+                 stock_dim,
+                 hmax,
+                 initial_amount,
+                 buy_cost_pct,
+                 sell_cost_pct,
+                 reward_scaling,
+                 state_space,
+                 action_space,
+                 tech_indicator_list,
+                 turbulence_threshold=None,
+                 make_plots=False,
+                 print_verbosity=10,
+                 day=0,
+                 initial=True,
+                 previous_state=[],
+                 model_name='',
+                 mode='',
+                 iteration=''):
+        if not initial and len(previous_state) < 2 * stock_dim + 1:
+            raise ValueError("initial=False needs the previous_state to continue from")
+
+        self.df = df
+        self.stock_dim = stock_dim
+        self.hmax = hmax
+        self.initial_amount = initial_amount
+        self.buy_cost_pct = buy_cost_pct
+        self.sell_cost_pct = sell_cost_pct
+        self.reward_scaling = reward_scaling
+        self.turbulence_threshold = turbulence_threshold
+        self.initial = initial
+        self.previous_state = previous_state
+        self.state_space = state_space
+        self.tech_indicator_list = tech_indicator_list
+        self.print_verbosity = print_verbosity
+        self.model_name = model_name
+        self.mode = mode
+        self.iteration = iteration
+        self.action_space = spaces.Box(low=-1, high=1, shape=(action_space,))
+        self.observation_space = spaces.Box(low=-np.inf, high=np.inf, shape=(state_space,))
+
+        data = df.sort_values(["date", "tic"], kind="mergesort")
+        self.dates = data.date.unique()
+        self.tickers = data.tic.unique()
+        self.num_days = len(self.dates)
+        if len(data) != self.num_days * stock_dim:
+            raise ValueError("df must have exactly one row per (date, tic)")
+        columns = ["close"] + list(tech_indicator_list)
+        values = data[columns].to_numpy(dtype=np.float64).reshape(self.num_days, stock_dim, len(columns))
+        self.close = np.ascontiguousarray(values[:, :, 0])
+        self.tensor = np.ascontiguousarray(values.transpose(0, 2, 1), dtype=np.float32)
+        if turbulence_threshold is not None:
+            if "turbulence" not in data.columns:
+                raise ValueError("df must have a turbulence column to use turbulence_threshold")
+            # the same for every tic of a date, StockTradingEnv reads the first one
+            self.turbulence_values = data["turbulence"].to_numpy(dtype=np.float64).reshape(self.num_days, stock_dim)[:, 0]
+
+        self.state = np.zeros(state_space, dtype=np.float32)
+        self._cash = np.zeros(1)
+        self._holdings = np.zeros((1, stock_dim))
+        self._orders = np.zeros((1, stock_dim), dtype=np.int64)
+        self._order_buffers = OrderBuffers(1, stock_dim)
+        self.asset_memory = np.zeros(self.num_days)
+        self.rewards_memory = np.zeros(max(self.num_days - 1, 0))
+        self.actions_memory = np.zeros((max(self.num_days - 1, 0), stock_dim), dtype=np.int64)
+
+        # day is where the first episode starts, episodes after one has been
+        # stepped start at day 0. Parallel copies use it to start from
+        # different offsets of the training window
+        if not 0 <= day < max(self.num_days - 1, 1):
+            raise ValueError(f"day must be in [0, {self.num_days - 1}), got {day}")
+        self.episode = 0
+        self.start_day = day
+        self._reset_account()
+        self.seed()
+
+    def _reset_account(self):
+        self.day = self.start_day
+        if self.initial:
+            self._cash[0] = self.initial_amount
+            self._holdings[:] = 0
+        else:
+            # the cash and holdings of previous_state, e.g. the last state of
+            # the previous trading window, valued at the first close of this one
+            self._cash[0] = self.previous_state[0]
+            self._holdings[0] = self.previous_state[self.stock_dim + 1:2 * self.stock_dim + 1]
+        self.asset_memory[self.day] = self._total_asset()
+        self.reward = 0
+        self.turbulence = 0
+        self.cost = 0
+        self.trades = 0
+        self.terminal = False
+        self._update_state()
+
+    def _update_state(self):
+        n = self.stock_dim
+        self.state[0] = self._cash[0]
+        self.state[1:n + 1] = self.tensor[self.day, 0]
+        self.state[n + 1:2 * n + 1] = self._holdings[0]
+        self.state[2 * n + 1:] = self.tensor[self.day, 1:].ravel()
+
+    def _total_asset(self):
+        return self._cash[0] + self.close[self.day] @ self._holdings[0]
+
+    def step(self, actions):
+        self.terminal = self.day >= self.num_days - 1
+        if self.terminal:
+            if self.episode % self.print_verbosity == 0:
+                self._print_episode_stats()
+            # DummyVecEnv keeps the terminal observation after reset, so it can't share the buffer
+            return self.state.copy(), self.reward, self.terminal, {}
+
+        # same float32 scaling and truncation towards zero as StockTradingEnv
+        orders = self._orders[0]
+        np.multiply(actions, self.hmax, out=orders, casting="unsafe")
+        if self.turbulence_threshold is not None and self.turbulence >= self.turbulence_threshold:
+            np.maximum(self._holdings[0], 0, out=orders, casting="unsafe")
+            np.negative(orders, out=orders)
+        begin_total_asset = self._total_asset()
+        cost, trades = execute_orders(
+            self._cash, self._holdings, self.close[self.day], self._orders,
+            self.buy_cost_pct, self.sell_cost_pct, self._order_buffers
+        )
+        self.cost += cost[0]
+        self.trades += int(trades[0])
+        self.actions_memory[self.day] = self._orders[0]
+
+        self.day += 1
+        if self.turbulence_threshold is not None:
+            self.turbulence = self.turbulence_values[self.day]
+        self._update_state()
+        end_total_asset = self._total_asset()
+        self.asset_memory[self.day] = end_total_asset
+        self.reward = end_total_asset - begin_total_asset
+        self.rewards_memory[self.day - 1] = self.reward
+        self.reward = self.reward * self.reward_scaling
+        return self.state, self.reward, self.terminal, {}
+
+    def _print_episode_stats(self):
+        asset_memory = self.asset_memory[self.start_day:self.day + 1]
+        end_total_asset = asset_memory[-1]
+        daily_return = pd.Series(asset_memory).pct_change(1)
+        print(f"day: {self.day}, episode: {self.episode}")
+        print(f"begin_total_asset: {asset_memory[0]:0.2f}")
+        print(f"end_total_asset: {end_total_asset:0.2f}")
+        print(f"total_reward: {end_total_asset - self.initial_amount:0.2f}")
+        print(f"total_cost: {self.cost:0.2f}")
+        print(f"total_trades: {self.trades}")
+        if daily_return.std() != 0:
+            print(f"Sharpe: {(252**0.5) * daily_return.mean() / daily_return.std():0.3f}")
+        print("=================================")
+
+    def reset(self):
+        if self.day > self.start_day:
+            self.start_day = 0
+        self._reset_account()
+        self.episode += 1
+        return self.state
+
+    def get_episode_state(self):
+        """
+        Returns a copy of everything stepping changes, so a checkpointed
+        training run can continue the episode it was in.
+        """
+        return {
+            "day": self.day,
+            "start_day": self.start_day,
+            "episode": self.episode,
+            "cash": self._cash.copy(),
+            "holdings": self._holdings.copy(),
+            "asset_memory": self.asset_memory.copy(),
+            "rewards_memory": self.rewards_memory.copy(),
+            "actions_memory": self.actions_memory.copy(),
+            "reward": self.reward,
+            "turbulence": self.turbulence,
+            "cost": self.cost,
+            "trades": self.trades,
+            "terminal": self.terminal,
+            "np_random": copy.deepcopy(self.np_random),
+        }
+
+    def set_episode_state(self, episode_state):
+        self.day = episode_state["day"]
+        self.start_day = episode_state["start_day"]
+        self.episode = episode_state["episode"]
+        self._cash[:] = episode_state["cash"]
+        self._holdings[:] = episode_state["holdings"]
+        self.asset_memory[:] = episode_state["asset_memory"]
+        self.rewards_memory[:] = episode_state["rewards_memory"]
+        self.actions_memory[:] = episode_state["actions_memory"]
+        self.reward = episode_state["reward"]
+        self.turbulence = episode_state.get("turbulence", 0)
+        self.cost = episode_state["cost"]
+        self.trades = episode_state["trades"]
+        self.terminal = episode_state["terminal"]
+        self.np_random = copy.deepcopy(episode_state["np_random"])
+        self._update_state()
+
+    def risk_off_days(self):
+        """
+        (days,) True on the days an episode started at day 0 sells every
+        holding and buys nothing, all False without a turbulence_threshold
+        """
+        if self.turbulence_threshold is None:
+            return np.zeros(self.num_days, dtype=bool)
+        risk_off = self.turbulence_values >= self.turbulence_threshold
+        risk_off[0] = False
+        return risk_off
+
+    def render(self, mode='human', close=False):
+        return self.state
+
+    def save_asset_memory(self):
+        days = slice(self.start_day, self.day + 1)
+        return pd.DataFrame({'date': self.dates[days], 'account_value': self.asset_memory[days]})
+
+    def save_action_memory(self):
+        days = slice(self.start_day, self.day)
+        df_actions = pd.DataFrame(self.actions_memory[days], columns=self.tickers)
+        df_actions.index = pd.Index(self.dates[days], name='date')
+        return df_actions
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def get_sb_env(self):
+        e = DummyVecEnv([lambda: self])
+        obs = e.reset()
+        return e, obs
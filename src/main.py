@@ -11,8 +11,9 @@ import itertools
 import random
 import copy
 import time
+import json
+import yaml
 
-%matplotlib inline
 from finrl.config import config
 from finrl.marketdata.yahoodownloader import YahooDownloader
 from finrl.preprocessing.preprocessors import FeatureEngineer
@@ -26,9 +27,23 @@ from pprint import pprint
 import sys
 import os
 sys.path.append("../FinRL-Library")
+sys.path.append("../benchmark_calculation")
 
 from utils import *
 from dataloader import *
+from sweep import cell_id, run_successive_halving, run_sweep, sweep_cells
+from dataset_store import DatasetStore, dataset_splits, write_dataset
+from dataset_pipeline import build_dataset_sharded
+from batch_evaluation import evaluate_models, load_models
+from action_replay import scenario_perf_stats
+from checkpoints import latest_checkpoint
+from sentiment_store import SENTIMENTS_DIR, SentimentStore, read_sentiments, sentiment_files, use_sentiment_window
+from bootstrap import sharpe_difference_tests
+from buy_and_hold import get_buy_and_hold_share_allocation
+from portfolio_engine import holdings_daily_returns
+from model_setting import configuration_run_id, make_env_kwargs
+from turbulence import risk_off_threshold
+from paper_trading import PaperTrader, frame_feed, model_policy
 
 if not os.path.exists("./" + config.DATA_SAVE_DIR):
     os.makedirs("./" + config.DATA_SAVE_DIR)
@@ -39,48 +54,42 @@ if not os.path.exists("./" + config.TENSORBOARD_LOG_DIR):
 if not os.path.exists("./" + config.RESULTS_DIR):
     os.makedirs("./" + config.RESULTS_DIR)
 
-configs = yaml.load(open("./conf/config.yml").read(), Loader=yaml.Loader)
+configs = yaml.load(open("./config.yaml").read(), Loader=yaml.Loader)["stocks"]
 
 def load_and_save():
     stocks_tradable = configs["stocks_tradable"]
 
-    dataset = dict()
-    for root, dirs, files in os.walk("./data/sentiments", topdown=False):
-        for name in files:
-            if name.split("_")[0] in stocks_tradable:
-            dataset[name.split("_")[0]] = pd.read_csv(os.path.join(root, name), index_col=0).reset_index(drop=True)
-            dataset[name.split("_")[0]]["date"] = pd.to_datetime(dataset[name.split("_")[0]]["date"], format="%Y-%m-%d")
-
-    df = get_stock_data(
-    i    configs["train"]["start_date"], configs["test"]["end_date"], configs["stocks_tradable"]
+    if configs["pipeline"]["enabled"]:
+        if configs["turbulence"]["enabled"]:
+            raise ValueError("The sharded pipeline does not compute the turbulence index, disable pipeline or turbulence")
+        build_dataset_sharded(
+            configs["train"]["start_date"], configs["test"]["end_date"], stocks_tradable,
+            configs["indicators"], configs["sentiments"]["windows"], configs["dataset"]["dir"],
+            configs["pipeline"]["memory_budget_mb"], configs["pipeline"]["workers"]
+        )
+        return
 
+    df, _ = get_stock_data(
+        configs["train"]["start_date"], configs["test"]["end_date"], configs["stocks_tradable"],
+        configs["indicators"], use_turbulence=configs["turbulence"]["enabled"],
+        turbulence_window=configs["turbulence"]["window"]
     )
 
-    df = add_sentiments(configs["sentiments"]["days"], dataset, df)
-
-    train = data_split(df, cofings["train"]["start_date"], configs["train"]["end_date"])
-    validation = data_split(df, cofings["validation"]["start_date"], configs["validation"]["end_date"])
-    train_for_test = data_split(df, configs["train"]["start_date"], configs["validation"]["end_date"])
-    test = data_split(df, configs["test"]["start_date"], configs["test"]["end_date"])
-
-    testing_days = pd.Series(test.date.unique())
-
-    train.to_csv("./data/train_data.csv", index=False)
-    validation.to_csv("./data/validation_data.csv", index=False)
-    train_for_test.to_csv("./data/train_for_test.csv", index=False)
-    test.to_csv("./data/test_data.csv", index=False)
-    testing_days.to_csv("./data/testing_days.csv", index=False)
+    # aggregates of every window are stored, the window used is picked in train and test
+    df = SentimentStore(configs["sentiments"]["windows"]).add_columns(df, stocks_tradable)
 
-    print("train, validation, train_for_test, test files saved")
+    write_dataset(df, configs["dataset"]["dir"])
+    print(f"dataset saved to {configs['dataset']['dir']}")
     
-def train():
-    train = pd.read_csv("./data/train_data.csv")
-    validation = pd.read_csv("./data/validation_data.csv")
+def grid_cells():
+    """
+    Returns the configurations of the hyperparameter grid
+    """
     features = [
         ["open", "high", "low", "close", "volume"],
         ["open", "high", "low", "close", "volume"] + ["sentiment_mean", "sentiment_std"],
-        config.TECHNICAL_INDICATORS,
-        config.TECHNICAL_INDICATORS + ["sentiment_mean", "sentiment_std"]
+        configs["indicators"],
+        configs["indicators"] + ["sentiment_mean", "sentiment_std"]
     ]
 
     model_names = [
@@ -95,40 +104,163 @@ def train():
 
     repetition = 3
 
-    for model_name, feature_set in zip(features, model_names):
-        for rep in range(repetition):
-            perf_results = dict()
-            for batch_size in batch_sizes:
-                for lr in learning_rates:
-                    
-                    ctime = time.time()
-                    perf_stats_all, _ = train_configuration(
-                        f"{model_name}_{rep}",
-                        train,
-                        validation,
-                        feature_set,
-                        batch_sizes,
-                        learning_rates,
-                        42
-                    )
-
-
-                    perf_results[f"result_{batch_size}_{lr}"] = perf_stats_all.to_json()
-
-            open(f"{model_name}_{rep}.json","w").write(json.dumps(perf_results)) 
-            print(f"Results saved to {save_fname}.json") 
-
-            print(f"Time taken {(time.time() - ctime)/60}")
+    return sweep_cells(
+        model_names, features, repetition, batch_sizes, learning_rates, configs["sweep"]["seed"],
+        turbulence_threshold()
+    )
+
+def turbulence_threshold():
+    """
+    Returns the turbulence the environments go risk-off at, the configured
+    quantile of the turbulence of the training dates (None if disabled)
+    """
+    if not configs["turbulence"]["enabled"]:
+        return None
+    store = DatasetStore(configs["dataset"]["dir"], dataset_splits(configs))
+    return risk_off_threshold(store.split("train", columns=["date", "turbulence"]), configs["turbulence"]["threshold_quantile"])
+
+def trained_run_dir(cell, grid_train):
+    """
+    Returns the directory the model of a grid configuration is checkpointed in
+    """
+    if configs["successive_halving"]["enabled"]:
+        return "./" + config.RESULTS_DIR + "/successive_halving/checkpoints/" + cell_id(cell)
+    env_kwargs = make_env_kwargs(
+        grid_train, cell["features"], f"{cell['model_name']}_{cell['rep']}", cell.get("turbulence_threshold")
+    )
+    run = configuration_run_id(grid_train, env_kwargs, cell["batch_size"], cell["lr"], cell["seed"])
+    return "./" + config.TRAINED_MODEL_DIR + "/" + run
+
+def train():
+    store = DatasetStore(configs["dataset"]["dir"], dataset_splits(configs))
+    train = use_sentiment_window(store.split("train"), configs["sentiments"]["days"])
+    validation = use_sentiment_window(store.split("validation"), configs["sentiments"]["days"])
+    cells = grid_cells()
+    ctime = time.time()
+    if configs["successive_halving"]["enabled"]:
+        results = run_successive_halving(
+            cells,
+            train,
+            validation,
+            "./" + config.RESULTS_DIR + "/successive_halving",
+            configs["successive_halving"]["min_timesteps"],
+            configs["successive_halving"]["eta"],
+            num_workers=configs["sweep"]["workers"],
+        )
+    else:
+        results = run_sweep(
+            cells,
+            train,
+            validation,
+            "./" + config.RESULTS_DIR + "/sweep",
+            num_workers=configs["sweep"]["workers"],
+        )
+
+    perf_results = dict()
+    for cell in cells:
+        save_fname = f"{cell['model_name']}_{cell['rep']}"
+        perf_results.setdefault(save_fname, dict())
+        if cell_id(cell) in results:
+            perf_results[save_fname][f"result_{cell['batch_size']}_{cell['lr']}"] = results[cell_id(cell)]["perf_stats"]
+
+    for save_fname, results_of_rep in perf_results.items():
+        open(f"{save_fname}.json","w").write(json.dumps(results_of_rep))
+        print(f"Results saved to {save_fname}.json")
+
+    print(f"Time taken {(time.time() - ctime)/60}")
     
 
 def test():
-    daily_risk_free_rates = fill_missing_daily_rf_rates(
-        date_to_daily_risk_free_rate, [datetime.datetime.strptime(date, "%Y-%m-%d") for date in dates["0"]]
-    )
+    store = DatasetStore(configs["dataset"]["dir"], dataset_splits(configs))
+    dates = store.split("test", columns=["date"]).date.unique()
+    daily_risk_free_rates = get_daily_risk_free_rates(dates, RISK_FREE_RATES_CSV)
     
-    train = pd.read_csv("./data/train_for_test.csv")
-    test = pd.read_csv("./data/test_data.csv")
+    train = use_sentiment_window(store.split("train_for_test"), configs["sentiments"]["days"])
+    test = use_sentiment_window(store.split("test"), configs["sentiments"]["days"])
+
+    # backtest every trained configuration of the grid on the test period,
+    # with one batched rollout per feature set
+    grid_train = use_sentiment_window(store.split("train"), configs["sentiments"]["days"])
+    run_dirs = dict()
+    for cell in grid_cells():
+        run_dir = trained_run_dir(cell, grid_train)
+        if latest_checkpoint(run_dir) is not None:
+            run_dirs.setdefault(cell["model_name"], []).append((cell, run_dir))
+
+    ctime = time.time()
+    # the same backtests under other transaction costs and hmax, replaying the orders of the models
+    cost_scenarios = [
+        {"buy_cost_pct": cost_pct, "sell_cost_pct": cost_pct, "hmax": hmax}
+        for cost_pct in configs["cost_scenarios"]["cost_pct"] for hmax in configs["cost_scenarios"]["hmax"]
+    ]
+    test_stats = []
+    scenario_stats = []
+    account_values = []
+    for model_name, runs in run_dirs.items():
+        env_kwargs = make_env_kwargs(test, runs[0][0]["features"], model_name, runs[0][0].get("turbulence_threshold"))
+        df_account_values, stats, orders = evaluate_models(load_models([run_dir for _, run_dir in runs]), test, env_kwargs)
+        stats.index = [cell_id(cell) for cell, _ in runs]
+        test_stats.append(stats)
+        scenario_stats.append(scenario_perf_stats(test, env_kwargs, orders, cost_scenarios, stats.index))
+        account_values.extend(df_account_value["account_value"].to_numpy() for df_account_value in df_account_values)
+    test_stats = pd.concat(test_stats)
+    test_stats.to_csv("./" + config.RESULTS_DIR + "/test_perf_stats.csv")
+    pd.concat(scenario_stats).to_csv("./" + config.RESULTS_DIR + "/test_cost_scenarios.csv")
+    print(f"{len(test_stats)} configurations backtested under {len(cost_scenarios)} cost scenarios in {(time.time() - ctime)/60} minutes")
+
+    # are the sharpe ratios distinguishable from buying and holding the test stocks?
+    closes = test.pivot(index="date", columns="tic", values="close")
+    bnh_allocations = get_buy_and_hold_share_allocation({tic: closes[tic].tolist() for tic in closes.columns})
+    bnh_daily_returns = holdings_daily_returns(closes.to_numpy(), [[bnh_allocations[tic] for tic in closes.columns]])
+    account_values = np.array(account_values)
+    daily_returns = np.vstack([account_values[:, 1:] / account_values[:, :-1] - 1, bnh_daily_returns])
+    sharpe_tests = sharpe_difference_tests(
+        daily_returns, daily_risk_free_rates, names=list(test_stats.index) + ["buy_and_hold"], benchmark="buy_and_hold"
+    )
+    sharpe_tests.to_csv("./" + config.RESULTS_DIR + "/test_sharpe_tests.csv", index=False)
+    print(f"{(sharpe_tests.p_value < 0.05).sum()} of {len(sharpe_tests)} configurations differ from buy and hold at the 5% level")
+
+
+def paper_trade():
+    """
+    Streams the test period one bar at a time through a trained configuration
+    (paper_trading.cell, or the one with the best test Sharpe ratio), whose
+    indicators, sentiment aggregates and state are updated from each bar
+    as it arrives, and reports the latency of its decisions against the budget
+    """
+    store = DatasetStore(configs["dataset"]["dir"], dataset_splits(configs))
+    test = store.split("test")
+    history = store.split("train_for_test")
+    # the bars before the test period warm the indicators up
+    warmup_dates = history.date.unique()[-configs["paper_trading"]["warmup_days"]:]
+    bars = pd.concat([history[history.date.isin(warmup_dates)], test], ignore_index=True)
+
+    name = configs["paper_trading"]["cell"]
+    if not name:
+        test_stats = pd.read_csv("./" + config.RESULTS_DIR + "/test_perf_stats.csv", index_col=0)
+        name = test_stats["Sharpe ratio"].idxmax()
+    cell = {cell_id(cell): cell for cell in grid_cells()}[name]
+    grid_train = use_sentiment_window(store.split("train"), configs["sentiments"]["days"])
+    model = load_models([trained_run_dir(cell, grid_train)])[0]
+
+    env_kwargs = make_env_kwargs(test, cell["features"], f"{cell['model_name']}_{cell['rep']}", cell.get("turbulence_threshold"))
+    tickers = sorted(test.tic.astype(str).unique())
+    sentiments = {tic: read_sentiments(path) for tic, path in sentiment_files(SENTIMENTS_DIR, tickers).items()}
+    trader = PaperTrader(model_policy(model), tickers, env_kwargs, sentiments, configs["sentiments"]["days"])
+    _, df_actions = trader.run(frame_feed(bars), start_date=test.date.min())
+
+    budget_ms = configs["paper_trading"]["budget_ms"]
+    latencies = trader.latencies.summary(budget_ms)
+    print(latencies)
+    latencies.to_csv("./" + config.RESULTS_DIR + "/paper_trading_latency.csv")
+    trader.latencies.histogram().to_csv("./" + config.RESULTS_DIR + "/paper_trading_latency_histogram.csv", index=False)
+    df_actions.to_csv("./" + config.RESULTS_DIR + "/paper_trading_orders.csv")
+    p99 = latencies.loc["total", "p99_ms"]
+    print(f"{name}: p99 decision latency of {p99:.2f}ms, {'within' if p99 <= budget_ms else 'over'} the {budget_ms}ms budget")
 
 
 if __name__ == "__main__":
-    
+    # stages to run, in order, e.g. python main.py load_and_save train
+    stages = {"load_and_save": load_and_save, "train": train, "test": test, "paper_trade": paper_trade}
+    for stage in sys.argv[1:] or ["load_and_save", "train", "test"]:
+        stages[stage]()
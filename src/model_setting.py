@@ -14,8 +14,8 @@ import json
 import sys
 import os
 from pprint import pprint
+from typing import List
 
-%matplotlib inline
 from finrl.config import config
 from finrl.marketdata.yahoodownloader import YahooDownloader
 from finrl.preprocessing.preprocessors import FeatureEngineer
@@ -26,16 +26,73 @@ from finrl.trade.backtest import backtest_stats, backtest_plot, get_daily_return
 
 sys.path.append("../FinRL-Library")
 
-def train_configuration(
-    model_name: str
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv
+
+from callbacks import EnvThroughputCallback, TrainingCheckpointCallback
+from checkpoints import latest_checkpoint, load_checkpoint, run_id, warm_start
+from fast_env import FastStockTradingEnv
+from replay_buffer import SharedMemoryReplayBuffer
+
+def make_train_env(
     train: pd.DataFrame,
-    validation: pd.DataFrame,
-    features: List[str],
-    batch_size: int,
-    lr: float,
+    env_kwargs: dict,
     seed: int,
+    env_class=FastStockTradingEnv,
+    n_envs: int = 1,
+    vec_env: str = "dummy",
     ):
+    """
+    Returns the vectorized training environment.
+
+    With n_envs > 1, copy i is seeded with seed + i and, when env_class is
+    FastStockTradingEnv, starts its first episode i / n_envs of the way into
+    the training window so the copies don't step through the same days together.
+    vec_env: "dummy" steps the copies in-process, "subproc" in one process each
+    """
+    if n_envs == 1:
+        e_train_gym = env_class(df = train, **env_kwargs)
+        e_train_gym.seed(42)
+        e_train_gym.action_space.seed(42)
+
+        env_train, _ = e_train_gym.get_sb_env()
+        env_train.seed(seed)
+        env_train.action_space.seed(seed)
+        return env_train
+
+    num_days = len(train.date.unique())
+
+    def make_env(rank):
+        def _init():
+            start_kwargs = {}
+            if env_class is FastStockTradingEnv:
+                start_kwargs["day"] = rank * (num_days - 1) // n_envs
+            env = env_class(df = train, **env_kwargs, **start_kwargs)
+            env.seed(seed + rank)
+            env.action_space.seed(seed + rank)
+            return env
+        return _init
+
+    env_fns = [make_env(rank) for rank in range(n_envs)]
+    if vec_env == "dummy":
+        env_train = DummyVecEnv(env_fns)
+    elif vec_env == "subproc":
+        env_train = SubprocVecEnv(env_fns)
+    else:
+        raise ValueError(f"vec_env must be 'dummy' or 'subproc', got {vec_env!r}")
+    env_train.seed(seed)
+    return env_train
 
+
+TOTAL_TIMESTEPS = 50000
+
+
+def make_env_kwargs(train: pd.DataFrame, features: List[str], model_name: str, turbulence_threshold: float = None):
+    """
+    Returns the keyword arguments of the training and validation environments
+
+    turbulence_threshold: turbulence at or above which the environments sell
+    everything and buy nothing (the data needs a turbulence column)
+    """
     stock_dimension = len(train.tic.unique())
     state_space = 1 + 2*stock_dimension + len(features)*stock_dimension
     print(f"Stock Dimension: {stock_dimension}, State Space: {state_space}")
@@ -52,40 +109,137 @@ def train_configuration(
         "reward_scaling": 1e-4,
         "model_name": model_name 
     }
+    # only set when used, so the run ids of existing configurations don't change
+    if turbulence_threshold is not None:
+        env_kwargs["turbulence_threshold"] = turbulence_threshold
+    return env_kwargs
 
-    e_train_gym = StockTradingEnv(df = train, **env_kwargs)
-    e_train_gym.seed(42)
-    e_train_gym.action_space.seed(42)
-
-    env_train, _ = e_train_gym.get_sb_env()
-    env_train.seed(seed)
-    env_train.action_space.seed(seed)
-    print(type(env_train))
 
+def build_model(env_train, batch_size: int, lr: float, shared_replay_buffer: bool = False):
+    """
+    shared_replay_buffer: keep the transitions in a SharedMemoryReplayBuffer
+    (float32, one observation per transition, in shared memory)
+    instead of SB3's ReplayBuffer
+    """
+    model_kwargs = {"batch_size": batch_size, 
+                    "buffer_size": 50000, 
+                    "learning_rate": lr}
+    if shared_replay_buffer:
+        model_kwargs["replay_buffer_class"] = SharedMemoryReplayBuffer
     agent = DRLAgent(env = env_train)
-    model_ddpg = agent.get_model("ddpg", 
-                                 model_kwargs={"batch_size": batch_size, 
-                                                "buffer_size": 50000, 
-                                                "learning_rate": lr}
-                                  )
-    trained_ddpg = agent.train_model(model=model_ddpg,
-                                     tb_log_name='ddpg',
-                                     total_timesteps=50000)
-
-    e_trade_gym = StockTradingEnv(df = validation, **env_kwargs)
+    return agent.get_model("ddpg", model_kwargs=model_kwargs)
+
+
+def evaluate_model(model, validation: pd.DataFrame, env_kwargs: dict, seed: int, env_class=FastStockTradingEnv):
+    """
+    Returns the account values and actions of the model trading over validation
+    """
+    e_trade_gym = env_class(df = validation, **env_kwargs)
     e_trade_gym.seed(seed)
     e_trade_gym.action_space.seed(seed)
-    df_account_value, df_actions = DRLAgent.DRL_prediction(
-          model=trained_ddpg,
+    return DRLAgent.DRL_prediction(
+          model=model,
           environment = e_trade_gym
     )
+
+
+def configuration_run_id(
+    train: pd.DataFrame,
+    env_kwargs: dict,
+    batch_size: int,
+    lr: float,
+    seed: int,
+    env_class=FastStockTradingEnv,
+    n_envs: int = 1,
+    warm_start_from: str = None,
+    shared_replay_buffer: bool = False,
+    ):
+    """
+    Returns the run id train_configuration checkpoints a configuration under
+    """
+    # only part of the id when set, so the ids of existing runs don't change
+    replay_buffer = {"replay_buffer": SharedMemoryReplayBuffer.__name__} if shared_replay_buffer else {}
+    return run_id(
+        env_kwargs=env_kwargs,
+        batch_size=batch_size,
+        lr=lr,
+        seed=seed,
+        env_class=env_class.__name__,
+        n_envs=n_envs,
+        total_timesteps=TOTAL_TIMESTEPS,
+        train=[str(train.date.min()), str(train.date.max()), len(train)],
+        warm_start_from=warm_start_from,
+        **replay_buffer,
+    )
+
+
+def train_configuration(
+    model_name: str,
+    train: pd.DataFrame,
+    validation: pd.DataFrame,
+    features: List[str],
+    batch_size: int,
+    lr: float,
+    seed: int,
+    env_class=FastStockTradingEnv,
+    n_envs: int = 1,
+    vec_env: str = "dummy",
+    checkpoint_freq: int = 10000,
+    warm_start_from: str = None,
+    shared_replay_buffer: bool = False,
+    turbulence_threshold: float = None,
+    ):
+    """
+    env_class: FastStockTradingEnv (default) or FinRL's StockTradingEnv,
+    both take the same env_kwargs and follow the same trading rules
+    n_envs, vec_env: number of environment copies collecting transitions in
+    parallel and how they are run (see make_train_env)
+    checkpoint_freq: steps between checkpoints of the run, saved under
+    TRAINED_MODEL_DIR/<run id>. The run id only depends on the configuration,
+    so rerunning an interrupted configuration resumes from its last checkpoint
+    warm_start_from: run id of an earlier run whose last policy initializes
+    the networks of this one (the hyperparameters are the ones given here)
+    shared_replay_buffer: train with a SharedMemoryReplayBuffer, about half
+    the memory of SB3's ReplayBuffer per transition (see build_model)
+    turbulence_threshold: train and validate with the environments going
+    risk-off on turbulent days (see make_env_kwargs)
+    """
+
+    env_kwargs = make_env_kwargs(train, features, model_name, turbulence_threshold)
+    run = configuration_run_id(
+        train, env_kwargs, batch_size, lr, seed, env_class, n_envs, warm_start_from, shared_replay_buffer
+    )
+    run_dir = os.path.join(".", config.TRAINED_MODEL_DIR, run)
+    print(f"Run id: {run}")
+
+    env_train = make_train_env(train, env_kwargs, seed, env_class, n_envs, vec_env)
+    print(type(env_train))
+
+    checkpoint = latest_checkpoint(run_dir)
+    if checkpoint is not None:
+        print(f"Resuming from {checkpoint}")
+        model_ddpg = load_checkpoint(checkpoint, env_train)
+    else:
+        model_ddpg = build_model(env_train, batch_size, lr, shared_replay_buffer)
+        if warm_start_from is not None:
+            warm_start_checkpoint = latest_checkpoint(os.path.join(".", config.TRAINED_MODEL_DIR, warm_start_from))
+            if warm_start_checkpoint is None:
+                raise ValueError(f"Run {warm_start_from} has no checkpoint to warm start from")
+            warm_start(model_ddpg, warm_start_checkpoint)
+
+    throughput = EnvThroughputCallback()
+    checkpointing = TrainingCheckpointCallback(run_dir, checkpoint_freq)
+    trained_ddpg = model_ddpg.learn(total_timesteps=TOTAL_TIMESTEPS - model_ddpg.num_timesteps,
+                                    tb_log_name='ddpg',
+                                    callback=[throughput, checkpointing],
+                                    reset_num_timesteps=checkpoint is None)
+    env_train.close()
+
+    df_account_value, df_actions = evaluate_model(trained_ddpg, validation, env_kwargs, seed, env_class)
         
     print("==============Get Backtest Results===========")
-    now = datetime.datetime.now().strftime('%Y%m%d-%Hh%M')
-
     perf_stats_all = backtest_stats(account_value=df_account_value)
     perf_stats_all = pd.DataFrame(perf_stats_all)
-    perf_stats_all.to_csv("./"+config.RESULTS_DIR+"/perf_stats_all_"+now+'.csv')
+    perf_stats_all.to_csv("./"+config.RESULTS_DIR+"/perf_stats_all_"+run+'.csv')
        
     return perf_stats_all, df_account_value
-
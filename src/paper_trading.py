@@ -0,0 +1,521 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.append("../data_preprocessing")
+from indicators import (
+    BOLL_PERIOD, BOLL_STD_TIMES, CCI_CONSTANT, COLUMN_INDICATOR, MACD_EMA_LONG, MACD_EMA_SHORT,
+    MACD_EMA_SIGNAL, PRICE_COLUMNS, WINDOW_INDICATOR
+)
+from price_sources import PRICE_COLUMNS as CSV_PRICE_COLUMNS
+from price_store import load_price_store
+
+from fast_env import OrderBuffers, execute_orders
+
+CSVS_DIR = "../data_preprocessing/csvs"
+PRICE_STORE_DIR = "../data_preprocessing/price_store"
+SENTIMENT_FEATURES = ["sentiment_mean", "sentiment_std"]
+# Time from a bar's arrival to its orders a policy should decide within
+DECISION_BUDGET_MS = 10
+# Stages of a bar timed by PaperTrader, total is the whole decision
+LATENCY_STAGES = ["features", "policy", "orders", "total"]
+# Edges of the latency histogram buckets, 10 per decade from 1us to 1s
+LATENCY_BUCKETS_MS = np.geomspace(1e-3, 1e3, 61)
+
+
+def price_store_feed(tickers=None, start_date=None, end_date=None, csvs_dir=CSVS_DIR, store_dir=PRICE_STORE_DIR):
+    """
+    Replays the bars of the *_technical_data.csv files one date at a time,
+    through the price store built from them (see data_preprocessing/price_store.py).
+
+    Yields the date and the bar: a dictionary of price column (open, high,
+    low, close, volume) to its (tickers,) values, in the order of tickers
+    (default: every ticker of the store). Calling it again replays the feed.
+    """
+    store = load_price_store(csvs_dir, store_dir)
+    tickers = store.tickers if tickers is None else list(tickers)
+    columns = [store.tickers.index(tic) for tic in tickers]
+    # the CSV header does not follow the order the prices are written in
+    # (see get_stock_price_data.CSV_CLOSE_INDEX), so fields are taken by position
+    fields = {column: CSV_PRICE_COLUMNS.index(column.capitalize()) for column in PRICE_COLUMNS}
+    rows = store.date_slice(start_date or store.dates[0], end_date or store.dates[-1])
+    for date, prices in zip(store.dates[rows], store.prices[rows]):
+        yield date, {column: prices[columns, field] for column, field in fields.items()}
+
+
+def frame_feed(df):
+    """
+    Replays the bars of a long dataset with date, tic and price columns
+    (e.g. a DatasetStore split) one date at a time, tickers sorted like
+    FastStockTradingEnv. Yields the same (date, bar) as price_store_feed,
+    with the turbulence of the date too when df has a turbulence column.
+    Tickers without a bar on a date (no row, or a row build_stock_panel
+    filled with 0) have NaN prices, like the bars the indicators were computed on.
+    """
+    df = df.assign(tic=df["tic"].astype(str))
+    columns = [column for column in PRICE_COLUMNS + ["turbulence"] if column in df.columns]
+    panels = {
+        column: df.pivot(index="date", columns="tic", values=column).sort_index().sort_index(axis=1)
+        for column in columns
+    }
+    dates = panels["close"].index
+    arrays = {column: panel.to_numpy(dtype=np.float64, copy=True) for column, panel in panels.items()}
+    missing = ~(arrays["close"] > 0)
+    for column in columns:
+        if column in PRICE_COLUMNS:
+            arrays[column][missing] = np.nan
+    for day, date in enumerate(dates):
+        yield date, {column: values[day] for column, values in arrays.items()}
+
+
+class EwmMean:
+    """
+    Exponentially weighted mean of every ticker, one bar at a time, with the
+    same recursion (and rounding) as indicators.ewm_mean over the whole array.
+    Tickers not in present (without a bar) are left as they are.
+    """
+
+    def __init__(self, alpha, num_tickers):
+        self.alpha = alpha
+        self.weighted_sums = np.zeros(num_tickers)
+        self.weights = np.zeros(num_tickers)
+
+    def update(self, values, present):
+        valid = ~np.isnan(values)
+        weighted_sums = np.where(valid, values, 0.0) - (self.alpha - 1.0) * self.weighted_sums
+        weights = valid - (self.alpha - 1.0) * self.weights
+        self.weighted_sums = np.where(present, weighted_sums, self.weighted_sums)
+        self.weights = np.where(present, weights, self.weights)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.weights == 0, np.nan, self.weighted_sums / self.weights)
+
+
+class MovingWindow:
+    """
+    The last window values of every ticker (NaN values are skipped) in a ring,
+    with their sums, sums of squares and counts, as moving_mean and
+    moving_var compute them: values are kept centered on the first valid
+    value of their ticker, and the sums of a ticker are recomputed from the
+    ring every time its position wraps around so the additions and removals
+    don't drift. Tickers not in present (without a bar) are left as they are.
+    """
+
+    def __init__(self, window, num_tickers):
+        self.window = window
+        self.ring = np.full((window, num_tickers), np.nan)
+        self.positions = np.zeros(num_tickers, dtype=np.int64)
+        self.first = np.full(num_tickers, np.nan)
+        self.sums = np.zeros(num_tickers)
+        self.squares = np.zeros(num_tickers)
+        self.counts = np.zeros(num_tickers)
+
+    def update(self, values, present):
+        tickers = np.flatnonzero(present)
+        self.first[tickers] = np.where(np.isnan(self.first[tickers]), values[tickers], self.first[tickers])
+        centered = values[tickers] - self.first[tickers]
+        rows = self.positions[tickers]
+        leaving = self.ring[rows, tickers]
+        self.ring[rows, tickers] = centered
+        self.positions[tickers] = (rows + 1) % self.window
+
+        entering, left = np.nan_to_num(centered), np.nan_to_num(leaving)
+        self.sums[tickers] += entering - left
+        self.squares[tickers] += entering ** 2 - left ** 2
+        self.counts[tickers] += ~np.isnan(centered)
+        self.counts[tickers] -= ~np.isnan(leaving)
+        wrapped = tickers[self.positions[tickers] == 0]
+        if len(wrapped):
+            ring = self.ring[:, wrapped]
+            self.sums[wrapped] = np.nansum(ring, axis=0)
+            self.squares[wrapped] = np.nansum(ring ** 2, axis=0)
+            self.counts[wrapped] = np.sum(~np.isnan(ring), axis=0)
+
+    def mean(self, min_periods=None):
+        min_periods = self.window if min_periods is None else min_periods
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums / self.counts + self.first
+        return np.where(self.counts < min_periods, np.nan, means)
+
+    def var(self, min_periods=None, ddof=1):
+        min_periods = self.window if min_periods is None else min_periods
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = np.maximum((self.squares - self.sums ** 2 / self.counts) / (self.counts - ddof), 0.0)
+        return np.where(self.counts < max(min_periods, ddof + 1), np.nan, var)
+
+    def mean_absolute_deviation(self, means):
+        """
+        Mean distance of the window's values to means, as in indicators.cci
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.nansum(np.abs(self.ring - (means - self.first)), axis=0) / self.counts
+
+
+class StreamingIndicators:
+    """
+    The technical indicators of indicators.compute_indicators (stockstats
+    names), updated one bar of every ticker at a time from a few moving
+    windows and exponentially weighted means per ticker instead of the
+    whole history: O(tickers) per bar (cci_<n> goes over its n day window).
+    Up to rounding, the values of a bar are compute_indicators' values of
+    the bars streamed so far, NaN included. Like add_technical_indicators,
+    a ticker's indicators only see its own bars: a ticker without a bar on
+    a date (NaN close) is skipped and keeps its values.
+    """
+
+    def __init__(self, indicators, num_tickers):
+        self.indicators = list(indicators)
+        self.num_tickers = num_tickers
+        self._windows = dict()
+        self._ewms = dict()
+        self._previous = None
+        # parse the names now so an unknown one fails before streaming starts
+        for name in self.indicators:
+            if name in ("macd", "macds", "macdh", "boll", "boll_ub", "boll_lb"):
+                continue
+            match = COLUMN_INDICATOR.match(name)
+            if not WINDOW_INDICATOR.match(name) and not (match and match.group(1) in PRICE_COLUMNS):
+                raise ValueError(f"Unknown technical indicator {name!r}")
+
+    def _window(self, series, values, window):
+        """
+        The moving window of a series, updated with values once per bar
+        """
+        key = (series, window)
+        if key not in self._updated:
+            self._windows.setdefault(key, MovingWindow(window, self.num_tickers)).update(values, self._present)
+            self._updated[key] = self._windows[key]
+        return self._updated[key]
+
+    def _ewm(self, series, values, alpha):
+        """
+        The exponentially weighted mean of a series, updated with values once per bar
+        """
+        key = (series, alpha)
+        if key not in self._updated:
+            self._updated[key] = self._ewms.setdefault(key, EwmMean(alpha, self.num_tickers)).update(values, self._present)
+        return self._updated[key]
+
+    def update(self, bar):
+        """
+        bar: dictionary of price column to its (tickers,) values
+
+        Returns a dictionary of indicator name to its (tickers,) values
+        """
+        self._updated = dict()
+        close = bar["close"]
+        self._present = ~np.isnan(close)
+        nan = np.full(self.num_tickers, np.nan)
+        # the last bar of every ticker, which need not be the previous date's
+        previous = self._previous or {column: nan for column in bar}
+        computed = dict()
+        for name in self.indicators:
+            if name in computed:
+                continue
+            if name in ("macd", "macds", "macdh"):
+                line = (
+                    self._ewm("close", close, 2.0 / (MACD_EMA_SHORT + 1))
+                    - self._ewm("close", close, 2.0 / (MACD_EMA_LONG + 1))
+                )
+                signal = self._ewm("macd", line, 2.0 / (MACD_EMA_SIGNAL + 1))
+                computed.update(macd=line, macds=signal, macdh=line - signal)
+            elif name in ("boll", "boll_ub", "boll_lb"):
+                window = self._window("close", close, BOLL_PERIOD)
+                middle, std = window.mean(1), np.sqrt(window.var(1))
+                computed.update(boll=middle, boll_ub=middle + BOLL_STD_TIMES * std, boll_lb=middle - BOLL_STD_TIMES * std)
+            elif WINDOW_INDICATOR.match(name):
+                kind, window = WINDOW_INDICATOR.match(name).groups()
+                computed[name] = self._window_indicator(kind, int(window), bar, previous)
+            else:
+                column, window, kind = COLUMN_INDICATOR.match(name).groups()
+                window = int(window)
+                if kind == "sma":
+                    computed[name] = self._window(column, bar[column], window).mean(1)
+                elif kind == "ema":
+                    computed[name] = self._ewm(column, bar[column], 2.0 / (window + 1))
+                else:
+                    computed[name] = np.sqrt(self._window(column, bar[column], window).var(1))
+        self._previous = {column: np.where(self._present, values, previous[column]) for column, values in bar.items()}
+        return {name: computed[name] for name in self.indicators}
+
+    def _window_indicator(self, kind, window, bar, previous):
+        close, high, low = bar["close"], bar.get("high"), bar.get("low")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if kind == "rsi":
+                change = close - previous["close"]
+                zeros = np.where(np.isnan(change), np.nan, 0.0)
+                gains = self._ewm("gains", np.where(change > 0, change, zeros), 1.0 / window)
+                losses = self._ewm("losses", np.where(change < 0, -change, zeros), 1.0 / window)
+                return 100 - 100 / (1.0 + gains / losses)
+            if kind == "cci":
+                typical = (close + high + low) / 3.0
+                typical_window = self._window("typical", typical, window)
+                typical_mean = typical_window.mean(1)
+                deviation = typical_window.mean_absolute_deviation(typical_mean)
+                return (typical - typical_mean) / (CCI_CONSTANT * deviation)
+            if kind == "dx":
+                up_move = np.maximum(high - previous["high"], 0.0)
+                down_move = np.maximum(previous["low"] - low, 0.0)
+                plus_dm = np.where(up_move > down_move, up_move, 0.0)
+                minus_dm = np.where(down_move > up_move, down_move, 0.0)
+                true_range = np.max([high - low, np.abs(high - previous["close"]), np.abs(low - previous["close"])], axis=0)
+                average_true_range = self._ewm("true_range", true_range, 1.0 / window)
+                plus_di = self._ewm("plus_dm", plus_dm, 2.0 / (window + 1)) / average_true_range * 100
+                minus_di = self._ewm("minus_dm", minus_dm, 2.0 / (window + 1)) / average_true_range * 100
+                return np.abs(plus_di - minus_di) / (plus_di + minus_di) * 100
+            returns = close / previous["close"] - 1
+            return np.sqrt(self._window("returns", returns, window).var())
+
+
+class StreamingSentiment:
+    """
+    The sentiment_mean and sentiment_std of the tickers on each date, as
+    SentimentStore.add_columns and use_sentiment_window give them: the mean
+    and std of the news published from ndays before the date up to and
+    including it, 0 for the tickers without news on that date.
+
+    The news of all tickers are sorted by date once. Each date adds the news
+    published since the previous one to running sums per ticker and removes
+    the ones that left the window, O(tickers + news) per date.
+    """
+
+    def __init__(self, sentiments, tickers, ndays):
+        """
+        sentiments: dictionary of ticker to its news (read_sentiments)
+        """
+        self.ndays = ndays
+        self.num_tickers = len(tickers)
+        codes = {tic: code for code, tic in enumerate(tickers)}
+        news = [
+            (news_of_tic["date"].to_numpy(dtype="datetime64[D]"), np.full(len(news_of_tic), codes[tic]),
+             news_of_tic["sentiment_score"].to_numpy(dtype=np.float64))
+            for tic, news_of_tic in sentiments.items() if tic in codes
+        ]
+        dates, tickers, scores = (np.concatenate(arrays) for arrays in zip(*news)) if news else (
+            np.array([], dtype="datetime64[D]"), np.array([], dtype=np.int64), np.array([])
+        )
+        order = np.argsort(dates, kind="stable")
+        self.dates, self.tickers, self.scores = dates[order], tickers[order], scores[order]
+        self.sums = np.zeros(self.num_tickers)
+        self.squares = np.zeros(self.num_tickers)
+        self.counts = np.zeros(self.num_tickers)
+        self._added, self._removed = 0, 0
+
+    def _accumulate(self, rows, sign):
+        np.add.at(self.sums, self.tickers[rows], sign * self.scores[rows])
+        np.add.at(self.squares, self.tickers[rows], sign * self.scores[rows] ** 2)
+        np.add.at(self.counts, self.tickers[rows], sign)
+
+    def update(self, date):
+        """
+        Returns the (tickers,) sentiment_mean and sentiment_std of date
+        """
+        date = np.datetime64(date, "D")
+        added = np.searchsorted(self.dates, date, side="right")
+        rows = slice(self._added, added)
+        self._accumulate(rows, 1)
+        news_today = np.zeros(self.num_tickers, dtype=bool)
+        news_today[self.tickers[rows][self.dates[rows] == date]] = True
+        self._added = added
+
+        removed = np.searchsorted(self.dates, date - np.timedelta64(self.ndays, "D"), side="left")
+        self._accumulate(slice(self._removed, removed), -1)
+        self._removed = removed
+
+        counts = np.where(news_today, self.counts, 1.0)
+        mean = np.where(news_today, self.sums / counts, 0.0)
+        std = np.where(news_today, np.sqrt(np.maximum(self.squares / counts - mean ** 2, 0.0)), 0.0)
+        return mean, std
+
+
+class LatencyRecorder:
+    """
+    Nanoseconds every bar spent in each stage, with their percentiles and
+    histogram in milliseconds
+    """
+
+    def __init__(self, stages=LATENCY_STAGES):
+        self.samples = {stage: [] for stage in stages}
+
+    def record(self, **stage_ns):
+        for stage, ns in stage_ns.items():
+            self.samples[stage].append(ns)
+
+    def _milliseconds(self, stage):
+        return np.array(self.samples[stage], dtype=np.float64) / 1e6
+
+    def summary(self, budget_ms=DECISION_BUDGET_MS):
+        """
+        Returns a frame with the number of bars, the mean, p50, p95, p99 and
+        max milliseconds of every stage and the share of bars within budget_ms
+        """
+        rows = dict()
+        for stage in self.samples:
+            ms = self._milliseconds(stage)
+            if not len(ms):
+                continue
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            rows[stage] = {
+                "bars": len(ms), "mean_ms": ms.mean(), "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+                "max_ms": ms.max(), "within_budget": (ms <= budget_ms).mean(),
+            }
+        return pd.DataFrame.from_dict(rows, orient="index")
+
+    def histogram(self, buckets_ms=LATENCY_BUCKETS_MS):
+        """
+        Returns a frame with the number of bars of every stage in each bucket
+        [low_ms, high_ms), the last one also counting the bars above it
+        """
+        counts = {
+            stage: np.histogram(np.clip(self._milliseconds(stage), buckets_ms[0], buckets_ms[-1]), buckets_ms)[0]
+            for stage in self.samples
+        }
+        return pd.DataFrame({"low_ms": buckets_ms[:-1], "high_ms": buckets_ms[1:], **counts})
+
+
+def model_policy(model):
+    """
+    The deterministic action of a trained SB3 model for a state, as DRL_prediction
+    """
+    def policy(state):
+        action, _ = model.predict(state, deterministic=True)
+        return action
+    return policy
+
+
+class PaperTrader:
+    """
+    Trades a policy on a stream of bars, one bar at a time, with the state,
+    action and order semantics of FastStockTradingEnv(**env_kwargs): on each
+    bar the indicators and sentiment aggregates are updated with it, the state
+    vector (cash, closes, holdings, features) is written in place, the policy
+    picks the actions and the orders are executed at the bar's close.
+
+    As build_stock_panel fills the dataset the policy was trained on, the
+    prices and features of tickers without a bar are 0 (they can't trade on
+    it), and so are features missing on a bar. The dataset fills the first
+    bars of a ticker's indicators with its first values instead, which a
+    stream doesn't have yet, so a stream should start with warm-up bars (see run).
+
+    With a turbulence_threshold, the bars need a turbulence (see frame_feed):
+    on the bars at or above it, except the first traded one, everything held
+    is sold and nothing is bought, as FastStockTradingEnv.risk_off_days.
+
+    Every bar's stages are timed into latencies (see LatencyRecorder).
+    """
+
+    def __init__(self, policy, tickers, env_kwargs, sentiments=None, sentiment_days=0, torch_threads=1):
+        self.policy = policy
+        self.tickers = list(tickers)
+        self.hmax = env_kwargs["hmax"]
+        self.buy_cost_pct = env_kwargs["buy_cost_pct"]
+        self.sell_cost_pct = env_kwargs["sell_cost_pct"]
+        self.turbulence_threshold = env_kwargs.get("turbulence_threshold")
+        self.initial_amount = env_kwargs["initial_amount"]
+        self.features = list(env_kwargs["tech_indicator_list"])
+        n = self.stock_dim = len(self.tickers)
+        if env_kwargs["stock_dim"] != n:
+            raise ValueError(f"The policy trades {env_kwargs['stock_dim']} tickers, the stream has {n}")
+
+        self.indicators = StreamingIndicators(
+            [f for f in self.features if f not in PRICE_COLUMNS and f not in SENTIMENT_FEATURES], n
+        )
+        self.sentiment = None
+        if any(f in SENTIMENT_FEATURES for f in self.features):
+            if sentiments is None:
+                raise ValueError("The features need sentiments")
+            self.sentiment = StreamingSentiment(sentiments, self.tickers, sentiment_days)
+        # single threaded inference has the lowest latency for small networks
+        torch.set_num_threads(torch_threads)
+
+        self.state = np.zeros(env_kwargs["state_space"], dtype=np.float32)
+        self._feature_values = np.zeros((len(self.features), n))
+        self._close = np.zeros(n)
+        # the environments start their episodes at a turbulence of 0
+        self._traded = False
+        self.cash = np.array([float(self.initial_amount)])
+        self.holdings = np.zeros((1, n))
+        self._orders = np.zeros((1, n), dtype=np.int64)
+        self._order_buffers = OrderBuffers(1, n)
+        self.latencies = LatencyRecorder()
+
+    def _update_features(self, date, bar):
+        values = self.indicators.update(bar)
+        if self.sentiment is not None:
+            values.update(zip(SENTIMENT_FEATURES, self.sentiment.update(date)))
+        present = ~np.isnan(bar["close"])
+        for i, feature in enumerate(self.features):
+            value = bar[feature] if feature in PRICE_COLUMNS else values[feature]
+            self._feature_values[i] = np.where(present & ~np.isnan(value), value, 0.0)
+        self._close[:] = np.where(present, bar["close"], 0.0)
+
+        n = self.stock_dim
+        self.state[0] = self.cash[0]
+        self.state[1:n + 1] = self._close
+        self.state[n + 1:2 * n + 1] = self.holdings[0]
+        self.state[2 * n + 1:] = self._feature_values.ravel()
+
+    def account_value(self, close):
+        return self.cash[0] + np.where(np.isnan(close), 0.0, close) @ self.holdings[0]
+
+    def _risk_off(self, bar):
+        if self.turbulence_threshold is None:
+            return False
+        if "turbulence" not in bar:
+            raise ValueError("The bars need a turbulence to use turbulence_threshold")
+        return self._traded and np.nanmax(bar["turbulence"]) >= self.turbulence_threshold
+
+    def on_bar(self, date, bar, trade=True):
+        """
+        Processes a bar as it arrives. Returns the orders executed at its
+        close (shares, negative for sells), or None for a warm-up bar
+        (trade=False), which only updates the features.
+        """
+        start = time.perf_counter_ns()
+        self._update_features(date, bar)
+        features_done = time.perf_counter_ns()
+        if not trade:
+            return None
+
+        actions = self.policy(self.state)
+        policy_done = time.perf_counter_ns()
+        # same float32 scaling and truncation towards zero as the environment
+        self._orders[0] = (np.asarray(actions, dtype=np.float32) * self.hmax).astype(int)
+        if self._risk_off(bar):
+            self._orders[0] = -np.maximum(self.holdings[0], 0)
+        self._traded = True
+        execute_orders(
+            self.cash, self.holdings, self._close, self._orders, self.buy_cost_pct, self.sell_cost_pct, self._order_buffers
+        )
+        end = time.perf_counter_ns()
+        self.latencies.record(
+            features=features_done - start, policy=policy_done - features_done,
+            orders=end - policy_done, total=end - start,
+        )
+        return self._orders[0].copy()
+
+    def run(self, feed, start_date=None):
+        """
+        Streams the bars of feed (see price_store_feed and frame_feed), trading
+        from start_date on (default: the first bar), the bars before it
+        warm the features up.
+
+        Returns a frame of the account value at every traded bar's close
+        before its orders (as save_asset_memory) and a frame of the orders
+        executed at every traded bar (as save_action_memory).
+        """
+        start_date = None if start_date is None else pd.Timestamp(start_date)
+        dates, account_values, orders = [], [], []
+        for date, bar in feed:
+            trade = start_date is None or pd.Timestamp(date) >= start_date
+            if trade:
+                dates.append(date)
+                account_values.append(self.account_value(bar["close"]))
+            bar_orders = self.on_bar(date, bar, trade)
+            if trade:
+                orders.append(bar_orders)
+        df_account_value = pd.DataFrame({"date": dates, "account_value": account_values})
+        df_actions = pd.DataFrame(np.array(orders).reshape(-1, self.stock_dim), columns=self.tickers)
+        df_actions.index = pd.Index(dates, name="date")
+        return df_account_value, df_actions
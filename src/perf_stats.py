@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+TRADING_DAYS_PER_YEAR = 252
+# Statistics of pyfolio's timeseries.perf_stats, which backtest_stats prints,
+# in the same order
+PERF_STAT_NAMES = [
+    "Annual return",
+    "Cumulative returns",
+    "Annual volatility",
+    "Sharpe ratio",
+    "Calmar ratio",
+    "Stability",
+    "Max drawdown",
+    "Omega ratio",
+    "Sortino ratio",
+    "Skew",
+    "Kurtosis",
+    "Tail ratio",
+    "Daily value at risk",
+]
+
+
+def perf_stats(account_values):
+    """
+    account_values: (K, T) account value curves, e.g. of K models over the
+    same trading days
+
+    Returns a (K, len(PERF_STAT_NAMES)) DataFrame with the statistics
+    backtest_stats computes for every curve, all curves at once.
+
+    Like backtest_stats, the daily returns are the pct_change of the curve, so
+    their first value is NaN. empyrical skips it, except for the number of
+    years of the annual return, and scipy's skew and kurtosis propagate it.
+    """
+    account_values = np.asarray(account_values, dtype=np.float64)
+    num_curves, num_days = account_values.shape
+    returns = account_values[:, 1:] / account_values[:, :-1] - 1
+
+    growth = np.prod(1 + returns, axis=1)
+    annual_return = growth ** (TRADING_DAYS_PER_YEAR / num_days) - 1
+    cumulative_returns = growth - 1
+
+    mean = returns.mean(axis=1)
+    std = returns.std(axis=1, ddof=1)
+    annual_volatility = std * np.sqrt(TRADING_DAYS_PER_YEAR)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sharpe_ratio = mean / std * np.sqrt(TRADING_DAYS_PER_YEAR)
+
+    cumulative = np.hstack([np.full((num_curves, 1), 100.0), 100.0 * np.cumprod(1 + returns, axis=1)])
+    running_max = np.fmax.accumulate(cumulative, axis=1)
+    max_drawdown = ((cumulative - running_max) / running_max).min(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        calmar_ratio = np.where(max_drawdown < 0, annual_return / np.abs(max_drawdown), np.nan)
+    calmar_ratio[np.isinf(calmar_ratio)] = np.nan
+
+    # r squared of the linear fit of the cumulative log returns against time
+    cumulative_log_returns = np.cumsum(np.log1p(returns), axis=1)
+    time = np.arange(num_days - 1, dtype=np.float64)
+    time_deviation = time - time.mean()
+    log_deviation = cumulative_log_returns - cumulative_log_returns.mean(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = (log_deviation @ time_deviation) / np.sqrt(
+            (log_deviation ** 2).sum(axis=1) * (time_deviation ** 2).sum()
+        )
+    stability = correlation ** 2
+
+    gains = np.where(returns > 0, returns, 0).sum(axis=1)
+    losses = -np.where(returns < 0, returns, 0).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        omega_ratio = np.where(losses > 0, gains / losses, np.nan)
+
+    downside_risk = np.sqrt((np.minimum(returns, 0) ** 2).mean(axis=1)) * np.sqrt(TRADING_DAYS_PER_YEAR)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sortino_ratio = mean * TRADING_DAYS_PER_YEAR / downside_risk
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tail_ratio = np.abs(np.percentile(returns, 95, axis=1)) / np.abs(np.percentile(returns, 5, axis=1))
+    value_at_risk = mean - 2.0 * std
+
+    stats = np.column_stack([
+        annual_return,
+        cumulative_returns,
+        annual_volatility,
+        sharpe_ratio,
+        calmar_ratio,
+        stability,
+        max_drawdown,
+        omega_ratio,
+        sortino_ratio,
+        np.full(num_curves, np.nan),
+        np.full(num_curves, np.nan),
+        tail_ratio,
+        value_at_risk,
+    ])
+    return pd.DataFrame(stats, columns=PERF_STAT_NAMES)
+
+
+def perf_stats_frame(stats_row):
+    """
+    Returns one row of perf_stats in the layout of
+    pd.DataFrame(backtest_stats(account_value=...))
+    """
+    return pd.DataFrame(pd.Series(stats_row.values, index=PERF_STAT_NAMES))
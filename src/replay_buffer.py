@@ -0,0 +1,270 @@
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+from stable_baselines3.common.buffers import BaseBuffer, ReplayBuffer
+from stable_baselines3.common.preprocessing import get_action_dim, get_obs_shape
+from stable_baselines3.common.type_aliases import ReplayBufferSamples
+
+# Every array of the buffer starts on a multiple of this many bytes
+ALIGNMENT = 64
+
+
+def _aligned(num_bytes):
+    return -(-num_bytes // ALIGNMENT) * ALIGNMENT
+
+
+def replay_buffer_layout(buffer_size, n_envs, obs_shape, action_dim):
+    """
+    Returns the (offset, shape, dtype) of every array of a shared replay buffer
+    and the total number of bytes of its block
+    """
+    arrays = {
+        "observations": ((buffer_size, n_envs) + tuple(obs_shape), np.float32),
+        "actions": ((buffer_size, n_envs, action_dim), np.float32),
+        "rewards": ((buffer_size, n_envs), np.float32),
+        "dones": ((buffer_size, n_envs), np.float32),
+        # position and full flag of every environment column, shared with
+        # every process attached to the block
+        "counters": ((n_envs, 2), np.int64),
+    }
+    layout, offset = dict(), 0
+    for name, (shape, dtype) in arrays.items():
+        layout[name] = (offset, shape, dtype)
+        offset += _aligned(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return layout, offset
+
+
+def default_bytes_per_transition(observation_space, action_space):
+    """
+    Bytes a transition takes in SB3's ReplayBuffer: obs and next_obs in the
+    dtype of the observation space, the action in the dtype of the action space,
+    float32 reward and done
+    """
+    obs_bytes = int(np.prod(get_obs_shape(observation_space))) * np.dtype(observation_space.dtype).itemsize
+    action_bytes = get_action_dim(action_space) * np.dtype(action_space.dtype).itemsize
+    return 2 * obs_bytes + action_bytes + 2 * np.dtype(np.float32).itemsize
+
+
+def _release(block, owner):
+    if owner:
+        block.unlink()
+    try:
+        block.close()
+    except BufferError:
+        # arrays of the buffer are still alive, the mapping goes with them
+        pass
+
+
+class SharedMemoryReplayBuffer(ReplayBuffer):
+    """
+    Replay buffer holding its transitions as float32 arrays in one block of
+    shared memory (multiprocessing.shared_memory), a drop-in replacement for
+    SB3's ReplayBuffer through replay_buffer_class.
+
+    The next observation of a transition is not stored separately: it is the
+    observation of the next row of the same environment (as with SB3's
+    optimize_memory_usage), so a transition takes one observation instead of
+    two. The next observation of the last transition of an episode is
+    overwritten by the first observation of the next episode. Its value is
+    only used when the episode was cut by a time limit, which the trading
+    environments don't have, since the target of a done transition is its
+    reward alone.
+
+    Every environment column has its own position and full flag, and only one
+    process may write to a column. Other processes (e.g. parallel collectors)
+    attach to the block by name through attach(buffer.shared_spec(), env_index)
+    and write to their column of the same arrays without copying or pickling
+    them, so the next observation of a transition is always one its collector
+    wrote. The buffer that created the block writes to every column, so when
+    collectors fill it, only they call add. The buffer that created the block unlinks it when closed or garbage collected,
+    so collectors should be started from its process (multiprocessing children
+    share its resource tracker, which would otherwise unlink the block when
+    they exit).
+    Pickling (e.g. save_replay_buffer) copies the transitions, and unpickling
+    puts them in a new block.
+    """
+
+    def __init__(
+        self,
+        buffer_size,
+        observation_space,
+        action_space,
+        device="cpu",
+        n_envs=1,
+        optimize_memory_usage=True,
+        handle_timeout_termination=False,
+        name=None,
+        env_index=None,
+        ):
+        if handle_timeout_termination:
+            raise ValueError(
+                "SharedMemoryReplayBuffer does not keep the next observation of the last transition of an episode, "
+                "so it cannot handle timeout termination"
+            )
+        # pos and full are only set once the block exists (see the properties)
+        self._columns = slice(None) if env_index is None else slice(env_index, env_index + 1)
+        BaseBuffer.__init__(self, buffer_size, observation_space, action_space, device, n_envs=n_envs)
+        self._layout, self.nbytes = replay_buffer_layout(buffer_size, n_envs, self.obs_shape, self.action_dim)
+        owner = name is None
+        if owner:
+            self._block = shared_memory.SharedMemory(create=True, size=self.nbytes)
+        else:
+            self._block = shared_memory.SharedMemory(name=name)
+        self._finalizer = weakref.finalize(self, _release, self._block, owner)
+        self._bind()
+        self.optimize_memory_usage = True
+        self.handle_timeout_termination = False
+
+        if owner:
+            print(
+                f"Replay buffer: {self.bytes_per_transition()} bytes per transition "
+                f"({default_bytes_per_transition(observation_space, action_space)} with ReplayBuffer), "
+                f"{self.nbytes / 2**20:.1f} MiB in shared memory {self.name}"
+            )
+
+    def _bind(self):
+        for array_name, (offset, shape, dtype) in self._layout.items():
+            setattr(self, array_name, np.ndarray(shape, dtype=dtype, buffer=self._block.buf, offset=offset))
+
+    @property
+    def name(self):
+        return self._block.name
+
+    # pos and full are the ones of the columns this buffer writes to, they live
+    # in the block so that every attached process sees them, a new block starts
+    # at 0 and BaseBuffer's initial values are not written over the ones of an
+    # attached block
+    @property
+    def pos(self):
+        return int(self.counters[self._columns][0, 0])
+
+    @pos.setter
+    def pos(self, value):
+        if "counters" in self.__dict__:
+            self.counters[self._columns, 0] = value
+
+    @property
+    def full(self):
+        return bool(self.counters[self._columns][0, 1])
+
+    @full.setter
+    def full(self, value):
+        if "counters" in self.__dict__:
+            self.counters[self._columns, 1] = value
+
+    def size(self):
+        """
+        Returns the number of transitions of all the columns
+        """
+        return int(np.sum(self._transitions_per_column()))
+
+    def _transitions_per_column(self):
+        # the row at pos only holds the next observation of the row before it
+        positions, full = self.counters[:, 0], self.counters[:, 1].astype(bool)
+        return np.where(full, self.buffer_size - 1, positions)
+
+    def bytes_per_transition(self):
+        """
+        Bytes a transition takes: one float32 observation, action, reward and done
+        """
+        return sum(
+            int(np.prod(shape[2:])) * np.dtype(dtype).itemsize
+            for array_name, (_, shape, dtype) in self._layout.items() if array_name != "counters"
+        )
+
+    def shared_spec(self):
+        """
+        Returns what attach needs to open the same block in another process
+        """
+        return {
+            "name": self.name,
+            "buffer_size": self.buffer_size,
+            "observation_space": self.observation_space,
+            "action_space": self.action_space,
+            "n_envs": self.n_envs,
+        }
+
+    @classmethod
+    def attach(cls, shared_spec, env_index, device="cpu"):
+        """
+        Returns a buffer on the block of the buffer shared_spec was taken from,
+        writing to environment column env_index only
+        """
+        spec = dict(shared_spec)
+        if not 0 <= env_index < spec["n_envs"]:
+            raise ValueError(f"env_index must be in [0, {spec['n_envs']}), got {env_index}")
+        return cls(
+            spec.pop("buffer_size"), spec.pop("observation_space"), spec.pop("action_space"),
+            device=device, env_index=env_index, **spec
+        )
+
+    def close(self):
+        """
+        Release the block, which is unlinked if this buffer created it
+        """
+        for array_name in self._layout:
+            self.__dict__.pop(array_name, None)
+        self._finalizer()
+
+    def add(self, obs, next_obs, action, reward, done, infos=None):
+        pos, columns = self.pos, self._columns
+        n_envs = len(self.counters[columns])
+        # the rows are written before the position moves past them,
+        # so a process sampling the block never reads a partial transition
+        self.observations[pos, columns] = np.asarray(obs).reshape((n_envs,) + self.obs_shape)
+        self.observations[(pos + 1) % self.buffer_size, columns] = np.asarray(next_obs).reshape((n_envs,) + self.obs_shape)
+        self.actions[pos, columns] = np.asarray(action).reshape(n_envs, self.action_dim)
+        self.rewards[pos, columns] = np.asarray(reward).reshape(n_envs)
+        self.dones[pos, columns] = np.asarray(done).reshape(n_envs)
+
+        if pos + 1 == self.buffer_size:
+            self.full = True
+        self.pos = (pos + 1) % self.buffer_size
+
+    def sample(self, batch_size, env=None):
+        # uniform over the transitions of every column, which collectors
+        # may have filled to different positions
+        transitions = self._transitions_per_column()
+        ends = np.cumsum(transitions)
+        if ends[-1] == 0:
+            raise ValueError("The replay buffer has no transitions to sample")
+        inds = np.random.randint(0, ends[-1], size=batch_size)
+        env_indices = np.searchsorted(ends, inds, side="right")
+        inds -= ends[env_indices] - transitions[env_indices]
+        # the row at pos holds the next observation of the row before it,
+        # not the observation of the transition it used to hold
+        positions, full = self.counters[env_indices, 0], self.counters[env_indices, 1].astype(bool)
+        batch_inds = np.where(full, (positions + 1 + inds) % self.buffer_size, inds)
+        return self._get_samples(batch_inds, env=env, env_indices=env_indices)
+
+    def _get_samples(self, batch_inds, env=None, env_indices=None):
+        if env_indices is None:
+            env_indices = np.random.randint(0, high=self.n_envs, size=(len(batch_inds),))
+        next_inds = (batch_inds + 1) % self.buffer_size
+        data = (
+            self._normalize_obs(self.observations[batch_inds, env_indices], env),
+            self.actions[batch_inds, env_indices],
+            self._normalize_obs(self.observations[next_inds, env_indices], env),
+            self.dones[batch_inds, env_indices].reshape(-1, 1),
+            self._normalize_reward(self.rewards[batch_inds, env_indices].reshape(-1, 1), env),
+        )
+        return ReplayBufferSamples(*tuple(map(self.to_torch, data)))
+
+    def __getstate__(self):
+        state = {
+            key: value for key, value in self.__dict__.items()
+            if key not in self._layout and key not in ("_block", "_finalizer")
+        }
+        state["_data"] = bytes(self._block.buf[:self.nbytes])
+        return state
+
+    def __setstate__(self, state):
+        data = state.pop("_data")
+        self.__dict__.update(state)
+        # the copy owns its block and writes to every column
+        self._columns = slice(None)
+        self._block = shared_memory.SharedMemory(create=True, size=self.nbytes)
+        self._block.buf[:self.nbytes] = data
+        self._finalizer = weakref.finalize(self, _release, self._block, True)
+        self._bind()
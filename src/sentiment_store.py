@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+SENTIMENTS_DIR = "./data/sentiments"
+SENTIMENT_STORE_DIR = "./data/sentiment_store"
+SENTIMENT_DATE_FMT = "%Y-%m-%d"
+SENTIMENT_STATS = ["mean", "std", "count"]
+
+
+def sentiment_column(stat, ndays):
+    return f"sentiment_{stat}_{ndays}d"
+
+
+def ticker_sentiment_stats(sentiments, ndays):
+    """
+    sentiments: news of one ticker, with date and sentiment_score columns
+
+    Returns a frame indexed by every date with news, holding the mean, std and
+    count of the sentiment_score of the news published from ndays before that
+    date up to and including it.
+    """
+    sentiments = sentiments.sort_values("date", kind="mergesort")
+    scores = pd.Series(
+        sentiments["sentiment_score"].values,
+        index=pd.DatetimeIndex(sentiments["date"]).normalize()
+    )
+    rolling = scores.rolling(f"{ndays + 1}D")
+    stats = pd.DataFrame({
+        "sentiment_mean": rolling.mean(),
+        "sentiment_std": rolling.std(ddof=0),
+        "sentiment_count": rolling.count(),
+    })
+    # the last row of each date is the only one whose window covers all of that day's news
+    stats = stats[~stats.index.duplicated(keep="last")]
+    return stats.rename_axis("date")
+
+
+def sentiment_files(sentiments_dir=SENTIMENTS_DIR, tickers=None):
+    """
+    Returns a dictionary of ticker to its sentiment CSV (named <ticker>_*.csv)
+    """
+    files = dict()
+    for root, dirs, names in os.walk(sentiments_dir, topdown=False):
+        for name in names:
+            tic = name.split("_")[0]
+            if tickers is None or tic in tickers:
+                files[tic] = os.path.join(root, name)
+    return files
+
+
+def read_sentiments(path):
+    sentiments = pd.read_csv(path, index_col=0).reset_index(drop=True)
+    sentiments["date"] = pd.to_datetime(sentiments["date"], format=SENTIMENT_DATE_FMT)
+    return sentiments
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SentimentStore:
+    """
+    Daily per-ticker sentiment aggregates (mean, std and count) for a set of
+    lookback windows, computed once and kept next to the hash of the CSV they
+    were computed from:
+
+        store_dir/<ticker>.feather   date and one column per (stat, window)
+        store_dir/<ticker>.json      source hash and windows
+
+    A ticker is only recomputed when its CSV changes or a window is missing,
+    and windows requested over time accumulate in its file.
+    """
+
+    def __init__(self, windows, sentiments_dir=SENTIMENTS_DIR, store_dir=SENTIMENT_STORE_DIR):
+        self.windows = sorted(set(windows))
+        self.sentiments_dir = sentiments_dir
+        self.store_dir = store_dir
+
+    def _paths(self, tic):
+        base = os.path.join(self.store_dir, tic)
+        return base + ".feather", base + ".json"
+
+    def _stored_windows(self, tic, source_hash):
+        """
+        Returns the windows stored for the ticker if they were computed
+        from the current CSV, otherwise an empty list
+        """
+        stats_path, meta_path = self._paths(tic)
+        if not (os.path.exists(stats_path) and os.path.exists(meta_path)):
+            return []
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        return meta["windows"] if meta["source_hash"] == source_hash else []
+
+    def _build(self, tic, path, source_hash, windows):
+        sentiments = read_sentiments(path)
+        stats = pd.concat([
+            ticker_sentiment_stats(sentiments, ndays).rename(columns={
+                f"sentiment_{stat}": sentiment_column(stat, ndays) for stat in SENTIMENT_STATS
+            })
+            for ndays in windows
+        ], axis=1).reset_index()
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        stats_path, meta_path = self._paths(tic)
+        stats.to_feather(stats_path)
+        with open(meta_path, "w") as f:
+            json.dump({"source_hash": source_hash, "windows": windows}, f)
+        return stats
+
+    def ticker_stats(self, tic, path):
+        """
+        Returns the stored aggregates of a ticker, (re)computing them if needed
+        """
+        source_hash = file_hash(path)
+        stored_windows = self._stored_windows(tic, source_hash)
+        columns = ["date"] + [sentiment_column(stat, ndays) for ndays in self.windows for stat in SENTIMENT_STATS]
+        if set(self.windows) <= set(stored_windows):
+            return pd.read_feather(self._paths(tic)[0], columns=columns)
+        # windows computed earlier from the same CSV are kept
+        windows = sorted(set(self.windows) | set(stored_windows))
+        print(f"Computing sentiment aggregates of {tic} for windows {windows}")
+        return self._build(tic, path, source_hash, windows)[columns]
+
+    def add_columns(self, df, tickers=None):
+        """
+        df: main pandas dataset
+
+        Adds the aggregates of every window as columns, matched on (date, tic).
+        Rows whose ticker has no news on that date get 0, even when there is
+        news earlier in the window.
+        """
+        stats = []
+        for tic, path in sentiment_files(self.sentiments_dir, tickers).items():
+            tic_stats = self.ticker_stats(tic, path)
+            tic_stats["tic"] = tic
+            stats.append(tic_stats)
+
+        keys = pd.DataFrame({
+            "date": pd.to_datetime(df["date"]).values,
+            "tic": df["tic"].astype(str).values,
+        })
+        columns = [sentiment_column(stat, ndays) for ndays in self.windows for stat in SENTIMENT_STATS]
+        if stats:
+            stats = pd.concat(stats, ignore_index=True)
+            stats["date"] = stats["date"].astype(keys["date"].dtype)
+            joined = keys.merge(stats, on=["date", "tic"], how="left", sort=False)
+        else:
+            joined = pd.DataFrame(np.nan, index=keys.index, columns=columns)
+        for column in columns:
+            dtype = np.int32 if column.startswith("sentiment_count") else np.float32
+            df[column] = joined[column].fillna(0).to_numpy(dtype=dtype)
+        return df
+
+
+def use_sentiment_window(df, ndays):
+    """
+    Sets the sentiment_mean and sentiment_std feature columns
+    to the aggregates of the given lookback window
+    """
+    if sentiment_column("mean", ndays) not in df.columns:
+        raise ValueError(f"The dataset has no sentiment aggregates for a {ndays} day window, add it to sentiments.windows")
+    df["sentiment_mean"] = df[sentiment_column("mean", ndays)]
+    df["sentiment_std"] = df[sentiment_column("std", ndays)]
+    return df
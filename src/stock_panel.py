@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+from typing import List
+
+MARKET_DATA_CACHE_DIR = "../data_preprocessing/market_data_cache"
+
+
+def download_stock_data(start_date:str, end_date:str, ticker_list:List[str], price_source):
+    """
+    Same output as FinRL's YahooDownloader(...).fetch_data(), with the bars
+    served by price_source (e.g. a CachedPriceSource) instead of yf.download
+    """
+    frames = []
+    for tic in ticker_list:
+        # YahooDownloader downloads unadjusted bars and uses the adjusted close
+        temp_df = price_source.fetch(tic, start=start_date, end=end_date, interval="1d", auto_adjust=False)
+        frames.append(pd.DataFrame({
+            "date": temp_df.index,
+            "open": temp_df["Open"].to_numpy(),
+            "high": temp_df["High"].to_numpy(),
+            "low": temp_df["Low"].to_numpy(),
+            "close": temp_df["Adj Close"].to_numpy(),
+            "volume": temp_df["Volume"].to_numpy(),
+            "tic": tic,
+        }))
+    data_df = pd.concat(frames, ignore_index=True)
+    data_df["day"] = data_df["date"].dt.dayofweek
+    data_df["date"] = data_df["date"].dt.strftime("%Y-%m-%d")
+    data_df = data_df.dropna().reset_index(drop=True)
+    print("Shape of DataFrame: ", data_df.shape)
+    return data_df.sort_values(by=['date','tic']).reset_index(drop=True)
+
+
+def build_stock_panel(processed:pd.DataFrame, trading_dates=None):
+    """
+    Reindexes processed onto every (trading date, tic) pair, sorted by date and
+    tic, filling missing rows and values with 0.
+
+    The trading dates default to the dates of processed. A shard of the
+    tickers passes the dates of all tickers so its panel has the same rows
+    as the panel of the full frame.
+
+    Rows are placed by their (date code, tic code) position in the product index,
+    so the panel is allocated once, column by column, in compact dtypes:
+    date as datetime64, tic as categorical and float features as float32.
+    """
+    dates = pd.to_datetime(processed["date"])
+    if trading_dates is None:
+        trading_dates = dates.unique()
+    trading_dates = pd.DatetimeIndex(trading_dates).sort_values()
+    tickers = pd.Index(sorted(processed["tic"].unique()))
+
+    # position of every processed row in the (trading date, tic) product
+    rows = trading_dates.get_indexer(dates) * len(tickers) + tickers.get_indexer(processed["tic"])
+    panel = pd.DataFrame({
+        "date": np.repeat(trading_dates.values, len(tickers)),
+        "tic": pd.Categorical.from_codes(np.tile(np.arange(len(tickers)), len(trading_dates)), categories=tickers),
+    })
+    for column in processed.columns.drop(["date", "tic"]):
+        values = processed[column]
+        dtype = np.float32 if pd.api.types.is_float_dtype(values) else values.dtype
+        panel_values = np.zeros(len(panel), dtype=dtype)
+        panel_values[rows] = values.fillna(0).to_numpy(dtype=dtype)
+        panel[column] = panel_values
+    return panel
@@ -0,0 +1,272 @@
+import json
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import torch
+from finrl.trade.backtest import backtest_stats
+
+from utils import set_seed
+from checkpoints import latest_checkpoint, load_checkpoint, save_checkpoint
+from dataloader import RISK_FREE_RATES_CSV, get_daily_risk_free_rates, risk_free_adjusted_sharpe_ratio
+from model_setting import (
+    TOTAL_TIMESTEPS, build_model, evaluate_model, make_env_kwargs, make_train_env, train_configuration
+)
+
+# Set once per worker process by _init_worker so the datasets are pickled
+# once per worker instead of once per configuration
+_worker_data = {}
+
+
+def sweep_cells(model_names, features, repetition, batch_sizes, learning_rates, seed, turbulence_threshold=None):
+    """
+    Returns the list of configurations of the hyperparameter grid.
+    Every repetition gets its own seed so repetitions are independent runs.
+    With a turbulence_threshold, every configuration trains with it
+    (see make_env_kwargs).
+    """
+    cells = []
+    for model_name, feature_set in zip(model_names, features):
+        for rep in range(repetition):
+            for batch_size in batch_sizes:
+                for lr in learning_rates:
+                    cell = {
+                        "model_name": model_name,
+                        "rep": rep,
+                        "features": feature_set,
+                        "batch_size": batch_size,
+                        "lr": lr,
+                        "seed": seed + rep,
+                    }
+                    if turbulence_threshold is not None:
+                        cell["turbulence_threshold"] = turbulence_threshold
+                    cells.append(cell)
+    return cells
+
+
+def cell_id(cell):
+    return f"{cell['model_name']}_{cell['rep']}_{cell['batch_size']}_{cell['lr']}"
+
+
+def result_path(results_dir, cell):
+    return os.path.join(results_dir, cell_id(cell) + ".json")
+
+
+def _write_json(path, data):
+    """
+    Write through a temporary file so an interrupted sweep never
+    leaves a truncated file behind.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _write_result(results_dir, cell, result):
+    _write_json(result_path(results_dir, cell), result)
+
+
+def _init_worker(train, validation, torch_threads, daily_rf_rates=None):
+    # Each worker trains one model at a time, so keep torch from
+    # oversubscribing the cores shared with the other workers
+    torch.set_num_threads(torch_threads)
+    _worker_data["train"] = train
+    _worker_data["validation"] = validation
+    _worker_data["daily_rf_rates"] = daily_rf_rates
+
+
+def _run_cell(cell):
+    set_seed(cell["seed"])
+    ctime = time.time()
+    perf_stats_all, _ = train_configuration(
+        f"{cell['model_name']}_{cell['rep']}",
+        _worker_data["train"],
+        _worker_data["validation"],
+        cell["features"],
+        cell["batch_size"],
+        cell["lr"],
+        cell["seed"],
+        turbulence_threshold=cell.get("turbulence_threshold"),
+    )
+    return {
+        "cell": cell,
+        "perf_stats": perf_stats_all.to_json(),
+        "minutes": (time.time() - ctime) / 60,
+    }
+
+
+def load_results(results_dir, cells):
+    """
+    Returns a dictionary of cell id to saved result for every finished cell.
+    """
+    results = {}
+    for cell in cells:
+        path = result_path(results_dir, cell)
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                results[cell_id(cell)] = json.load(f)
+    return results
+
+
+def run_sweep(cells, train, validation, results_dir, num_workers=None, torch_threads=1):
+    """
+    Train every cell of the grid across a pool of num_workers processes
+    (defaults to the number of CPUs).
+
+    Each finished cell is saved to results_dir as soon as it completes, and
+    cells that already have a saved result are skipped, so rerunning an
+    interrupted sweep only trains the missing cells.
+
+    Returns a dictionary of cell id to result for every cell.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    pending = [cell for cell in cells if not os.path.exists(result_path(results_dir, cell))]
+    print(f"{len(cells) - len(pending)} of {len(cells)} configurations already done, {len(pending)} to run")
+
+    if pending:
+        num_workers = num_workers or os.cpu_count()
+        with ProcessPoolExecutor(
+            max_workers=min(num_workers, len(pending)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(train, validation, torch_threads),
+        ) as executor:
+            futures = {executor.submit(_run_cell, cell): cell for cell in pending}
+            for done, future in enumerate(as_completed(futures), 1):
+                cell = futures[future]
+                try:
+                    _write_result(results_dir, cell, future.result())
+                    print(f"[{done}/{len(pending)}] {cell_id(cell)} saved")
+                except Exception as e:
+                    # keep collecting the other cells, this one is retried on the next run
+                    print(f"[{done}/{len(pending)}] {cell_id(cell)} failed: {e!r}")
+
+    return load_results(results_dir, cells)
+
+
+def rung_timesteps(min_timesteps, max_timesteps, eta):
+    """
+    Returns the training steps every surviving trial has reached at each rung:
+    min_timesteps, min_timesteps * eta, ... up to max_timesteps.
+    """
+    rungs = [min_timesteps]
+    while rungs[-1] < max_timesteps:
+        rungs.append(min(rungs[-1] * eta, max_timesteps))
+    return rungs
+
+
+def _run_trial(cell, timesteps, results_dir):
+    """
+    Train the model of a cell up to timesteps, continuing from its last
+    checkpoint, then checkpoint it and score it on the validation window.
+    """
+    run_dir = os.path.join(results_dir, "checkpoints", cell_id(cell))
+    set_seed(cell["seed"])
+    ctime = time.time()
+    env_kwargs = make_env_kwargs(
+        _worker_data["train"], cell["features"], f"{cell['model_name']}_{cell['rep']}", cell.get("turbulence_threshold")
+    )
+    env_train = make_train_env(_worker_data["train"], env_kwargs, cell["seed"])
+    checkpoint = latest_checkpoint(run_dir)
+    if checkpoint is not None:
+        model = load_checkpoint(checkpoint, env_train)
+    else:
+        model = build_model(env_train, cell["batch_size"], cell["lr"])
+    model.learn(total_timesteps=timesteps - model.num_timesteps, tb_log_name='ddpg', reset_num_timesteps=checkpoint is None)
+    save_checkpoint(model, run_dir)
+    env_train.close()
+
+    df_account_value, _ = evaluate_model(model, _worker_data["validation"], env_kwargs, cell["seed"])
+    daily_returns = df_account_value["account_value"].pct_change().fillna(0).values
+    sharpe = risk_free_adjusted_sharpe_ratio(daily_returns, _worker_data["daily_rf_rates"])
+    return {
+        "cell": cell,
+        "timesteps": int(model.num_timesteps),
+        "sharpe": float(sharpe),
+        "perf_stats": pd.DataFrame(backtest_stats(account_value=df_account_value)).to_json(),
+        "minutes": (time.time() - ctime) / 60,
+    }
+
+
+def _rung_sharpe(trial, timesteps):
+    # trials that failed or never traded (nan Sharpe) rank last
+    sharpe = trial.get("sharpe_by_timesteps", {}).get(str(timesteps), float("nan")) if trial else float("nan")
+    return -math.inf if math.isnan(sharpe) else sharpe
+
+
+def run_successive_halving(
+    cells, train, validation, results_dir, min_timesteps, eta,
+    max_timesteps=TOTAL_TIMESTEPS, num_workers=None, torch_threads=1, group_by=("model_name", "rep"),
+):
+    """
+    Adaptive version of run_sweep: every cell starts as a trial trained for
+    min_timesteps, and after each rung only the best 1 / eta of the trials of
+    each group (by default the hyperparameters of one model and repetition)
+    by validation risk free adjusted Sharpe ratio are trained eta times longer,
+    up to max_timesteps.
+
+    Trials are checkpointed at every rung, so a promoted trial continues
+    exactly where it stopped, and the scheduler state is saved after every
+    trial, so rerunning an interrupted search picks up where it stopped.
+
+    Returns a dictionary of cell id to the last result of every trial, with the
+    steps it was trained for under "timesteps".
+    """
+    os.makedirs(os.path.join(results_dir, "checkpoints"), exist_ok=True)
+    state_path = os.path.join(results_dir, "successive_halving.json")
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path, "r") as f:
+            state = json.load(f)
+
+    validation_dates = pd.to_datetime(pd.Series(validation.date.unique())).values
+    daily_rf_rates = get_daily_risk_free_rates(validation_dates, RISK_FREE_RATES_CSV)
+    rungs = rung_timesteps(min_timesteps, max_timesteps, eta)
+
+    groups = {}
+    for cell in cells:
+        groups.setdefault(tuple(cell[key] for key in group_by), []).append(cell)
+
+    num_workers = num_workers or os.cpu_count()
+    with ProcessPoolExecutor(
+        max_workers=min(num_workers, len(cells)),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(train, validation, torch_threads, daily_rf_rates),
+    ) as executor:
+        for rung, timesteps in enumerate(rungs):
+            if rung > 0:
+                for key, trials in groups.items():
+                    trials = sorted(trials, key=lambda cell: _rung_sharpe(state.get(cell_id(cell)), rungs[rung - 1]), reverse=True)
+                    groups[key] = trials[:max(1, math.ceil(len(trials) / eta))]
+                    for cell in trials[len(groups[key]):]:
+                        print(f"rung {rung}: stopped {cell_id(cell)} after {rungs[rung - 1]} steps")
+
+            pending = [
+                cell for trials in groups.values() for cell in trials
+                if state.get(cell_id(cell), {}).get("timesteps", 0) < timesteps
+            ]
+            print(f"rung {rung}: training {len(pending)} trials to {timesteps} steps")
+            futures = {executor.submit(_run_trial, cell, timesteps, results_dir): cell for cell in pending}
+            for done, future in enumerate(as_completed(futures), 1):
+                cell = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # a failed trial ranks last and is stopped at the next rung
+                    print(f"[{done}/{len(pending)}] {cell_id(cell)} failed: {e!r}")
+                    continue
+                sharpe_by_timesteps = state.get(cell_id(cell), {}).get("sharpe_by_timesteps", {})
+                result["sharpe_by_timesteps"] = {**sharpe_by_timesteps, str(timesteps): result["sharpe"]}
+                state[cell_id(cell)] = result
+                _write_json(state_path, state)
+                print(f"[{done}/{len(pending)}] {cell_id(cell)}: Sharpe {result['sharpe']:.3f} after {timesteps} steps")
+
+    used = sum(state[cell_id(cell)]["timesteps"] for cell in cells if cell_id(cell) in state)
+    grid = len(cells) * max_timesteps
+    print(f"Successive halving trained {used} of the {grid} steps of the exhaustive grid ({1 - used / grid:.0%} saved)")
+    return {cell_id(cell): state[cell_id(cell)] for cell in cells if cell_id(cell) in state}
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_preprocessing"))
+from price_sources import LocalCsvPriceSource
+
+from dataloader import get_stock_data
+from dataset_pipeline import build_dataset_sharded
+from dataset_store import DatasetStore, write_dataset
+from sentiment_store import SentimentStore
+
+TICKERS = ["AAA", "BBB", "CCC", "DDD"]
+INDICATORS = ["macd", "boll_ub", "boll_lb", "rsi_30", "cci_30", "dx_30", "close_30_sma"]
+WINDOWS = [0, 3]
+
+
+def write_bars(csv_dir, rng):
+    """
+    Writes yf.download style CSVs of random walks, with a ticker that
+    lists later and one with missing days, so shards have different dates
+    """
+    dates = pd.bdate_range("2015-01-01", "2017-12-31")
+    for i, tic in enumerate(TICKERS):
+        close = 50 * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates))))
+        bars = pd.DataFrame({
+            "Date": dates.strftime("%Y-%m-%d"),
+            "Open": close * rng.uniform(0.98, 1.02, len(dates)),
+            "High": close * 1.03,
+            "Low": close * 0.97,
+            "Close": close,
+            "Adj Close": close,
+            "Volume": rng.integers(10**5, 10**6, len(dates)).astype(float),
+        })
+        if i == 1:
+            bars = bars.iloc[200:]
+        if i == 2:
+            bars = bars.drop(index=range(300, 320))
+        bars.to_csv(os.path.join(csv_dir, f"{tic}.csv"), index=False)
+
+
+def write_sentiments(sentiments_dir, rng):
+    os.makedirs(sentiments_dir)
+    for tic in TICKERS[:2]:
+        dates = pd.DatetimeIndex(rng.choice(pd.bdate_range("2015-01-01", "2017-12-31"), 200)).strftime("%Y-%m-%d")
+        news = pd.DataFrame({"date": dates, "sentiment_score": rng.uniform(-1, 1, len(dates))})
+        news.to_csv(os.path.join(sentiments_dir, f"{tic}_news.csv"))
+
+
+def test_sharded_dataset_equals_full_frame_dataset(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("bars")
+    write_bars("bars", rng)
+    write_sentiments(os.path.join("data", "sentiments"), rng)
+    source = LocalCsvPriceSource("bars")
+
+    df, _ = get_stock_data("2015-06-01", "2018-01-01", TICKERS, INDICATORS, price_source=source)
+    write_dataset(SentimentStore(WINDOWS).add_columns(df, TICKERS), "full")
+    # a 1 MB budget puts every ticker in its own shard
+    build_dataset_sharded(
+        "2015-06-01", "2018-01-01", TICKERS, INDICATORS, WINDOWS, "sharded",
+        memory_budget_mb=1, num_workers=2, price_source=source,
+    )
+
+    full = DatasetStore("full").read("2015-06-01", "2018-01-01")
+    sharded = DatasetStore("sharded").read("2015-06-01", "2018-01-01")
+    assert (full["sentiment_count_3d"] > 0).any()
+    pd.testing.assert_frame_equal(sharded, full)
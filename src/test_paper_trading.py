@@ -0,0 +1,98 @@
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_preprocessing"))
+from get_stock_price_data import download_ticker
+from price_sources import LocalCsvPriceSource
+
+from dataloader import get_stock_data
+from fast_env import FastStockTradingEnv
+from model_setting import make_env_kwargs
+from paper_trading import PaperTrader, frame_feed, price_store_feed
+
+TICKERS = ["AAA", "BBB", "CCC"]
+INDICATORS = ["macd", "rsi_30", "cci_30", "dx_30", "close_30_sma"]
+
+
+def write_bars(csv_dir, rng, gaps=True):
+    """
+    Writes yf.download style CSVs of random walks, with a ticker that
+    lists later and one with missing days if gaps
+    """
+    dates = pd.bdate_range("2005-09-01", "2007-12-31")
+    for i, tic in enumerate(TICKERS):
+        close = 50 * np.exp(np.cumsum(rng.normal(0, 0.02, len(dates))))
+        bars = pd.DataFrame({
+            "Date": dates.strftime("%Y-%m-%d"),
+            "Open": close * rng.uniform(0.98, 1.02, len(dates)),
+            "High": close * rng.uniform(1.02, 1.04, len(dates)),
+            "Low": close * rng.uniform(0.96, 0.98, len(dates)),
+            "Close": close,
+            "Adj Close": close,
+            "Volume": rng.integers(10**5, 10**6, len(dates)).astype(float),
+        })
+        if gaps and i == 1:
+            bars = bars.iloc[200:]
+        if gaps and i == 2:
+            bars = bars.drop(index=range(300, 320))
+        bars.to_csv(os.path.join(csv_dir, f"{tic}.csv"), index=False)
+
+
+def test_price_store_feed_prices_equal_dataset_prices(tmp_path):
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / "bars")
+    os.makedirs(tmp_path / "csvs")
+    # the price store needs every ticker on the same dates
+    write_bars(tmp_path / "bars", rng, gaps=False)
+    source = LocalCsvPriceSource(str(tmp_path / "bars"))
+    for tic in TICKERS:
+        download_ticker(tic, source, end_time=datetime(2008, 1, 1), csv_dir=str(tmp_path / "csvs"))
+
+    df, _ = get_stock_data("2006-01-01", "2008-01-01", TICKERS, ["macd"], price_source=source)
+    feed = dict(price_store_feed(TICKERS, csvs_dir=str(tmp_path / "csvs"), store_dir=str(tmp_path / "store")))
+    for column in ["open", "high", "low", "close"]:
+        dataset = df.pivot(index="date", columns="tic", values=column)
+        streamed = np.array([feed[date][column] for date in dataset.index], dtype=np.float32)
+        np.testing.assert_array_equal(streamed, dataset[TICKERS].to_numpy())
+
+
+def test_paper_trader_trades_like_the_environment(tmp_path):
+    rng = np.random.default_rng(1)
+    os.makedirs(tmp_path / "bars")
+    write_bars(tmp_path / "bars", rng)
+    df, _ = get_stock_data(
+        "2006-01-01", "2008-01-01", TICKERS, INDICATORS, price_source=LocalCsvPriceSource(str(tmp_path / "bars")),
+        use_turbulence=True, turbulence_window=60,
+    )
+    # after the first bars of BBB, whose indicators the dataset fills with later values,
+    # and before CCC's missing days
+    start_date = pd.Timestamp("2006-09-01")
+    test = df[df.date >= start_date].reset_index(drop=True)
+    test.index = test.date.factorize()[0]
+    features = INDICATORS + ["volume"]
+    threshold = test.turbulence.quantile(0.9)
+    env_kwargs = make_env_kwargs(test, features, "test", threshold)
+    weights = rng.normal(0, 1, (len(TICKERS), env_kwargs["state_space"])).astype(np.float32)
+
+    env = FastStockTradingEnv(df=test, **env_kwargs)
+
+    def policy(state):
+        # the streamed state is the environment's, up to the rounding of the
+        # float32 prices the indicators are streamed from, and both trade the
+        # action of the environment's state
+        np.testing.assert_allclose(state, env.state, rtol=1e-3, atol=1e-3)
+        actions = np.tanh(weights @ (env.state / (np.abs(env.state) + 1))).astype(np.float32)
+        env.step(actions)
+        return actions
+
+    trader = PaperTrader(policy, TICKERS, env_kwargs)
+    df_account_value, df_actions = trader.run(frame_feed(df), start_date=start_date)
+    assert env.terminal and env.risk_off_days().any()
+
+    np.testing.assert_allclose(df_account_value["account_value"], env.save_asset_memory()["account_value"])
+    # the environment has no orders on its last day
+    np.testing.assert_array_equal(df_actions.to_numpy()[:-1], env.save_action_memory().to_numpy())
@@ -0,0 +1,59 @@
+import multiprocessing
+
+import numpy as np
+from gym import spaces
+
+from replay_buffer import SharedMemoryReplayBuffer
+
+BUFFER_SIZE = 50
+STEPS = 80
+
+
+def collect(shared_spec, env_index, start):
+    """
+    Adds STEPS transitions whose observation is (env_index, step) and whose
+    next observation is (env_index, step + 1) to column env_index
+    """
+    buffer = SharedMemoryReplayBuffer.attach(shared_spec, env_index)
+    start.wait()
+    for step in range(STEPS):
+        buffer.add(
+            np.array([env_index, step], dtype=np.float32),
+            np.array([env_index, step + 1], dtype=np.float32),
+            np.full(1, step, dtype=np.float32),
+            np.array([100 * env_index + step]),
+            np.zeros(1),
+        )
+    buffer.close()
+
+
+def test_two_collectors_write_their_own_columns():
+    observation_space = spaces.Box(-np.inf, np.inf, shape=(2,))
+    action_space = spaces.Box(-1, 1, shape=(1,))
+    buffer = SharedMemoryReplayBuffer(BUFFER_SIZE, observation_space, action_space, n_envs=2)
+
+    ctx = multiprocessing.get_context("spawn")
+    start = ctx.Event()
+    collectors = [ctx.Process(target=collect, args=(buffer.shared_spec(), i, start)) for i in range(2)]
+    for collector in collectors:
+        collector.start()
+    start.set()
+    for collector in collectors:
+        collector.join()
+        assert collector.exitcode == 0
+
+    assert buffer.counters.tolist() == [[STEPS % BUFFER_SIZE, 1], [STEPS % BUFFER_SIZE, 1]]
+    assert buffer.size() == 2 * (BUFFER_SIZE - 1)
+
+    np.random.seed(0)
+    samples = buffer.sample(1000)
+    obs, next_obs = np.asarray(samples.observations), np.asarray(samples.next_observations)
+    env_index, step = obs[:, 0], obs[:, 1]
+    # every transition is one its collector wrote, and only the last BUFFER_SIZE - 1 are kept
+    assert set(env_index) == {0, 1}
+    assert (step >= STEPS - BUFFER_SIZE + 1).all() and (step < STEPS).all()
+    np.testing.assert_array_equal(next_obs[:, 0], env_index)
+    np.testing.assert_array_equal(next_obs[:, 1], step + 1)
+    np.testing.assert_array_equal(np.asarray(samples.actions)[:, 0], step)
+    np.testing.assert_array_equal(np.asarray(samples.rewards)[:, 0], 100 * env_index + step)
+    buffer.close()
@@ -1,4 +1,5 @@
 import os
+import random
 
 import torch
 import numpy as np
@@ -7,7 +8,7 @@ from gym.utils import seeding
 from stable_baselines3.common.utils import set_random_seed
 
 
-def set_seed(seed=seed):
+def set_seed(seed):
     os.environ['PYTHONHASHSEED']=str(seed) 
 
     _,seed = seeding.np_random(seed)
@@ -15,3 +16,23 @@ def set_seed(seed=seed):
     set_random_seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
+
+
+def get_rng_state():
+    """
+    Returns the state of every random number generator set_seed seeds
+    """
+    return {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "torch_cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state["random"])
+    np.random.set_state(rng_state["numpy"])
+    torch.set_rng_state(rng_state["torch"])
+    if rng_state["torch_cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state["torch_cuda"])